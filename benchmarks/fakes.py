@@ -0,0 +1,581 @@
+import copy
+import datetime
+import random
+import re
+import sys
+import threading
+import time
+import types
+import uuid
+from concurrent.futures import Future
+
+
+# Sentinels and transforms matching google.cloud.firestore's public API
+class _Sentinel:
+    def __init__(self, name):
+        self.name = name
+
+    def __repr__(self):
+        return self.name
+
+
+SERVER_TIMESTAMP = _Sentinel("SERVER_TIMESTAMP")
+DELETE_FIELD = _Sentinel("DELETE_FIELD")
+
+
+class ArrayUnion:
+    def __init__(self, values):
+        self.values = list(values)
+
+
+class ArrayRemove:
+    def __init__(self, values):
+        self.values = list(values)
+
+
+class Increment:
+    def __init__(self, value):
+        self.value = value
+
+
+_FIELD_PATH_TOKEN = re.compile(r"`((?:[^`\\]|\\.)*)`|([^.`]+)")
+_SIMPLE_FIELD_NAME = re.compile(r"^[_a-zA-Z][_a-zA-Z0-9]*$")
+
+
+def _split_field_path(path):
+    return [
+        re.sub(r"\\(.)", r"\1", quoted) if quoted else plain for quoted, plain in _FIELD_PATH_TOKEN.findall(path)
+    ]
+
+
+# Matches google.cloud.firestore_v1.field_path.FieldPath, for building paths of field
+# names that need quoting
+class FieldPath:
+    def __init__(self, *parts):
+        self.parts = parts
+
+    def to_api_repr(self):
+        return ".".join(
+            part if _SIMPLE_FIELD_NAME.match(part) else "`" + part.replace("\\", "\\\\").replace("`", "\\`") + "`"
+            for part in self.parts
+        )
+
+
+# Firestore's limits on a single commit and on the size of a document
+MAX_WRITES_PER_COMMIT = 500
+MAX_DOCUMENT_BYTES = 1024 * 1024 - 4
+
+
+# Function to get the storage size of a value the way Firestore counts it
+def _value_size(value):
+    if isinstance(value, str):
+        return len(value.encode("utf-8")) + 1
+    if isinstance(value, bytes):
+        return len(value)
+    if isinstance(value, dict):
+        return sum(_value_size(key) + _value_size(item) for key, item in value.items())
+    if isinstance(value, (list, tuple)):
+        return sum(_value_size(item) for item in value)
+    if value is None or isinstance(value, bool):
+        return 1
+    return 8
+
+
+def _document_size(path, data):
+    return sum(len(segment.encode("utf-8")) + 1 for segment in path.split("/")) + 16 + _value_size(data) + 32
+
+
+def _apply_value(current, value):
+    if value is SERVER_TIMESTAMP:
+        return datetime.datetime.now(datetime.timezone.utc)
+    if isinstance(value, ArrayUnion):
+        result = list(current) if isinstance(current, list) else []
+        result += [item for item in value.values if item not in result]
+        return result
+    if isinstance(value, ArrayRemove):
+        result = list(current) if isinstance(current, list) else []
+        return [item for item in result if item not in value.values]
+    if isinstance(value, Increment):
+        return (current if isinstance(current, (int, float)) else 0) + value.value
+    if isinstance(value, dict):
+        return {key: _apply_value(None, item) for key, item in value.items()}
+    return copy.deepcopy(value)
+
+
+def _merge(target, data):
+    for key, value in data.items():
+        if value is DELETE_FIELD:
+            target.pop(key, None)
+        elif isinstance(value, dict) and isinstance(target.get(key), dict):
+            _merge(target[key], value)
+        else:
+            target[key] = _apply_value(target.get(key), value)
+
+
+def _set_path(target, path, value):
+    parts = _split_field_path(path)
+    for part in parts[:-1]:
+        if not isinstance(target.get(part), dict):
+            target[part] = {}
+        target = target[part]
+    if value is DELETE_FIELD:
+        target.pop(parts[-1], None)
+    else:
+        target[parts[-1]] = _apply_value(target.get(parts[-1]), value)
+
+
+def _get_path(data, path):
+    for part in _split_field_path(path):
+        if not isinstance(data, dict) or part not in data:
+            raise KeyError(path)
+        data = data[part]
+    return data
+
+
+class NotFound(Exception):
+    pass
+
+
+class InvalidArgument(Exception):
+    pass
+
+
+class DocumentSnapshot:
+    def __init__(self, reference, data):
+        self.reference = reference
+        self.id = reference.id
+        self._data = data
+
+    @property
+    def exists(self):
+        return self._data is not None
+
+    def to_dict(self):
+        return copy.deepcopy(self._data) if self._data is not None else None
+
+    def get(self, field_path):
+        if self._data is None:
+            raise KeyError(field_path)
+        return copy.deepcopy(_get_path(self._data, field_path))
+
+
+class DocumentReference:
+    def __init__(self, client, path):
+        self._client = client
+        self.path = path
+        self.id = path.rsplit("/", 1)[-1]
+
+    def collection(self, name):
+        return CollectionReference(self._client, f"{self.path}/{name}")
+
+    def get(self, transaction=None):
+        return self._client._get(self)
+
+    def set(self, data, merge=False):
+        self._client._commit([("set", self, data, merge)])
+
+    def update(self, data):
+        self._client._commit([("update", self, data, False)])
+
+    def delete(self):
+        self._client._commit([("delete", self, None, False)])
+
+
+_OPERATORS = {
+    "==": lambda a, b: a == b,
+    "!=": lambda a, b: a != b,
+    "<": lambda a, b: a is not None and a < b,
+    "<=": lambda a, b: a is not None and a <= b,
+    ">": lambda a, b: a is not None and a > b,
+    ">=": lambda a, b: a is not None and a >= b,
+    "in": lambda a, b: a in b,
+    "array_contains": lambda a, b: isinstance(a, list) and b in a,
+}
+
+
+class Query:
+    def __init__(self, client, path, filters=(), limit=None, orders=(), cursor=None, fields=None):
+        self._client = client
+        self._path = path
+        self._filters = list(filters)
+        self._limit = limit
+        self._orders = list(orders)
+        self._cursor = cursor
+        self._fields = fields
+
+    def _copy(self, **changes):
+        options = {
+            "filters": self._filters, "limit": self._limit, "orders": self._orders,
+            "cursor": self._cursor, "fields": self._fields,
+        }
+        options.update(changes)
+        return Query(self._client, self._path, **options)
+
+    def where(self, field_path, op_string, value):
+        return self._copy(filters=self._filters + [(field_path, op_string, value)])
+
+    def limit(self, count):
+        return self._copy(limit=count)
+
+    def order_by(self, field_path, direction="ASCENDING"):
+        return self._copy(orders=self._orders + [(field_path, direction == "DESCENDING")])
+
+    # Only document snapshots are supported as cursors
+    def start_after(self, document):
+        return self._copy(cursor=document)
+
+    def select(self, field_paths):
+        return self._copy(fields=list(field_paths))
+
+    def _matches(self, data):
+        for field_path, op_string, value in self._filters:
+            try:
+                field_value = _get_path(data, field_path)
+            except KeyError:
+                return False
+            if not _OPERATORS[op_string](field_value, value):
+                return False
+        return True
+
+    # Function to sort documents like Firestore: by the ordered fields, then by path
+    def _sort(self, snapshots):
+        def field(data, field_path):
+            try:
+                return _get_path(data, field_path)
+            except KeyError:
+                return None
+
+        for field_path, descending in reversed(self._orders):
+            snapshots.sort(key=lambda snapshot: field(snapshot._data, field_path), reverse=descending)
+        if self._cursor is not None:
+            keys = [
+                tuple(field(snapshot._data, field_path) for field_path, _ in self._orders) + (snapshot.reference.path,)
+                for snapshot in snapshots
+            ]
+            cursor = tuple(field(self._cursor._data, field_path) for field_path, _ in self._orders)
+            cursor += (self._cursor.reference.path,)
+            snapshots = [snapshot for snapshot, key in zip(snapshots, keys) if key > cursor]
+        return snapshots
+
+    def stream(self, transaction=None):
+        return iter(self._client._query(self))
+
+
+class CollectionReference(Query):
+    def __init__(self, client, path):
+        super().__init__(client, path)
+        self.id = path.rsplit("/", 1)[-1]
+
+    def document(self, document_id=None):
+        return DocumentReference(self._client, f"{self._path}/{document_id or uuid.uuid4().hex[:20]}")
+
+
+class WriteBatch:
+    def __init__(self, client):
+        self._client = client
+        self._writes = []
+
+    def set(self, reference, data, merge=False):
+        self._writes.append(("set", reference, data, merge))
+
+    def update(self, reference, data):
+        self._writes.append(("update", reference, data, False))
+
+    def delete(self, reference):
+        self._writes.append(("delete", reference, None, False))
+
+    def commit(self):
+        writes, self._writes = self._writes, []
+        self._client._commit(writes)
+
+
+class Transaction(WriteBatch):
+    pass
+
+
+# Writes are committed on flush, in batches like Firestore's BulkWriter
+class BulkWriter(WriteBatch):
+    def create(self, reference, data):
+        self._writes.append(("set", reference, data, False))
+
+    def flush(self):
+        writes, self._writes = self._writes, []
+        for i in range(0, len(writes), 20):
+            self._client._commit(writes[i:i + 20])
+
+    def close(self):
+        self.flush()
+
+
+# Runs the function and commits its writes while holding the database lock, so
+# transactions are serializable just like Firestore's
+def transactional(func):
+    def wrapper(transaction, *args, **kwargs):
+        with transaction._client._lock:
+            result = func(transaction, *args, **kwargs)
+            transaction.commit()
+            return result
+
+    return wrapper
+
+
+# In-memory Firestore with the subset of the client API the services use. Counts
+# document reads and writes the way Firestore bills them.
+class FakeFirestore:
+    def __init__(self):
+        self._documents = {}
+        self._lock = threading.RLock()
+        self.reads = 0
+        self.writes = 0
+
+    def collection(self, name):
+        return CollectionReference(self, name)
+
+    def document(self, path):
+        return DocumentReference(self, path)
+
+    def batch(self):
+        return WriteBatch(self)
+
+    def transaction(self):
+        return Transaction(self)
+
+    def bulk_writer(self):
+        return BulkWriter(self)
+
+    def get_all(self, references, transaction=None):
+        return [reference.get() for reference in references]
+
+    def _get(self, reference):
+        with self._lock:
+            self.reads += 1
+            return DocumentSnapshot(reference, copy.deepcopy(self._documents.get(reference.path)))
+
+    def _query(self, query):
+        prefix = query._path + "/"
+        with self._lock:
+            results = [
+                DocumentSnapshot(DocumentReference(self, path), copy.deepcopy(data))
+                for path, data in sorted(self._documents.items())
+                if path.startswith(prefix) and "/" not in path[len(prefix):] and query._matches(data)
+            ]
+            results = query._sort(results)
+            if query._limit is not None:
+                results = results[:query._limit]
+            if query._fields is not None:
+                results = [
+                    DocumentSnapshot(result.reference, {
+                        field_path: result._data[field_path] for field_path in query._fields if field_path in result._data
+                    })
+                    for result in results
+                ]
+            # An empty result is still billed as one read
+            self.reads += max(len(results), 1)
+            return results
+
+    # Function to apply the writes of a commit atomically. Commits over Firestore's
+    # limits are rejected as a whole, like Firestore does.
+    def _commit(self, writes):
+        if len(writes) > MAX_WRITES_PER_COMMIT:
+            raise InvalidArgument(f"A commit can contain at most {MAX_WRITES_PER_COMMIT} writes, got {len(writes)}")
+
+        with self._lock:
+            staged = {}  # path -> the document after the writes, None once deleted
+            for operation, reference, data, merge in writes:
+                path = reference.path
+                if path not in staged:
+                    staged[path] = copy.deepcopy(self._documents.get(path))
+                document = staged[path]
+                if operation == "delete":
+                    staged[path] = None
+                elif operation == "update":
+                    if document is None:
+                        raise NotFound(f"No document to update: {path}")
+                    for field_path, value in data.items():
+                        _set_path(document, field_path, value)
+                elif merge and document is not None:
+                    _merge(document, data)
+                else:
+                    document = {}
+                    _merge(document, data)
+                    staged[path] = document
+
+            for path, document in staged.items():
+                if document is not None and _document_size(path, document) > MAX_DOCUMENT_BYTES:
+                    raise InvalidArgument(f"Document {path} exceeds the maximum size of {MAX_DOCUMENT_BYTES} bytes")
+
+            for path, document in staged.items():
+                if document is None:
+                    self._documents.pop(path, None)
+                else:
+                    self._documents[path] = document
+            self.writes += len(writes)
+
+
+# In-memory Pub/Sub. Published messages are queued per topic until drained.
+class FakePubSub:
+    def __init__(self):
+        self._topics = {}
+        self._lock = threading.Lock()
+        self.published = 0
+
+    def publish(self, topic, data, **attributes):
+        with self._lock:
+            self._topics.setdefault(topic, []).append({"data": data, "attributes": attributes})
+            self.published += 1
+        future = Future()
+        future.set_result(str(self.published))
+        return future
+
+    def drain(self, topic):
+        with self._lock:
+            return self._topics.pop(topic, [])
+
+
+class FakePublisherClient:
+    def __init__(self, batch_settings=None, **kwargs):
+        self._pubsub = pubsub
+
+    @staticmethod
+    def topic_path(project, topic):
+        return f"projects/{project}/topics/{topic}"
+
+    def publish(self, topic, data, **attributes):
+        return self._pubsub.publish(topic, data, **attributes)
+
+
+class FakeSecretManagerServiceClient:
+    secrets = {}
+
+    def access_secret_version(self, request):
+        secret_name = request["name"].split("/")[3]
+        payload = types.SimpleNamespace(data=self.secrets.get(secret_name, "").encode("UTF-8"))
+        return types.SimpleNamespace(payload=payload)
+
+
+# Process-wide fakes, shared by every service loaded into the benchmark
+firestore_db = FakeFirestore()
+pubsub = FakePubSub()
+
+
+# Function to replace the Google Cloud client libraries with the in-process fakes.
+# With cloud=False only Secret Manager is faked, for running against the emulators.
+# Must run before any service module is imported.
+def install(secrets=None, cloud=True):
+    FakeSecretManagerServiceClient.secrets = dict(secrets or {})
+
+    firestore_module = types.ModuleType("google.cloud.firestore")
+    firestore_module.Client = lambda *args, **kwargs: firestore_db
+    firestore_module.ArrayUnion = ArrayUnion
+    firestore_module.ArrayRemove = ArrayRemove
+    firestore_module.Increment = Increment
+    firestore_module.SERVER_TIMESTAMP = SERVER_TIMESTAMP
+    firestore_module.DELETE_FIELD = DELETE_FIELD
+    firestore_module.transactional = transactional
+
+    firestore_v1_module = types.ModuleType("google.cloud.firestore_v1")
+    field_path_module = types.ModuleType("google.cloud.firestore_v1.field_path")
+    field_path_module.FieldPath = FieldPath
+    firestore_v1_module.field_path = field_path_module
+
+    pubsub_module = types.ModuleType("google.cloud.pubsub_v1")
+    pubsub_module.PublisherClient = FakePublisherClient
+    pubsub_module.types = types.SimpleNamespace(BatchSettings=lambda **kwargs: kwargs)
+
+    secretmanager_module = types.ModuleType("google.cloud.secretmanager")
+    secretmanager_module.SecretManagerServiceClient = FakeSecretManagerServiceClient
+
+    try:
+        import google.cloud as google_cloud
+    except ImportError:
+        google_module = sys.modules.setdefault("google", types.ModuleType("google"))
+        google_cloud = types.ModuleType("google.cloud")
+        google_module.cloud = google_cloud
+        sys.modules["google.cloud"] = google_cloud
+
+    modules = [("secretmanager", secretmanager_module)]
+    if cloud:
+        modules += [("firestore", firestore_module), ("firestore_v1", firestore_v1_module), ("pubsub_v1", pubsub_module)]
+
+    for name, module in modules:
+        sys.modules[f"google.cloud.{name}"] = module
+        setattr(google_cloud, name, module)
+    if cloud:
+        sys.modules["google.cloud.firestore_v1.field_path"] = field_path_module
+
+
+# Stand-in for telegram.Bot. Sleeps to simulate API latency and answers a share of
+# sends with 429 like Telegram's flood control.
+class StubBot:
+    username = "benchmark_bot"
+    defaults = None
+
+    def __init__(self, latency=0.0, retry_after_rate=0.0, retry_after=0.01):
+        self.latency = latency
+        self.retry_after_rate = retry_after_rate
+        self.retry_after = retry_after
+        self.sent = 0
+        self.rate_limited = 0
+        self._lock = threading.Lock()
+
+    def send_message(self, chat_id, text, **kwargs):
+        if self.latency:
+            time.sleep(self.latency)
+        if self.retry_after_rate and random.random() < self.retry_after_rate:
+            from telegram.error import RetryAfter
+
+            with self._lock:
+                self.rate_limited += 1
+            raise RetryAfter(self.retry_after)
+        with self._lock:
+            self.sent += 1
+
+
+class _StubResponse:
+    def __init__(self, payload):
+        self._payload = payload
+
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return self._payload
+
+
+# Stand-in for the requests.Session used to call the Snapshot GraphQL API. Answers
+# aliased proposal queries from a dict of generated proposals.
+class StubSnapshotSession:
+    def __init__(self, proposals, latency=0.0):
+        self.proposals = proposals
+        self.latency = latency
+        self.requests = 0
+
+    def post(self, url, json=None, timeout=None):
+        if self.latency:
+            time.sleep(self.latency)
+        self.requests += 1
+        variables = json["variables"]
+        aliases = re.findall(r"(p\d+): proposal\(id: \$(id\d+)\)", json["query"])
+        return _StubResponse({
+            "data": {alias: self.proposals.get(variables[variable]) for alias, variable in aliases}
+        })
+
+
+# Stand-in for the openai module
+class StubOpenAI:
+    api_key = None
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.requests = 0
+        self.Completion = self
+
+    def create(self, prompt, **kwargs):
+        if self.latency:
+            time.sleep(self.latency)
+        self.requests += 1
+        words = prompt.split("\n\n", 1)[-1].split()
+        text = " ".join(words[:100])
+        usage = {"prompt_tokens": len(prompt.split()), "completion_tokens": len(words[:100])}
+        usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+        return types.SimpleNamespace(choices=[types.SimpleNamespace(text=text)], usage=usage)
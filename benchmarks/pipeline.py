@@ -0,0 +1,397 @@
+import argparse
+import base64
+import bisect
+import datetime
+import importlib.util
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+import types
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+from benchmarks import fakes  # noqa: E402
+
+WEBHOOK_SECRET = "benchmark-secret"
+MATCHED_EVENTS_TOPIC = "projects/telegram-governance-bot/topics/matched-events-topic"
+PENDING_EVENTS_TOPIC = "projects/telegram-governance-bot/topics/snapshot-webhook-events"
+
+KEYWORDS = [
+    "treasury", "grant", "grants", "budget", "incentives", "liquidity", "emissions", "delegate",
+    "delegates", "council", "upgrade", "oracle", "bridge", "security", "audit", "funding",
+    "partnership", "listing", "collateral", "risk", "parameters", "fee", "fees", "staking",
+    "rewards", "buyback", "vesting", "airdrop", "migration", "deployment", "multisig", "election",
+]
+FILLER_WORDS = [
+    "the", "proposal", "community", "this", "will", "and", "to", "of", "for", "we", "in", "a",
+    "protocol", "dao", "vote", "token", "holders", "should", "be", "with", "on", "as", "by",
+    "support", "process", "period", "current", "new", "framework", "implementation", "team",
+]
+TICKER_MENTIONS = ["UNI", "AAVE", "$op", "ETH", "CRV", "$arb", "COMP", "LDO", "GRT", "ENS"]
+
+
+class ZipfSampler:
+    def __init__(self, items, exponent=1.1):
+        self.items = items
+        total = 0.0
+        self.cumulative = []
+        for rank in range(1, len(items) + 1):
+            total += 1.0 / rank ** exponent
+            self.cumulative.append(total)
+
+    def sample(self, rng):
+        return self.items[bisect.bisect_left(self.cumulative, rng.random() * self.cumulative[-1])]
+
+    def sample_many(self, rng, count):
+        return list(dict.fromkeys(self.sample(rng) for _ in range(count)))
+
+
+def load_service(directory, module_name):
+    service_path = os.path.join(REPO_ROOT, directory)
+    sys.path.insert(0, service_path)
+    spec = importlib.util.spec_from_file_location(module_name, os.path.join(service_path, "main.py"))
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[module_name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+# Function to generate a synthetic subscriber population: projects and keywords follow
+# a Zipf popularity, a tenth of the users follow tickers and some read digests
+def generate_users(rng, user_count, spaces):
+    space_sampler = ZipfSampler(spaces)
+    keyword_sampler = ZipfSampler(KEYWORDS)
+    for i in range(user_count):
+        user = {
+            "projects": space_sampler.sample_many(rng, rng.randint(1, 5)),
+            "keywords": keyword_sampler.sample_many(rng, rng.randint(1, 3)) if rng.random() < 0.3 else [],
+            "tickers": [],
+        }
+        if rng.random() < 0.1:
+            user["tickers"] = ["*"] if rng.random() < 0.3 else rng.sample(["UNI", "AAVE", "OP", "ETH", "CRV"], 2)
+        roll = rng.random()
+        if roll < 0.05:
+            user["delivery_mode"] = "hourly"
+        elif roll < 0.1:
+            user["delivery_mode"] = "daily"
+        yield str(100000000 + i), user
+
+
+def write_users(db, users):
+    batch = db.batch()
+    pending = 0
+    for user_id, user in users:
+        batch.set(db.collection("user_subscriptions").document(user_id), user)
+        pending += 1
+        if pending == 500:
+            batch.commit()
+            batch = db.batch()
+            pending = 0
+    if pending:
+        batch.commit()
+
+
+def generate_proposal(rng, index, spaces, body_words):
+    space_id = ZipfSampler(spaces).sample(rng) if rng.random() < 0.8 else rng.choice(spaces)
+    words = [rng.choice(FILLER_WORDS) for _ in range(max(body_words + rng.randint(-body_words // 2, body_words // 2), 1))]
+    for _ in range(rng.randint(0, 4)):
+        words.insert(rng.randrange(len(words)), rng.choice(KEYWORDS))
+    for _ in range(rng.randint(0, 2)):
+        words.insert(rng.randrange(len(words)), rng.choice(TICKER_MENTIONS))
+    now = int(time.time())
+    return {
+        "id": f"0x{index:064x}",
+        "title": f"[{space_id}] {' '.join(rng.choice(KEYWORDS + FILLER_WORDS) for _ in range(6))}",
+        "body": " ".join(words),
+        "choices": ["For", "Against", "Abstain"],
+        "start": now,
+        "end": now + 3 * 86400,
+        "snapshot": "17000000",
+        "state": "active",
+        "author": f"0x{rng.getrandbits(160):040x}",
+        "created": now,
+        "updated": None,
+        "scores": [],
+        "scores_by_strategy": [],
+        "scores_total": 0,
+        "scores_updated": 0,
+        "plugins": {},
+        "network": "1",
+        "strategies": [{"name": "erc20-balance-of", "network": "1", "params": {"symbol": "GOV", "decimals": 18}}],
+        "space": {"id": space_id, "name": space_id.split(".")[0].title()},
+    }
+
+
+# Function to encode a document in the Firestore wire format that Firestore triggers deliver
+def encode_value(value):
+    if value is None:
+        return {"nullValue": None}
+    if isinstance(value, bool):
+        return {"booleanValue": value}
+    if isinstance(value, int):
+        return {"integerValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    if isinstance(value, str):
+        return {"stringValue": value}
+    if isinstance(value, datetime.datetime):
+        return {"timestampValue": value.isoformat()}
+    if isinstance(value, dict):
+        return {"mapValue": {"fields": {key: encode_value(item) for key, item in value.items()}}}
+    if isinstance(value, (list, tuple)):
+        return {"arrayValue": {"values": [encode_value(item) for item in value]}}
+    return {"stringValue": str(value)}
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(int(fraction * len(ordered)), len(ordered) - 1)]
+
+
+def summarize(durations):
+    return {
+        "count": len(durations),
+        "p50_ms": round(percentile(durations, 0.5) * 1000, 3) if durations else None,
+        "p99_ms": round(percentile(durations, 0.99) * 1000, 3) if durations else None,
+        "mean_ms": round(sum(durations) / len(durations) * 1000, 3) if durations else None,
+    }
+
+
+def git_revision():
+    try:
+        revision = subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_ROOT, text=True).strip()
+        dirty = subprocess.call(["git", "diff", "--quiet", "HEAD"], cwd=REPO_ROOT) != 0
+        return revision + ("-dirty" if dirty else "")
+    except Exception:
+        return None
+
+
+# Pub/Sub topics drained from the emulator with a pull subscription per topic
+class EmulatorPubSub:
+    def __init__(self, project):
+        from google.cloud import pubsub_v1
+
+        self.publisher = pubsub_v1.PublisherClient()
+        self.subscriber = pubsub_v1.SubscriberClient()
+        self.subscriptions = {}
+        for topic in (MATCHED_EVENTS_TOPIC, PENDING_EVENTS_TOPIC):
+            subscription = f"projects/{project}/subscriptions/benchmark-{topic.rsplit('/', 1)[-1]}"
+            try:
+                self.publisher.create_topic(request={"name": topic})
+            except Exception:
+                pass
+            try:
+                self.subscriber.create_subscription(request={"name": subscription, "topic": topic})
+            except Exception:
+                pass
+            self.subscriptions[topic] = subscription
+
+    def drain(self, topic):
+        messages = []
+        while True:
+            response = self.subscriber.pull(
+                request={"subscription": self.subscriptions[topic], "max_messages": 1000}, timeout=5
+            )
+            if not response.received_messages:
+                return messages
+            self.subscriber.acknowledge(request={
+                "subscription": self.subscriptions[topic],
+                "ack_ids": [message.ack_id for message in response.received_messages],
+            })
+            messages += [
+                {"data": message.message.data, "attributes": dict(message.message.attributes)}
+                for message in response.received_messages
+            ]
+
+
+def run(args):
+    rng = random.Random(args.seed)
+
+    # Measure the pipeline, not Telegram's limits, unless asked to. Per-span log lines
+    # would drown the results.
+    os.environ.setdefault("LOG_SPANS", "false")
+    os.environ.setdefault("TOKEN", "123456:benchmark")
+    os.environ["GLOBAL_MESSAGES_PER_SECOND"] = str(args.telegram_rate)
+    os.environ["PER_CHAT_INTERVAL_SECONDS"] = "0"
+    os.environ["USER_MESSAGES_PER_MINUTE"] = "0"
+    os.environ["WEBHOOK_FAST_ACK"] = "true" if args.fast_ack else "false"
+
+    secrets = {"SNAPSHOT_WEBHOOK_SECRET": WEBHOOK_SECRET, "OPENAI_API_KEY": "benchmark"}
+    if args.backend == "fake":
+        fakes.install(secrets)
+        pubsub = fakes.pubsub
+    else:
+        if not os.environ.get("FIRESTORE_EMULATOR_HOST") or not os.environ.get("PUBSUB_EMULATOR_HOST"):
+            sys.exit("The emulator backend needs FIRESTORE_EMULATOR_HOST and PUBSUB_EMULATOR_HOST")
+        os.environ.setdefault("GOOGLE_CLOUD_PROJECT", "telegram-governance-bot")
+        fakes.install(secrets, cloud=False)
+        pubsub = EmulatorPubSub(os.environ["GOOGLE_CLOUD_PROJECT"])
+
+    from common import clients, instrumentation, subscription_index
+
+    webhook_main = load_service("webhook-cloud-function", "webhook_main")
+    matcher_main = load_service("process-events-cloud-function", "matcher_main")
+    bot_main = load_service("telegram-bot-cloud-run", "bot_main")
+
+    db = clients.get_firestore_client()
+
+    # Stub external APIs
+    spaces = [f"space{i}.eth" for i in range(args.spaces)]
+    proposals = {}
+    snapshot_session = fakes.StubSnapshotSession(proposals, latency=args.snapshot_latency)
+    webhook_main.proposal_client.session = snapshot_session
+    stub_bot = fakes.StubBot(latency=args.telegram_latency, retry_after_rate=args.retry_after_rate)
+    bot_main.bot = stub_bot
+    stub_openai = fakes.StubOpenAI(latency=args.openai_latency)
+    clients._clients["openai"] = stub_openai
+
+    print(f"Generating {args.users} subscribers...", file=sys.stderr)
+    setup_started = time.perf_counter()
+    write_users(db, generate_users(rng, args.users, spaces))
+    subscription_index.rebuild_index(db)
+    setup_seconds = time.perf_counter() - setup_started
+
+    import flask
+
+    flask_app = flask.Flask("benchmark")
+    stages = {}
+    operations = {}
+    work_units = 0
+
+    # The fakes count their own operations, real clients are counted by the instrumentation
+    def count_operations():
+        if args.backend == "fake":
+            return db.reads, db.writes
+        totals = instrumentation.get_totals()
+        return totals.get(instrumentation.FIRESTORE_READS, 0), totals.get(instrumentation.FIRESTORE_WRITES, 0)
+
+    def timed(stage, func, *func_args):
+        reads, writes = count_operations()
+        started = time.perf_counter()
+        result = func(*func_args)
+        stages.setdefault(stage, []).append(time.perf_counter() - started)
+        after_reads, after_writes = count_operations()
+        counts = operations.setdefault(stage, {"reads": 0, "writes": 0})
+        counts["reads"] += after_reads - reads
+        counts["writes"] += after_writes - writes
+        return result
+
+    print(f"Running {args.events} proposals through the pipeline...", file=sys.stderr)
+    setup_totals = instrumentation.get_totals()
+    started = time.perf_counter()
+    def stored_fields(proposal_id):
+        if args.backend == "fake":
+            stored = fakes.firestore_db._documents.get(f"snapshot_events/{proposal_id}")
+        else:
+            snapshot = db.collection("snapshot_events").document(proposal_id).get()
+            stored = snapshot.to_dict() if snapshot.exists else None
+        return {key: encode_value(value) for key, value in stored.items()} if stored else None
+
+    # Later lifecycle events are timed separately, they reuse the first event's match
+    def run_event(proposal, event):
+        suffix = "" if event == "proposal/created" else "_lifecycle"
+        old_fields = stored_fields(proposal["id"])
+
+        request = types.SimpleNamespace(method="POST", data=json.dumps({
+            "id": f"proposal/{proposal['id']}",
+            "event": event,
+            "space": proposal["space"]["id"],
+            "expire": proposal["end"],
+            "secret": WEBHOOK_SECRET,
+        }))
+        with flask_app.test_request_context():
+            timed("webhook" + suffix, webhook_main.webhook, request)
+
+        for message in pubsub.drain(PENDING_EVENTS_TOPIC):
+            cloud_event = types.SimpleNamespace(data={"message": {
+                "data": base64.b64encode(message["data"]).decode(),
+                "attributes": message["attributes"],
+            }})
+            timed("enrich" + suffix, webhook_main.enrich_snapshot_event, cloud_event)
+
+        # The Firestore trigger delivers the stored document; reading it isn't part of the function
+        trigger_data = {"value": {"fields": stored_fields(proposal["id"])}}
+        if old_fields:
+            trigger_data["oldValue"] = {"fields": old_fields}
+        timed("match" + suffix, matcher_main.monitor_snapshot_events, trigger_data, None)
+
+        delivered = 0
+        for message in pubsub.drain(MATCHED_EVENTS_TOPIC):
+            envelope = {"message": {"data": base64.b64encode(message["data"]).decode()}}
+            timed("deliver" + suffix, bot_main.handle_pubsub_envelope, envelope)
+            delivered += 1
+        return delivered
+
+    event_types = ["proposal/created"] + (["proposal/start", "proposal/end"] if args.lifecycle else [])
+    event_count = 0
+    for index in range(args.events):
+        proposal = generate_proposal(rng, index, spaces, args.body_words)
+        proposals[proposal["id"]] = proposal
+        for event in event_types:
+            work_units += run_event(proposal, event)
+            event_count += 1
+    elapsed = time.perf_counter() - started
+
+    totals = instrumentation.get_totals()
+    counters = {name: value - setup_totals.get(name, 0) for name, value in totals.items()}
+    results = {
+        "revision": git_revision(),
+        "config": vars(args),
+        "setup_seconds": round(setup_seconds, 3),
+        "elapsed_seconds": round(elapsed, 3),
+        "events": event_count,
+        "events_per_second": round(event_count / elapsed, 3),
+        "stages": {stage: summarize(durations) for stage, durations in stages.items()},
+        "firestore_per_event": {
+            stage: {
+                "reads": round(counts["reads"] / len(stages[stage]), 2),
+                "writes": round(counts["writes"] / len(stages[stage]), 2),
+            }
+            for stage, counts in operations.items()
+        },
+        "work_units": work_units,
+        "telegram": {"messages": stub_bot.sent, "rate_limited": stub_bot.rate_limited},
+        "counters": counters,
+        "snapshot_requests": snapshot_session.requests,
+        "openai_requests": stub_openai.requests,
+    }
+
+    output = json.dumps(results, indent=2, default=str)
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    print(output)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Drive webhook -> monitor_snapshot_events -> /pubsub end to end and report throughput."
+    )
+    parser.add_argument("--backend", choices=["fake", "emulator"], default="fake",
+                        help="in-process fakes, or the Firestore and Pub/Sub emulators")
+    parser.add_argument("--users", type=int, default=10000, help="synthetic subscribers")
+    parser.add_argument("--spaces", type=int, default=500, help="distinct Snapshot spaces")
+    parser.add_argument("--events", type=int, default=200, help="proposals to run through the pipeline")
+    parser.add_argument("--body-words", type=int, default=400, help="average proposal body length")
+    parser.add_argument("--seed", type=int, default=1, help="random seed, keep it fixed to compare commits")
+    parser.add_argument("--fast-ack", action="store_true", help="run the webhook in fast-ack mode")
+    parser.add_argument("--lifecycle", action="store_true",
+                        help="follow every proposal with start and end events")
+    parser.add_argument("--telegram-latency", type=float, default=0.0, help="seconds per stubbed send")
+    parser.add_argument("--telegram-rate", type=float, default=1000000, help="delivery engine messages/second")
+    parser.add_argument("--retry-after-rate", type=float, default=0.0, help="share of sends answered with 429")
+    parser.add_argument("--snapshot-latency", type=float, default=0.0, help="seconds per stubbed GraphQL request")
+    parser.add_argument("--openai-latency", type=float, default=0.0, help="seconds per stubbed completion")
+    parser.add_argument("--output", help="also write the JSON results to this file")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    run(parse_args())
@@ -0,0 +1,230 @@
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Entry point scenarios: the service directory and the request that wakes it up
+SCENARIOS = {
+    "webhook": "webhook-cloud-function",
+    "process-events": "process-events-cloud-function",
+    "bot-delivery": "telegram-bot-cloud-run",
+    "bot-command": "telegram-bot-cloud-run",
+}
+
+ENVIRONMENT = {
+    "TOKEN": "123456:benchmark",
+    "GLOBAL_MESSAGES_PER_SECOND": "1000000",
+    "PER_CHAT_INTERVAL_SECONDS": "0",
+    "LOG_SPANS": "false",
+}
+
+
+# Function to measure the import of a service's main module with the real client
+# libraries, as the platform does on a cold start. Nothing is imported before it.
+def measure_import(scenario):
+    service_path = os.path.join(REPO_ROOT, SCENARIOS[scenario])
+    sys.path[:0] = [service_path, REPO_ROOT]
+    started = time.perf_counter()
+    __import__("main")
+    return {"cold_import_ms": (time.perf_counter() - started) * 1000}
+
+
+# Function to prepare the service and return a callable sending it one request.
+# Each call handles a new event, so warm calls don't hit the per-proposal caches.
+def prepare_request(scenario, module, db):
+    import base64
+    import random
+
+    from benchmarks import fakes, pipeline
+    from common import clients, delivery_state, subscription_index
+
+    rng = random.Random(1)
+    spaces = [f"space{i}.eth" for i in range(20)]
+    counter = iter(range(1000))
+
+    if scenario == "webhook":
+        proposals = {}
+        module.proposal_client.session = fakes.StubSnapshotSession(proposals)
+
+        def request():
+            proposal = pipeline.generate_proposal(rng, next(counter), spaces, 400)
+            proposals[proposal["id"]] = proposal
+            return module.webhook(_Request(json.dumps({
+                "id": f"proposal/{proposal['id']}",
+                "event": "proposal/created",
+                "space": proposal["space"]["id"],
+                "expire": proposal["end"],
+                "secret": pipeline.WEBHOOK_SECRET,
+            })))
+
+        import flask
+
+        app = flask.Flask("benchmark")
+
+        def request_in_context():
+            with app.test_request_context():
+                return request()
+
+        return request_in_context
+
+    if scenario == "process-events":
+        pipeline.write_users(db, pipeline.generate_users(rng, 1000, spaces))
+        subscription_index.rebuild_index(db)
+
+        def request():
+            proposal = pipeline.generate_proposal(rng, next(counter), spaces, 400)
+            fields = {key: pipeline.encode_value(value) for key, value in proposal.items()}
+            return module.monitor_snapshot_events({"value": {"fields": fields}}, None)
+
+        return request
+
+    module.bot = fakes.StubBot()
+    clients._clients["openai"] = fakes.StubOpenAI()
+
+    if scenario == "bot-delivery":
+        from common.proposal import Proposal
+
+        def request():
+            proposal_data = pipeline.generate_proposal(rng, next(counter), spaces, 400)
+            db.collection("snapshot_events").document(proposal_data["id"]).set(proposal_data)
+            proposal = Proposal(
+                id=proposal_data["id"],
+                space_id=proposal_data["space"]["id"],
+                space_name=proposal_data["space"]["name"],
+                title=proposal_data["title"],
+                body=proposal_data["body"],
+                start=proposal_data["start"],
+                end=proposal_data["end"],
+                choices=proposal_data["choices"],
+                event="proposal/created",
+            )
+            event_ref = db.collection(delivery_state.MATCHED_EVENTS_COLLECTION).document()
+            delivery_state.write_matched_event(
+                db, event_ref, {"proposal": proposal.to_projection()}, [str(100000000 + i) for i in range(50)]
+            )
+            work_unit = delivery_state.get_work_units(event_ref, 0)[0]
+            envelope = {"message": {"data": base64.b64encode(json.dumps(work_unit).encode("utf-8")).decode()}}
+            return module.handle_pubsub_envelope(envelope)
+
+        return request
+
+    from telegram import Update
+
+    def request():
+        update_id = next(counter)
+        payload = {
+            "update_id": update_id,
+            "message": {
+                "message_id": update_id,
+                "date": int(time.time()),
+                "chat": {"id": 100000000, "type": "private"},
+                "from": {"id": 100000000, "is_bot": False, "first_name": "Benchmark"},
+                "text": "/list_subscriptions",
+                "entities": [{"type": "bot_command", "offset": 0, "length": 19}],
+            },
+        }
+        return module.get_dispatcher().process_update(Update.de_json(payload, module.bot))
+
+    return request
+
+
+# Function to measure the first and a warm request of a service, against the
+# in-process fakes or the emulators
+def measure_requests(scenario, backend):
+    sys.path[:0] = [os.path.join(REPO_ROOT, SCENARIOS[scenario]), REPO_ROOT]
+    from benchmarks import fakes, pipeline
+
+    secrets = {"SNAPSHOT_WEBHOOK_SECRET": pipeline.WEBHOOK_SECRET, "OPENAI_API_KEY": "benchmark"}
+    fakes.install(secrets, cloud=backend == "fake")
+
+    module = __import__("main")
+
+    from common import clients
+
+    # Setup goes through the bare fake, so it doesn't create the service's clients early
+    db = fakes.firestore_db if backend == "fake" else clients.get_firestore_client()
+    request = prepare_request(scenario, module, db)
+
+    timings = []
+    for _ in range(2):
+        started = time.perf_counter()
+        request()
+        timings.append((time.perf_counter() - started) * 1000)
+
+    return {"first_request_ms": timings[0], "warm_request_ms": timings[1]}
+
+
+def run_child(scenario, mode, backend):
+    environment = dict(os.environ, **ENVIRONMENT)
+    output = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), "--child", scenario, "--mode", mode, "--backend", backend],
+        cwd=REPO_ROOT,
+        env=environment,
+        capture_output=True,
+        text=True,
+    )
+    if output.returncode != 0:
+        raise RuntimeError(f"{scenario} {mode} failed:\n{output.stderr}")
+    return json.loads(output.stdout.strip().splitlines()[-1])
+
+
+def run(args):
+    from benchmarks.pipeline import git_revision
+
+    results = {}
+    for scenario in args.scenarios:
+        print(f"Measuring {scenario}...", file=sys.stderr)
+        samples = {}
+        for _ in range(args.runs):
+            for mode in ("import", "requests"):
+                for name, value in run_child(scenario, mode, args.backend).items():
+                    samples.setdefault(name, []).append(value)
+        results[scenario] = {name: round(statistics.median(values), 1) for name, values in samples.items()}
+
+    config = {"backend": args.backend, "runs": args.runs}
+    output = json.dumps({"revision": git_revision(), "config": config, "scenarios": results}, indent=2)
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    print(output)
+
+
+class _Request:
+    method = "POST"
+
+    def __init__(self, data):
+        self.data = data
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Measure cold import and first-request latency of each entry point in fresh interpreters."
+    )
+    parser.add_argument("--backend", choices=["fake", "emulator"], default="fake",
+                        help="in-process fakes, or the Firestore and Pub/Sub emulators, for the requests")
+    parser.add_argument("--scenarios", nargs="+", choices=list(SCENARIOS), default=list(SCENARIOS))
+    parser.add_argument("--runs", type=int, default=5, help="fresh interpreters per measurement, the median is reported")
+    parser.add_argument("--output", help="also write the JSON results to this file")
+    parser.add_argument("--child", choices=list(SCENARIOS), help=argparse.SUPPRESS)
+    parser.add_argument("--mode", choices=["import", "requests"], help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.child:
+        if args.mode == "import":
+            result = measure_import(args.child)
+        else:
+            result = measure_requests(args.child, args.backend)
+        # The last line of the child's output is its result
+        print(json.dumps(result))
+    else:
+        sys.path.insert(0, REPO_ROOT)
+        run(args)
@@ -0,0 +1,136 @@
+import os
+import threading
+import time
+
+# GCP project id
+PROJECT_ID = "telegram-governance-bot"
+
+# Cached secrets are refreshed in the background once they are this old...
+SECRET_REFRESH_SECONDS = int(os.environ.get("SECRET_REFRESH_SECONDS", "300"))
+# ...and fetched synchronously once they are this old
+SECRET_TTL_SECONDS = int(os.environ.get("SECRET_TTL_SECONDS", "900"))
+# Forced refreshes (e.g. after a rotation) of the same secret are limited to one per interval
+SECRET_FORCE_REFRESH_INTERVAL_SECONDS = int(os.environ.get("SECRET_FORCE_REFRESH_INTERVAL_SECONDS", "30"))
+
+# Process-wide clients, created on first use and shared by every request
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def _get_client(name, factory):
+    client = _clients.get(name)
+    if client is None:
+        with _clients_lock:
+            client = _clients.get(name)
+            if client is None:
+                client = factory()
+                _clients[name] = client
+    return client
+
+
+def get_firestore_client():
+    def factory():
+        from google.cloud import firestore
+        from common.instrumentation import instrument_firestore
+        return instrument_firestore(firestore.Client())
+
+    return _get_client("firestore", factory)
+
+
+def get_publisher_client():
+    def factory():
+        from google.cloud import pubsub_v1
+        return pubsub_v1.PublisherClient()
+
+    return _get_client("publisher", factory)
+
+
+# Publisher for fan-outs that publish many small messages at once. Messages are
+# batched, at the cost of up to 50 ms of latency per message.
+def get_batch_publisher_client():
+    def factory():
+        from google.cloud import pubsub_v1
+        return pubsub_v1.PublisherClient(
+            batch_settings=pubsub_v1.types.BatchSettings(max_messages=100, max_latency=0.05)
+        )
+
+    return _get_client("batch_publisher", factory)
+
+
+def get_secret_manager_client():
+    def factory():
+        from google.cloud import secretmanager
+        return secretmanager.SecretManagerServiceClient()
+
+    return _get_client("secretmanager", factory)
+
+
+def get_openai_client():
+    def factory():
+        import openai
+        return openai
+
+    client = _get_client("openai", factory)
+    # The key is cached by the secret store, so this picks up rotations for free
+    client.api_key = get_secret_value("OPENAI_API_KEY")
+    return client
+
+
+# TTL cache in front of Secret Manager
+class SecretStore:
+    def __init__(self, refresh_after=SECRET_REFRESH_SECONDS, ttl=SECRET_TTL_SECONDS):
+        self.refresh_after = refresh_after
+        self.ttl = ttl
+        self._values = {}  # (name, version) -> (value, fetched_at)
+        self._last_forced = {}  # (name, version) -> time of the last forced refresh
+        self._refreshing = set()
+        self._lock = threading.Lock()
+
+    def _fetch(self, key):
+        secret_name, version_id = key
+        name = f"projects/{PROJECT_ID}/secrets/{secret_name}/versions/{version_id}"
+        response = get_secret_manager_client().access_secret_version(request={"name": name})
+        value = response.payload.data.decode("UTF-8")
+        with self._lock:
+            self._values[key] = (value, time.monotonic())
+        return value
+
+    def _refresh_in_background(self, key):
+        try:
+            self._fetch(key)
+        except Exception as e:
+            print(f"Failed to refresh secret {key[0]}: {e}")
+        finally:
+            with self._lock:
+                self._refreshing.discard(key)
+
+    # Function to get a secret. force_refresh skips the cache, e.g. when a value
+    # stopped working because the secret was rotated.
+    def get(self, secret_name, version_id="latest", force_refresh=False):
+        key = (secret_name, version_id)
+        now = time.monotonic()
+
+        with self._lock:
+            entry = self._values.get(key)
+            if force_refresh and now - self._last_forced.get(key, float("-inf")) >= SECRET_FORCE_REFRESH_INTERVAL_SECONDS:
+                self._last_forced[key] = now
+                entry = None
+
+            if entry is not None:
+                value, fetched_at = entry
+                age = now - fetched_at
+                if age < self.ttl:
+                    # Serve the cached value, refreshing it ahead of expiry
+                    if age >= self.refresh_after and key not in self._refreshing:
+                        self._refreshing.add(key)
+                        threading.Thread(target=self._refresh_in_background, args=(key,), daemon=True).start()
+                    return value
+
+        return self._fetch(key)
+
+
+secret_store = SecretStore()
+
+
+def get_secret_value(secret_name, version_id="latest", force_refresh=False):
+    return secret_store.get(secret_name, version_id, force_refresh)
@@ -0,0 +1,205 @@
+import datetime
+import hashlib
+import math
+import os
+import socket
+import threading
+import time
+import uuid
+
+from google.cloud import firestore
+from google.cloud.firestore_v1.field_path import FieldPath
+
+MATCHED_EVENTS_COLLECTION = "matched_events"
+DELIVERIES_SUBCOLLECTION = "deliveries"
+
+# Above this many recipients the delivery state is split across documents in the
+# event's `deliveries` subcollection instead of a single `matched_users` map. This
+# keeps documents well within Firestore's field and size limits, and each shard is
+# delivered as its own Pub/Sub work unit.
+MAX_RECIPIENTS_PER_DOCUMENT = int(os.environ.get("MAX_RECIPIENTS_PER_DOCUMENT", "1000"))
+
+# Acknowledgements are written once this many are buffered or this long after the last write
+ACK_FLUSH_SIZE = int(os.environ.get("ACK_FLUSH_SIZE", "500"))
+ACK_FLUSH_INTERVAL_SECONDS = float(os.environ.get("ACK_FLUSH_INTERVAL_SECONDS", "1"))
+
+# Ack deadline of the bot's push subscription on the matched events topic. Pub/Sub
+# redelivers a work unit once it passes, so deliveries and leases are sized from it.
+# Must match the subscription's --ack-deadline (600, the push maximum, by default).
+PUBSUB_ACK_DEADLINE_SECONDS = int(os.environ.get("PUBSUB_ACK_DEADLINE_SECONDS", "600"))
+
+# How long a claim on a batch of recipients lasts. Has to outlive the delivery
+# deadline, so a crashed instance's recipients become claimable again afterwards.
+LEASE_SECONDS = int(os.environ.get("DELIVERY_LEASE_SECONDS", str(PUBSUB_ACK_DEADLINE_SECONDS)))
+
+# Firestore batches are limited to 500 writes
+MAX_BATCH_WRITES = 500
+
+
+# Function to get the number of delivery shards for a fan-out (0 keeps it inline)
+def get_shard_count(recipient_count):
+    if recipient_count <= MAX_RECIPIENTS_PER_DOCUMENT:
+        return 0
+    # Leave headroom, users are spread by hash and not evenly
+    return math.ceil(recipient_count / (MAX_RECIPIENTS_PER_DOCUMENT * 0.8))
+
+
+def get_user_shard(user_id, shard_count):
+    return int(hashlib.md5(user_id.encode("utf-8")).hexdigest(), 16) % shard_count
+
+
+# Function to get the document holding a user's delivery status
+def get_recipient_doc_ref(event_ref, user_id, shard_count):
+    if not shard_count:
+        return event_ref
+    return get_shard_doc_ref(event_ref, get_user_shard(user_id, shard_count))
+
+
+def get_shard_doc_ref(event_ref, shard):
+    return event_ref.collection(DELIVERIES_SUBCOLLECTION).document(str(shard))
+
+
+# Function to get every document holding delivery status for an event
+def get_recipient_doc_refs(event_ref, shard_count):
+    if not shard_count:
+        return [event_ref]
+    return [get_shard_doc_ref(event_ref, shard) for shard in range(shard_count)]
+
+
+def delivered_field(user_id):
+    return FieldPath("matched_users", user_id).to_api_repr()
+
+
+# Function to get the writes storing a matched event along with the delivery status of
+# every matched user: the shard count and (document, fields) pairs, the event first
+def get_matched_event_writes(event_ref, event_fields, matched_users):
+    shard_count = get_shard_count(len(matched_users))
+
+    if not shard_count:
+        return shard_count, [(event_ref, {
+            **event_fields,
+            "matched_users": {user_id: False for user_id in matched_users},
+            "delivery_shards": 0,
+        })]
+
+    shards = [{} for _ in range(shard_count)]
+    for user_id in matched_users:
+        shards[get_user_shard(user_id, shard_count)][user_id] = False
+
+    writes = [(event_ref, {**event_fields, "delivery_shards": shard_count, "recipient_count": len(matched_users)})]
+    writes += [(get_shard_doc_ref(event_ref, shard), {"matched_users": shards[shard]}) for shard in range(shard_count)]
+    return shard_count, writes
+
+
+# Function to store a matched event along with the delivery status of every matched user
+def write_matched_event(db, event_ref, event_fields, matched_users):
+    shard_count, writes = get_matched_event_writes(event_ref, event_fields, matched_users)
+
+    event_ref.set(writes[0][1])
+
+    # Keep each commit well below the request size limit
+    for i in range(1, len(writes), 100):
+        batch = db.batch()
+        for doc_ref, fields in writes[i:i + 100]:
+            batch.set(doc_ref, fields)
+        batch.commit()
+
+    return shard_count
+
+
+# Function to get the Pub/Sub work units for a matched event, one per delivery status
+# document. Each only references the stored event, so message size doesn't grow
+# with the number of recipients.
+def get_work_units(event_ref, shard_count):
+    if not shard_count:
+        return [{"id": event_ref.id, "delivery_shards": 0}]
+    return [{"id": event_ref.id, "delivery_shards": shard_count, "shard": shard} for shard in range(shard_count)]
+
+
+# Function to get a unique owner id for one delivery attempt
+def new_lease_owner():
+    return f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+
+
+@firestore.transactional
+def _claim_recipients(transaction, doc_ref, owner, lease_seconds):
+    snapshot = doc_ref.get(transaction=transaction)
+    if not snapshot.exists:
+        return []
+
+    data = snapshot.to_dict()
+    now = datetime.datetime.now(datetime.timezone.utc)
+    lease_expires = data.get("lease_expires")
+    if data.get("lease_owner") not in (None, owner) and lease_expires is not None and lease_expires > now:
+        return None
+
+    pending = [user_id for user_id, sent in data.get("matched_users", {}).items() if not sent]
+    if pending:
+        transaction.update(doc_ref, {
+            "lease_owner": owner,
+            "lease_expires": now + datetime.timedelta(seconds=lease_seconds),
+        })
+    return pending
+
+
+# Function to claim the pending recipients of a delivery status document. Returns
+# None if another delivery attempt currently holds the claim.
+def claim_recipients(db, doc_ref, owner, lease_seconds=LEASE_SECONDS):
+    return _claim_recipients(db.transaction(), doc_ref, owner, lease_seconds)
+
+
+# Function to give up a claim once its recipients have been handled
+def release_recipients(doc_ref, owner):
+    try:
+        doc_ref.update({"lease_owner": None, "lease_expires": None})
+    except Exception as e:
+        # The lease expires on its own
+        print(f"Failed to release delivery lease {owner} on {doc_ref.path}: {e}")
+
+
+# Buffers delivery acknowledgements and writes them in batches. Acks for the same
+# document are merged into a single update, so a flush costs one write per shard
+# document rather than one per recipient.
+class DeliveryAckBuffer:
+    def __init__(self, db, event_ref, shard_count):
+        self.db = db
+        self.event_ref = event_ref
+        self.shard_count = shard_count
+        self._pending = []
+        self._last_flush = time.monotonic()
+        self._lock = threading.Lock()
+
+    def ack(self, user_id):
+        with self._lock:
+            self._pending.append(user_id)
+            should_flush = (
+                len(self._pending) >= ACK_FLUSH_SIZE
+                or time.monotonic() - self._last_flush >= ACK_FLUSH_INTERVAL_SECONDS
+            )
+        if should_flush:
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, []
+            self._last_flush = time.monotonic()
+        if not pending:
+            return
+
+        updates = {}
+        for user_id in pending:
+            doc_ref = get_recipient_doc_ref(self.event_ref, user_id, self.shard_count)
+            updates.setdefault(doc_ref.path, (doc_ref, {}))[1][delivered_field(user_id)] = True
+
+        try:
+            updates = list(updates.values())
+            for i in range(0, len(updates), MAX_BATCH_WRITES):
+                batch = self.db.batch()
+                for doc_ref, fields in updates[i:i + MAX_BATCH_WRITES]:
+                    batch.update(doc_ref, fields)
+                batch.commit()
+        except Exception as e:
+            # Keep the acks for the next flush, otherwise these users get the message again on retry
+            print(f"Failed to write {len(pending)} delivery acknowledgements: {e}")
+            with self._lock:
+                self._pending = pending + self._pending
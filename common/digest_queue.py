@@ -0,0 +1,41 @@
+from google.cloud import firestore
+
+# Per-user queue of matched events waiting for the user's next digest
+DIGEST_QUEUE_COLLECTION = "digest_queue"
+
+IMMEDIATE = "immediate"
+HOURLY = "hourly"
+DAILY = "daily"
+
+DELIVERY_MODES = (IMMEDIATE, HOURLY, DAILY)
+DIGEST_MODES = (HOURLY, DAILY)
+
+# Firestore batches are limited to 500 writes
+MAX_BATCH_WRITES = 500
+
+
+def get_queue_ref(db, user_id):
+    return db.collection(DIGEST_QUEUE_COLLECTION).document(user_id)
+
+
+# Function to get the writes queueing a matched event for every digest user it matched.
+# Each is a (document, fields) pair to set with merge=True.
+def get_digest_item_writes(db, matched_event_id, users_by_mode):
+    return [
+        (
+            get_queue_ref(db, user_id),
+            {"mode": mode, "items": firestore.ArrayUnion([matched_event_id]), "pending": True},
+        )
+        for mode, users in users_by_mode.items()
+        for user_id in users
+    ]
+
+
+# Function to queue a matched event for every digest user it matched
+def enqueue_digest_items(db, matched_event_id, users_by_mode):
+    writes = get_digest_item_writes(db, matched_event_id, users_by_mode)
+    for i in range(0, len(writes), MAX_BATCH_WRITES):
+        batch = db.batch()
+        for queue_ref, fields in writes[i:i + MAX_BATCH_WRITES]:
+            batch.set(queue_ref, fields, merge=True)
+        batch.commit()
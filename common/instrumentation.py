@@ -0,0 +1,200 @@
+import contextvars
+import json
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+from common.clients import PROJECT_ID
+
+# Spans are logged one JSON line each, set to false to only log the per-trace summary
+LOG_SPANS = os.environ.get("LOG_SPANS", "true").lower() == "true"
+
+# Counter names
+FIRESTORE_READS = "firestore_reads"
+FIRESTORE_WRITES = "firestore_writes"
+OPENAI_TOKENS = "openai_tokens"
+SUMMARY_FALLBACKS = "summary_fallbacks"
+TELEGRAM_MESSAGES = "telegram_messages"
+TELEGRAM_FAILURES = "telegram_failures"
+TELEGRAM_RETRY_AFTER = "telegram_retry_after"
+TELEGRAM_DUPLICATES = "telegram_duplicates"
+TELEGRAM_USER_THROTTLED = "telegram_user_throttled"
+TELEGRAM_DEAD_CHATS = "telegram_dead_chats"
+
+# Totals since the instance started, across every trace
+_totals = {}
+_totals_lock = threading.Lock()
+
+_current_trace = contextvars.ContextVar("trace", default=None)
+
+
+# The unit of work followed across services: a webhook request, a matcher run or a
+# delivery. Every service handling the same event uses the same trace id.
+class Trace:
+    def __init__(self, name, trace_id, attributes):
+        self.name = name
+        self.trace_id = trace_id
+        self.attributes = attributes
+        self.counters = {}
+        self.spans = {}
+        self._lock = threading.Lock()
+
+    def increment(self, name, value):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def add_span(self, name, duration_ms):
+        with self._lock:
+            self.spans[name] = round(self.spans.get(name, 0) + duration_ms, 3)
+
+
+def new_trace_id():
+    return uuid.uuid4().hex
+
+
+def get_trace_id():
+    current = _current_trace.get()
+    return current.trace_id if current else None
+
+
+# Function to write a structured log line. Cloud Logging parses JSON written to stdout
+# and groups entries with the same trace.
+def log(message, **fields):
+    entry = {"severity": "INFO", "message": message, **fields}
+    trace_id = fields.get("trace_id") or get_trace_id()
+    if trace_id:
+        entry["trace_id"] = trace_id
+        entry["logging.googleapis.com/trace"] = f"projects/{PROJECT_ID}/traces/{trace_id}"
+    print(json.dumps(entry, default=str))
+
+
+# Function to follow a unit of work. Pass the trace id received from the previous
+# service to continue its trace. The summary with every span and counter is logged
+# when the work is done.
+@contextmanager
+def trace(name, trace_id=None, **attributes):
+    current = Trace(name, trace_id or new_trace_id(), attributes)
+    token = _current_trace.set(current)
+    started = time.perf_counter()
+    status = "ok"
+    try:
+        yield current
+    except BaseException:
+        status = "error"
+        raise
+    finally:
+        _current_trace.reset(token)
+        log(
+            "trace",
+            trace=name,
+            trace_id=current.trace_id,
+            status=status,
+            duration_ms=round((time.perf_counter() - started) * 1000, 3),
+            spans=current.spans,
+            counters=current.counters,
+            **current.attributes,
+        )
+
+
+# Function to time a stage of the current trace
+@contextmanager
+def span(name, **attributes):
+    started = time.perf_counter()
+    status = "ok"
+    try:
+        yield
+    except BaseException:
+        status = "error"
+        raise
+    finally:
+        duration_ms = round((time.perf_counter() - started) * 1000, 3)
+        current = _current_trace.get()
+        if current:
+            current.add_span(name, duration_ms)
+        if LOG_SPANS:
+            log("span", span=name, status=status, duration_ms=duration_ms, **attributes)
+
+
+def set_attribute(name, value):
+    current = _current_trace.get()
+    if current:
+        current.attributes[name] = value
+
+
+def increment(name, value=1):
+    current = _current_trace.get()
+    if current:
+        current.increment(name, value)
+    with _totals_lock:
+        _totals[name] = _totals.get(name, 0) + value
+
+
+# Function to get the instance-wide counter totals
+def get_totals():
+    with _totals_lock:
+        return dict(_totals)
+
+
+# Function to submit work to an executor as part of the caller's trace
+def submit_in_trace(executor, func, *args):
+    return executor.submit(contextvars.copy_context().run, func, *args)
+
+
+# Function to count the reads and writes of a Firestore client. Counts what Firestore
+# bills: one read per document returned (or per query without results) and one write
+# per committed write.
+def instrument_firestore(client):
+    try:
+        api = client._firestore_api
+    except AttributeError:
+        return client
+
+    commit = api.commit
+    batch_get_documents = api.batch_get_documents
+    run_query = api.run_query
+
+    def counted_commit(*args, **kwargs):
+        response = commit(*args, **kwargs)
+        increment(FIRESTORE_WRITES, len(response.write_results))
+        return response
+
+    def counted_batch_get_documents(*args, **kwargs):
+        return _CountedStream(batch_get_documents(*args, **kwargs), lambda response: "found" in response or "missing" in response)
+
+    def counted_run_query(*args, **kwargs):
+        return _CountedStream(run_query(*args, **kwargs), lambda response: "document" in response, minimum=1)
+
+    api.commit = counted_commit
+    api.batch_get_documents = counted_batch_get_documents
+    api.run_query = counted_run_query
+    return client
+
+
+# Wraps a streaming response, counting the reads it returns
+class _CountedStream:
+    def __init__(self, stream, is_read, minimum=0):
+        self._stream = stream
+        self._is_read = is_read
+        self._minimum = minimum
+        self._reads = 0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            response = next(self._stream)
+        except StopIteration:
+            if self._reads < self._minimum:
+                increment(FIRESTORE_READS, self._minimum - self._reads)
+                self._reads = self._minimum
+            raise
+        if self._is_read(response):
+            self._reads += 1
+            increment(FIRESTORE_READS)
+        return response
+
+    def __getattr__(self, name):
+        return getattr(self._stream, name)
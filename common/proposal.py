@@ -0,0 +1,125 @@
+import hashlib
+
+# Snapshot webhook events for a proposal's lifecycle, by the name users choose them with
+EVENT_TYPES = {
+    "created": "proposal/created",
+    "start": "proposal/start",
+    "end": "proposal/end",
+    "deleted": "proposal/deleted",
+}
+PROPOSAL_CREATED = EVENT_TYPES["created"]
+PROPOSAL_DELETED = EVENT_TYPES["deleted"]
+
+# Message label of each event
+EVENT_LABELS = {
+    "proposal/created": "Proposal Created",
+    "proposal/start": "Voting Started",
+    "proposal/end": "Voting Ended",
+    "proposal/deleted": "Proposal Deleted",
+}
+
+
+# Function to get the short event type ("created", "start", ...) of a Snapshot event.
+# Events stored before event types were tracked are proposal creations.
+def get_event_type(event):
+    return (event or PROPOSAL_CREATED).split("/")[-1]
+
+
+# Function to decode a single value from the Firestore wire format used by
+# Firestore triggers ({"stringValue": ...}, {"mapValue": {"fields": ...}}, ...)
+def decode_value(value):
+    if "stringValue" in value:
+        return value["stringValue"]
+    if "integerValue" in value:
+        return int(value["integerValue"])
+    if "doubleValue" in value:
+        return float(value["doubleValue"])
+    if "booleanValue" in value:
+        return value["booleanValue"]
+    if "timestampValue" in value:
+        return value["timestampValue"]
+    if "mapValue" in value:
+        return {key: decode_value(item) for key, item in value["mapValue"].get("fields", {}).items()}
+    if "arrayValue" in value:
+        return [decode_value(item) for item in value["arrayValue"].get("values", [])]
+    return None
+
+
+# A Snapshot proposal, reduced to what matching and notifications need. Events are
+# stored and passed between services as the compact projection from
+# to_projection(); the body stays in snapshot_events and is referenced by its hash.
+class Proposal:
+    __slots__ = ("id", "event", "space_id", "space_name", "title", "body", "body_hash", "body_length", "start", "end", "choices", "tickers")
+
+    def __init__(self, id, space_id, space_name, title, body=None, body_hash=None, start=None, end=None, choices=(), event=None, tickers=(), body_length=None):
+        self.id = id
+        self.event = event
+        self.space_id = space_id
+        self.space_name = space_name
+        self.title = title or ""
+        self.body = body
+        if body_hash is None and body is not None:
+            body_hash = hashlib.sha256(body.encode("utf-8")).hexdigest()
+        self.body_hash = body_hash
+        self.body_length = len(body) if body_length is None and body is not None else body_length
+        self.start = start
+        self.end = end
+        self.choices = list(choices)
+        # Known tickers mentioned in the title or body, filled in by the matcher
+        self.tickers = sorted(tickers)
+
+    # Function to decode the fields of a snapshot_events document from a Firestore trigger
+    @classmethod
+    def from_firestore_fields(cls, fields):
+        names = ("id", "event", "space", "title", "body", "start", "end", "choices")
+        return cls.from_event_data({name: decode_value(fields[name]) for name in names if name in fields})
+
+    # Function to build a proposal from a snapshot_events document
+    @classmethod
+    def from_event_data(cls, data):
+        space = data.get("space") or {}
+        return cls(
+            id=data.get("id"),
+            event=data.get("event"),
+            space_id=space.get("id"),
+            space_name=space.get("name"),
+            title=data.get("title"),
+            body=data.get("body") or "",
+            start=data.get("start"),
+            end=data.get("end"),
+            choices=data.get("choices") or [],
+        )
+
+    @classmethod
+    def from_projection(cls, data):
+        return cls(
+            id=data["id"],
+            event=data.get("event"),
+            space_id=data["space"]["id"],
+            space_name=data["space"].get("name"),
+            title=data.get("title"),
+            body_hash=data.get("body_hash"),
+            body_length=data.get("body_length"),
+            start=data.get("start"),
+            end=data.get("end"),
+            choices=data.get("choices", []),
+            tickers=data.get("tickers", []),
+        )
+
+    @property
+    def label(self):
+        return EVENT_LABELS.get(self.event or PROPOSAL_CREATED, "Proposal Updated")
+
+    def to_projection(self):
+        return {
+            "id": self.id,
+            "event": self.event,
+            "space": {"id": self.space_id, "name": self.space_name},
+            "title": self.title,
+            "body_hash": self.body_hash,
+            "body_length": self.body_length,
+            "start": self.start,
+            "end": self.end,
+            "choices": self.choices,
+            "tickers": self.tickers,
+        }
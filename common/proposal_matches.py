@@ -0,0 +1,82 @@
+import math
+
+from google.cloud import firestore
+
+# The users matched by a proposal's first event, kept so its later lifecycle events
+# (start, end, deleted) are a lookup instead of a new match against every subscription
+PROPOSAL_MATCHES_COLLECTION = "proposal_matches"
+SHARDS_SUBCOLLECTION = "shards"
+
+# Firestore documents are limited to 1 MiB, larger matches are split into shards
+MAX_USERS_PER_DOCUMENT = 20000
+
+
+def get_matches_ref(db, proposal_id):
+    return db.collection(PROPOSAL_MATCHES_COLLECTION).document(proposal_id.replace("/", "_"))
+
+
+# Function to get the writes storing the users matched by a proposal and the (kind,
+# term) index pairs they matched, as (document, fields) pairs. Shards come before the
+# main document, so a reader that sees the main document never sees a partial set.
+def get_matched_users_writes(db, proposal_id, users, terms):
+    users = sorted(users)
+    matches_ref = get_matches_ref(db, proposal_id)
+    fields = {
+        "proposal_id": proposal_id,
+        "user_count": len(users),
+        "terms": [{"kind": kind, "term": term} for kind, term in sorted(terms)],
+        "matched_at": firestore.SERVER_TIMESTAMP,
+    }
+
+    if len(users) <= MAX_USERS_PER_DOCUMENT:
+        return [(matches_ref, {**fields, "users": users, "shards": 0})]
+
+    shard_count = math.ceil(len(users) / MAX_USERS_PER_DOCUMENT)
+    writes = [
+        (
+            matches_ref.collection(SHARDS_SUBCOLLECTION).document(str(shard)),
+            {"users": users[shard * MAX_USERS_PER_DOCUMENT:(shard + 1) * MAX_USERS_PER_DOCUMENT]},
+        )
+        for shard in range(shard_count)
+    ]
+    writes.append((matches_ref, {**fields, "users": [], "shards": shard_count}))
+    return writes
+
+
+# Function to store the users matched by a proposal
+def write_matched_users(db, proposal_id, users, terms):
+    writes = get_matched_users_writes(db, proposal_id, users, terms)
+
+    # Shards are large, keep each commit well below the request size limit
+    for start in range(0, len(writes) - 1, 10):
+        batch = db.batch()
+        for doc_ref, fields in writes[start:min(start + 10, len(writes) - 1)]:
+            batch.set(doc_ref, fields)
+        batch.commit()
+
+    matches_ref, fields = writes[-1]
+    matches_ref.set(fields)
+
+
+# Function to get the users matched by a proposal and the (kind, term) pairs they
+# matched, or None if it wasn't matched yet. The terms are None for matches stored
+# before they were kept.
+def read_matched_users(db, proposal_id):
+    matches_ref = get_matches_ref(db, proposal_id)
+    doc = matches_ref.get()
+    if not doc.exists:
+        return None
+
+    matches = doc.to_dict()
+    users = set(matches.get("users", []))
+    shard_refs = [
+        matches_ref.collection(SHARDS_SUBCOLLECTION).document(str(shard)) for shard in range(matches.get("shards", 0))
+    ]
+    if shard_refs:
+        for shard_doc in db.get_all(shard_refs):
+            users.update(shard_doc.get("users") or [])
+
+    terms = matches.get("terms")
+    if terms is not None:
+        terms = {(term["kind"], term["term"]) for term in terms}
+    return users, terms
@@ -0,0 +1,115 @@
+import hashlib
+from urllib.parse import quote
+
+from google.cloud import firestore
+
+from common.digest_queue import DIGEST_MODES
+from common.proposal import EVENT_TYPES
+from common.tickers import ALL_TICKERS, get_ticker_subscriptions, normalize_ticker
+
+# Inverted index over user_subscriptions. Each entry maps one subscription term
+# (a project id, a lowercased keyword, or a ticker) to the users subscribed
+# to it, so matching an event only reads the terms that can actually match. Every
+# write stamps the entry's `updated` field, which lets warm matcher instances
+# refresh their cached copy incrementally.
+INDEX_COLLECTION = "subscription_index"
+
+# Firestore documents are limited to 1 MiB, so each entry is split into shard
+# documents by user. A shard holds around 60k users at 1M subscribers of a term.
+INDEX_SHARDS = 16
+
+PROJECT = "project"
+KEYWORD = "keyword"
+TICKER = "ticker"
+# Not a subscription term: lists the users receiving hourly or daily digests
+DELIVERY = "delivery"
+# Not a subscription term: lists the users who turned off notifications for an event
+# type ("created", "start", "end" or "deleted")
+MUTED_EVENT = "muted_event"
+
+
+def normalize_term(kind, term):
+    # Keywords are matched case-insensitively
+    if kind == KEYWORD:
+        return term.lower()
+    if kind == TICKER and term != ALL_TICKERS:
+        return normalize_ticker(term)
+    return term
+
+
+# Function to get the shard of an entry holding a user, the same for every term
+def get_index_shard(user_id):
+    return int(hashlib.md5(user_id.encode("utf-8")).hexdigest(), 16) % INDEX_SHARDS
+
+
+def index_doc_id(kind, term, shard=0):
+    # Firestore document ids can't contain "/", so the term is percent-encoded. Shard 0
+    # keeps the id entries had before they were sharded.
+    doc_id = f"{kind}:{quote(normalize_term(kind, term), safe='')}"
+    return f"{doc_id}:{shard}" if shard else doc_id
+
+
+def index_doc_ref(db, kind, term, shard=0):
+    return db.collection(INDEX_COLLECTION).document(index_doc_id(kind, term, shard))
+
+
+# Function to get the shard document of an entry holding a user
+def user_index_doc_ref(db, kind, term, user_id):
+    return index_doc_ref(db, kind, term, get_index_shard(user_id))
+
+
+# Function to get every index entry a user belongs to, as (kind, term) pairs
+def get_user_terms(user_subscription):
+    terms = [(PROJECT, project) for project in user_subscription.get("projects") or []]
+    terms += [(KEYWORD, keyword) for keyword in user_subscription.get("keywords") or []]
+    terms += [(TICKER, ticker) for ticker in get_ticker_subscriptions(user_subscription.get("tickers"))]
+    if user_subscription.get("delivery_mode") in DIGEST_MODES:
+        terms.append((DELIVERY, user_subscription["delivery_mode"]))
+    if user_subscription.get("events") is not None:
+        terms += [(MUTED_EVENT, event_type) for event_type in EVENT_TYPES if event_type not in user_subscription["events"]]
+    return list(dict.fromkeys((kind, normalize_term(kind, term)) for kind, term in terms))
+
+
+# Function to rebuild the whole index from user_subscriptions. Only needed once to
+# backfill existing subscriptions, and once to split entries written before they were
+# sharded; the bot keeps the index up to date afterwards.
+def rebuild_index(db):
+    index = {}  # (kind, term, shard) -> user ids
+    for doc in db.collection("user_subscriptions").stream():
+        user_subscription = doc.to_dict()
+        # Users whose chat is gone (e.g. they blocked the bot) are left out until they're back
+        if user_subscription.get("active") is False:
+            continue
+        shard = get_index_shard(doc.id)
+        for kind, term in get_user_terms(user_subscription):
+            index.setdefault((kind, term, shard), set()).add(doc.id)
+
+    # Entries for terms nobody is subscribed to anymore are emptied rather than
+    # deleted, so cached copies of the index pick up the change incrementally
+    rebuilt_ids = set(index_doc_id(kind, term, shard) for kind, term, shard in index)
+    writes = [
+        (doc.reference, {"users": [], "updated": firestore.SERVER_TIMESTAMP})
+        for doc in db.collection(INDEX_COLLECTION).stream()
+        if doc.id not in rebuilt_ids
+    ]
+    writes += [
+        (
+            index_doc_ref(db, kind, term, shard),
+            {"kind": kind, "term": term, "shard": shard, "users": sorted(users), "updated": firestore.SERVER_TIMESTAMP},
+        )
+        for (kind, term, shard), users in index.items()
+    ]
+
+    # Firestore batches are limited to 500 writes
+    for i in range(0, len(writes), 500):
+        batch = db.batch()
+        for doc_ref, entry in writes[i:i + 500]:
+            batch.set(doc_ref, entry, merge=True)
+        batch.commit()
+
+    terms = set((kind, term) for kind, term, _ in index)
+    print(f"Rebuilt subscription index with {len(terms)} terms in {len(index)} shards")
+
+
+if __name__ == "__main__":
+    rebuild_index(firestore.Client())
@@ -0,0 +1,61 @@
+import os
+import re
+
+KNOWN_TICKERS_PATH = os.path.join(os.path.dirname(__file__), "known_tickers.txt")
+
+# A subscription to every known ticker
+ALL_TICKERS = "*"
+
+# Candidate tokens: an optionally $-prefixed word of 2-10 letters and digits
+TICKER_TOKEN_REGEX = re.compile(r"(?<![\w$])(\$?)([A-Za-z][A-Za-z0-9]{1,9})\b")
+
+
+def _load_known_tickers(path):
+    tickers = set()
+    prefixed_only = set()
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            if line.startswith("$"):
+                prefixed_only.add(line[1:])
+            else:
+                tickers.add(line)
+    return tickers, prefixed_only
+
+
+# Tickers matched when written in upper case, and tickers only matched as "$TICKER"
+KNOWN_TICKERS, PREFIXED_ONLY_TICKERS = _load_known_tickers(KNOWN_TICKERS_PATH)
+
+
+def normalize_ticker(ticker):
+    return ticker.strip().lstrip("$").upper()
+
+
+def is_known_ticker(ticker):
+    return ticker == ALL_TICKERS or ticker in KNOWN_TICKERS or ticker in PREFIXED_ONLY_TICKERS
+
+
+# Function to get the known tickers mentioned in a text, in its original case.
+# "$uni" and "UNI" both count, "Uni" or "uni" don't.
+def extract_tickers(text):
+    tickers = set()
+    for prefix, token in TICKER_TOKEN_REGEX.findall(text):
+        if prefix:
+            symbol = token.upper()
+            if symbol in KNOWN_TICKERS or symbol in PREFIXED_ONLY_TICKERS:
+                tickers.add(symbol)
+        elif token in KNOWN_TICKERS:
+            tickers.add(token)
+    return tickers
+
+
+# Function to read a user's ticker subscriptions. Subscriptions used to be a single
+# boolean for "all tickers".
+def get_ticker_subscriptions(value):
+    if value is True:
+        return [ALL_TICKERS]
+    if not value:
+        return []
+    return list(value)
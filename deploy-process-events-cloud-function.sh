@@ -1,8 +1,12 @@
 #!/bin/bash
 
+# Vendor the modules shared between services into the function source
+rm -rf ./process-events-cloud-function/common
+cp -r ./common ./process-events-cloud-function/common
+
 gcloud functions deploy monitor_snapshot_events \
   --runtime python310 \
   --region us-east1 \
-  --trigger-event providers/cloud.firestore/eventTypes/document.create \
+  --trigger-event providers/cloud.firestore/eventTypes/document.write \
   --trigger-resource 'projects/telegram-governance-bot/databases/(default)/documents/snapshot_events/{eventId}' \
-  --source ./process-events-cloud-function
\ No newline at end of file
+  --source ./process-events-cloud-function
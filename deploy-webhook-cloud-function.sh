@@ -1,9 +1,28 @@
 #!/bin/bash
 
+# Vendor the modules shared between services into the function source
+rm -rf ./webhook-cloud-function/common
+cp -r ./common ./webhook-cloud-function/common
+
+# Webhook: validates and enqueues Snapshot events, then acknowledges immediately
 gcloud functions deploy snapshot_webhook \
   --gen2 \
   --region=us-central1 \
   --runtime=python310 \
   --source=./webhook-cloud-function \
   --entry-point=webhook \
-  --trigger-http
\ No newline at end of file
+  --trigger-http \
+  --set-env-vars=WEBHOOK_FAST_ACK=true
+
+# Enrichment worker: fetches proposal data for queued events and stores them. Handles
+# events concurrently so their proposal lookups are batched into one request.
+gcloud functions deploy enrich_snapshot_event \
+  --gen2 \
+  --region=us-central1 \
+  --runtime=python310 \
+  --source=./webhook-cloud-function \
+  --entry-point=enrich_snapshot_event \
+  --trigger-topic=snapshot-webhook-events \
+  --cpu=1 \
+  --concurrency=20 \
+  --retry
@@ -0,0 +1,95 @@
+from collections import deque
+
+
+def _is_word_char(char):
+    return char.isalnum() or char == "_"
+
+
+# Aho-Corasick automaton over all subscribed keywords. Finds every keyword that
+# occurs in a text in a single pass, no matter how many keywords there are.
+class KeywordMatcher:
+    def __init__(self, keywords, word_boundaries=False):
+        self.keywords = frozenset(keyword for keyword in keywords if keyword)
+        self.word_boundaries = word_boundaries
+
+        # Trie transitions, failure links and the keywords ending at each node
+        self._goto = [{}]
+        self._fail = [0]
+        self._output = [()]
+
+        for keyword in self.keywords:
+            self._add_keyword(keyword)
+        self._build_failure_links()
+
+    def _add_keyword(self, keyword):
+        node = 0
+        for char in keyword:
+            next_node = self._goto[node].get(char)
+            if next_node is None:
+                next_node = len(self._goto)
+                self._goto[node][char] = next_node
+                self._goto.append({})
+                self._fail.append(0)
+                self._output.append(())
+            node = next_node
+        self._output[node] += (keyword,)
+
+    def _build_failure_links(self):
+        # Breadth-first, so a node's failure target is always finished before the node
+        queue = deque(self._goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for char, child in self._goto[node].items():
+                queue.append(child)
+                fallback = self._fail[node]
+                while fallback and char not in self._goto[fallback]:
+                    fallback = self._fail[fallback]
+                self._fail[child] = self._goto[fallback].get(char, 0)
+                self._output[child] += self._output[self._fail[child]]
+
+    def _on_word_boundary(self, text, start, end):
+        if start > 0 and _is_word_char(text[start - 1]) and _is_word_char(text[start]):
+            return False
+        if end < len(text) and _is_word_char(text[end]) and _is_word_char(text[end - 1]):
+            return False
+        return True
+
+    # Function to get the set of keywords occurring in the text
+    def find(self, text):
+        goto = self._goto
+        fail = self._fail
+        output = self._output
+
+        found = set()
+        node = 0
+        for i, char in enumerate(text):
+            while node and char not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(char, 0)
+
+            for keyword in output[node]:
+                if keyword in found:
+                    continue
+                if self.word_boundaries and not self._on_word_boundary(text, i - len(keyword) + 1, i + 1):
+                    continue
+                found.add(keyword)
+
+        return found
+
+
+# Matcher kept across warm invocations, rebuilt only when the keyword set changes
+_cached_matcher = None
+
+
+def get_keyword_matcher(keywords, word_boundaries=False):
+    global _cached_matcher
+
+    keywords = frozenset(keywords)
+    if (
+        _cached_matcher is None
+        or _cached_matcher.keywords != keywords
+        or _cached_matcher.word_boundaries != word_boundaries
+    ):
+        _cached_matcher = KeywordMatcher(keywords, word_boundaries)
+
+    return _cached_matcher
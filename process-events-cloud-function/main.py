@@ -1,81 +1,177 @@
-from google.cloud import firestore
-from google.cloud import pubsub_v1
 import json
-import re
-
-# Initialize Firestore client
-db = firestore.Client()
-
-# Initialize Publisher client
-publisher = pubsub_v1.PublisherClient()
-topic_path = publisher.topic_path("telegram-governance-bot", "matched-events-topic")
-
-# Regex to match 3-5 uppercase letters. Used to match tickers
-TOKEN_TICKER_REGEX = r'\b[A-Z]{3,5}\b'
-
-
-# Function to publish a matched event
-def publish_matched_event(matched_event):
-    data = json.dumps(matched_event)
-    data = data.encode("utf-8")
-
-    future = publisher.publish(topic_path, data)
-    print(f"Published message: {future.result()}")
-
-
-
+import os
+from concurrent import futures
+from common import delivery_state, digest_queue, instrumentation, proposal_matches, subscription_index
+from common.clients import get_batch_publisher_client, get_firestore_client
+from common.proposal import Proposal, get_event_type
+from common.tickers import ALL_TICKERS, extract_tickers
+from keyword_matcher import get_keyword_matcher
+from subscription_cache import subscription_cache
+
+MATCHED_EVENTS_TOPIC = "matched-events-topic"
+
+# Only match keywords on word boundaries (e.g. "uni" won't match "unicorn")
+KEYWORD_WORD_BOUNDARIES = os.environ.get("KEYWORD_WORD_BOUNDARIES", "false").lower() == "true"
+
+
+# Function to publish the work units of a matched event
+def publish_matched_event(work_units):
+    # A large fan-out publishes many small work units at once
+    publisher = get_batch_publisher_client()
+    topic_path = publisher.topic_path("telegram-governance-bot", MATCHED_EVENTS_TOPIC)
+    publish_futures = [
+        publisher.publish(topic_path, json.dumps(work_unit).encode("utf-8"))
+        for work_unit in work_units
+    ]
+
+    # Publishing happens in the background; only wait once every message is queued
+    done, _ = futures.wait(publish_futures)
+    failed = [future.exception() for future in done if future.exception() is not None]
+    if failed:
+        raise RuntimeError(f"Failed to publish {len(failed)} of {len(work_units)} work units: {failed[0]}")
+
+    print(f"Published {len(work_units)} work units")
+
+
+# Function to find the index terms a proposal matches, as (kind, term) pairs with at
+# least one subscriber. Its tickers must already be extracted.
+def get_matched_terms(proposal):
+    # Get the project ID and body and title text from the proposal
+    event_project_id = proposal.space_id
+    event_body_text = proposal.body.lower()  # Convert to lower case for case-insensitive matching
+    event_title_text = proposal.title.lower()  # Convert to lower case for case-insensitive matching
+    event_tickers = proposal.tickers
+
+    # The event's project
+    terms = [(subscription_index.PROJECT, event_project_id)]
+
+    # Any keyword found in the body or title text. Only the keywords that actually appear
+    # in the event are touched.
+    keyword_subscribers = subscription_cache.get_kind_subscribers(subscription_index.KEYWORD)
+    keyword_matcher = get_keyword_matcher(keyword_subscribers.keys(), KEYWORD_WORD_BOUNDARIES)
+    for keyword in keyword_matcher.find(f"{event_title_text}\n{event_body_text}"):
+        terms.append((subscription_index.KEYWORD, keyword))
+
+    # Any of the mentioned tickers, or all tickers
+    for ticker in event_tickers:
+        terms.append((subscription_index.TICKER, subscription_index.normalize_term(subscription_index.TICKER, ticker)))
+    if event_tickers:
+        terms.append((subscription_index.TICKER, ALL_TICKERS))
+
+    return {(kind, term) for kind, term in terms if subscription_cache.get_term_subscribers(kind, term)}
+
+
+# Function to get the users currently subscribed to any of the given (kind, term) pairs
+def get_subscribers(terms):
+    return set().union(*(subscription_cache.get_term_subscribers(kind, term) for kind, term in terms))
+
+
+# Function to find the users whose subscriptions match a proposal, along with the terms
+# they matched. Its tickers must already be extracted.
+def match_subscriptions(proposal):
+    matched_terms = get_matched_terms(proposal)
+    return get_subscribers(matched_terms), matched_terms
+
+
+# Function to split the recipients of an event into users notified immediately and
+# users receiving hourly or daily digests
+def split_by_delivery_mode(matched_users):
+    digest_users = {
+        mode: matched_users & subscription_cache.get_term_subscribers(subscription_index.DELIVERY, mode)
+        for mode in digest_queue.DIGEST_MODES
+    }
+    return matched_users.difference(*digest_users.values()), digest_users
+
+
+# Function to get the recipients of an event: the matched users, minus the users who
+# turned off notifications for its type
+def filter_event_type(matched_users, event_type):
+    return matched_users - subscription_cache.get_term_subscribers(subscription_index.MUTED_EVENT, event_type)
+
+
+# Triggered by every write to snapshot_events. Each proposal has one document, which
+# the webhook updates with every lifecycle event (created, start, end, deleted).
 def monitor_snapshot_events(data, context):
-    # Get event data from the snapshot
-    event_data = data["value"]["fields"]
-
-    # Get the project ID and body and title text from the event data
-    event_project_id = event_data["space"]["mapValue"]["fields"]["id"]["stringValue"]
-    event_body_text = event_data["body"]["stringValue"].lower()  # Convert to lower case for case-insensitive matching
-    event_title_text = event_data["title"]["stringValue"].lower()  # Convert to lower case for case-insensitive matching
-
-    # Get all potential tickers in body and title text
-    body_text_tickers = re.findall(TOKEN_TICKER_REGEX, event_body_text.upper())
-    title_text_tickers = re.findall(TOKEN_TICKER_REGEX, event_title_text.upper())
-    event_tickers = set(body_text_tickers + title_text_tickers)  # Combine and remove duplicates
-
-    # Initialize a set to hold all matching user IDs
-    matched_users = set()
-
-    # Fetch all user subscriptions
-    user_subscriptions_ref = db.collection("user_subscriptions")
-    user_subscriptions_docs = user_subscriptions_ref.stream()
-
-    # Loop through user subscriptions and check if project ID, any keyword, or any ticker matches
-    for doc in user_subscriptions_docs:
-        user_subscription = doc.to_dict()
-
-        # Check if the event's project ID is in the user's subscription projects
-        if "projects" in user_subscription and event_project_id in user_subscription["projects"]:
-            matched_users.add(doc.id)
-
-        # Check if any of the user's keywords is in the body or title text
-        if "keywords" in user_subscription:
-            for keyword in user_subscription["keywords"]:
-                if keyword.lower() in event_body_text or keyword.lower() in event_title_text:
-                    matched_users.add(doc.id)
-                    break  # Stop checking other keywords once a match is found
-
-        # Check if any of the event's tickers are in the user's subscription tickers
-        if "tickers" in user_subscription:
-            for ticker in user_subscription["tickers"]:
-                if ticker in event_tickers:
-                    matched_users.add(doc.id)
-                    break  # Stop checking other tickers once a match is found
+    fields = data.get("value", {}).get("fields")
+    if not fields:
+        # The document was deleted
+        return
+
+    # Rewrites of the same event (e.g. a webhook retry or updated proposal data) were
+    # already handled
+    old_fields = data.get("oldValue", {}).get("fields", {})
+    if old_fields and old_fields.get("event") == fields.get("event"):
+        print(f"Event {fields.get('event', {}).get('stringValue')} was already handled, skipping it")
+        return
+
+    # Continue the trace started by the webhook that stored the event
+    trace_id = fields.get("trace_id", {}).get("stringValue")
+    with instrumentation.trace("match", trace_id=trace_id):
+        match_snapshot_event(fields)
+
+
+def match_snapshot_event(fields):
+    with instrumentation.span("load"):
+        # Decode the proposal from the snapshot
+        proposal = Proposal.from_firestore_fields(fields)
+
+        # Get the known tickers mentioned in the original-case title and body text, and keep
+        # them on the proposal
+        proposal.tickers = sorted(extract_tickers(f"{proposal.title}\n{proposal.body}"))
+    event_type = get_event_type(proposal.event)
+    instrumentation.set_attribute("proposal_id", proposal.id)
+    instrumentation.set_attribute("event_type", event_type)
+
+    # Shared Firestore client, created on first use
+    db = get_firestore_client()
+
+    # Bring the warm instance's copy of the subscription index up to date
+    with instrumentation.span("scan"):
+        subscription_cache.refresh(db)
+
+    # Later lifecycle events of a proposal reuse the users matched by its first event
+    with instrumentation.span("lookup"):
+        matches = proposal_matches.read_matched_users(db, proposal.id)
+    instrumentation.set_attribute("memoized", matches is not None)
+
+    if matches is None:
+        with instrumentation.span("match"):
+            matched_users, matched_terms = match_subscriptions(proposal)
+        with instrumentation.span("memoize"):
+            proposal_matches.write_matched_users(db, proposal.id, matched_users, matched_terms)
+    else:
+        # Only keep the memoized users who still hold one of the matched terms, so users
+        # who unsubscribed or were deactivated since the first event aren't notified.
+        # Matches stored before their terms were kept are matched again for the terms.
+        matched_users, matched_terms = matches
+        if matched_terms is None:
+            matched_terms = get_matched_terms(proposal)
+        matched_users &= get_subscribers(matched_terms)
+
+    # Users who turned off notifications for this event type
+    matched_users = filter_event_type(matched_users, event_type)
+    instrumentation.set_attribute("matched_users", len(matched_users))
 
     # Check if there were any matches
     if matched_users:
-        # Create a new document in the matched_events collection with the event data and the matched user IDs
-        matched_event_data = {
-            "event_data": event_data,
-            "matched_users": {user_id: False for user_id in matched_users},
-        }
-
-        db.collection("matched_events").document().set(matched_event_data)
-
-        # Publish the matched event to Firestore collection
-        publish_matched_event(matched_event_data)
\ No newline at end of file
+        # Users receiving hourly or daily digests get the event queued instead of sent
+        immediate_users, digest_users = split_by_delivery_mode(matched_users)
+
+        # Create a new document in the matched_events collection with the proposal and the
+        # matched user IDs. Large fan-outs keep their delivery status in sharded subdocuments.
+        with instrumentation.span("store"):
+            event_ref = db.collection(delivery_state.MATCHED_EVENTS_COLLECTION).document()
+            shard_count = delivery_state.write_matched_event(
+                db, event_ref, {"proposal": proposal.to_projection()}, immediate_users
+            )
+            digest_queue.enqueue_digest_items(db, event_ref.id, digest_users)
+
+        # Publish one work unit per delivery status document to the matched events topic.
+        # Work units carry the trace id on to the bot.
+        if immediate_users:
+            work_units = [
+                {**work_unit, "trace_id": instrumentation.get_trace_id()}
+                for work_unit in delivery_state.get_work_units(event_ref, shard_count)
+            ]
+            with instrumentation.span("publish", work_units=len(work_units)):
+                publish_matched_event(work_units)
@@ -0,0 +1,215 @@
+import argparse
+import datetime
+import json
+import multiprocessing
+import os
+
+from common import delivery_state, digest_queue, instrumentation, proposal_matches
+from common.clients import get_firestore_client
+from common.proposal import Proposal, get_event_type
+from common.tickers import extract_tickers
+from main import filter_event_type, match_subscriptions, publish_matched_event, split_by_delivery_mode
+from subscription_cache import subscription_cache
+
+# Replays stored snapshot_events through the matcher in bulk, e.g. to backfill
+# matched_events after a matcher change or to check how many users a change of the
+# subscription rules would notify. Run from the repository root:
+#   PYTHONPATH=. python process-events-cloud-function/replay.py --since 2023-01-01 --dry-run
+
+SNAPSHOT_EVENTS_COLLECTION = "snapshot_events"
+
+# Only the fields needed to match an event and store its projection are read
+EVENT_FIELDS = ["id", "event", "space", "title", "body", "start", "end", "choices", "created"]
+
+# Events sent to a worker at a time
+WORKER_CHUNK_SIZE = 16
+
+
+# Function to parse a --since/--until value, either a unix timestamp or an ISO date (UTC)
+def parse_time(value):
+    if value.isdigit():
+        return int(value)
+    parsed = datetime.datetime.fromisoformat(value)
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=datetime.timezone.utc)
+    return int(parsed.timestamp())
+
+
+# Function to build the query over the events to replay, oldest first
+def get_events_query(db, since=None, until=None, space=None):
+    query = db.collection(SNAPSHOT_EVENTS_COLLECTION)
+    if space:
+        # Needs a composite index on (space.id, created)
+        query = query.where("space.id", "==", space)
+    if since is not None:
+        query = query.where("created", ">=", since)
+    if until is not None:
+        query = query.where("created", "<", until)
+    return query.select(EVENT_FIELDS).order_by("created")
+
+
+# Function to stream the events of a query in pages, starting after the given document
+def iter_pages(query, page_size, start_after=None):
+    while True:
+        page_query = query.limit(page_size)
+        if start_after is not None:
+            page_query = page_query.start_after(start_after)
+        page = list(page_query.stream())
+        if page:
+            yield page
+        if len(page) < page_size:
+            return
+        start_after = page[-1]
+
+
+# Function to match one event in a worker process, against the worker's copy of the
+# subscription index
+def match_event(data):
+    proposal = Proposal.from_event_data(data)
+    proposal.tickers = sorted(extract_tickers(f"{proposal.title}\n{proposal.body}"))
+    matched_users, matched_terms = match_subscriptions(proposal)
+    recipients = filter_event_type(matched_users, get_event_type(proposal.event))
+    immediate_users, digest_users = split_by_delivery_mode(recipients)
+    # The body isn't sent back, the projection only keeps its hash
+    return proposal.id, proposal.to_projection(), matched_users, matched_terms, immediate_users, digest_users
+
+
+def init_worker(terms):
+    subscription_cache.load_snapshot(terms)
+
+
+# Function to create the worker pool. Workers are spawned rather than forked, the
+# parent's gRPC channels don't survive a fork, and get a copy of the parent's index.
+def create_pool(processes):
+    context = multiprocessing.get_context("spawn")
+    return context.Pool(processes, initializer=init_worker, initargs=(subscription_cache.get_snapshot(),))
+
+
+def load_checkpoint(path):
+    if not path or not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+# Function to save the progress of a replay. Written to a temporary file first, so an
+# interrupted replay never leaves a partial checkpoint behind.
+def save_checkpoint(path, last_id, counts):
+    temporary_path = f"{path}.tmp"
+    with open(temporary_path, "w") as f:
+        json.dump({"last_id": last_id, "counts": counts}, f)
+    os.replace(temporary_path, path)
+
+
+# Function to replay the events of a query. In dry-run mode nothing is written, only the
+# match counts are reported. Matched events are only sent when publish is set.
+def replay(db, query, pool, page_size=500, dry_run=False, publish=False, checkpoint=None, limit=None):
+    state = load_checkpoint(checkpoint)
+    counts = {"events": 0, "events_matched": 0, "matched_users": 0, "immediate": 0, "digest": 0}
+    start_after = None
+    if state:
+        counts.update(state["counts"])
+        start_after = db.collection(SNAPSHOT_EVENTS_COLLECTION).document(state["last_id"]).get()
+        print(f"Resuming after event {state['last_id']} ({counts['events']} events replayed)")
+
+    bulk_writer = None if dry_run else db.bulk_writer()
+
+    for page in iter_pages(query, page_size, start_after):
+        if limit is not None:
+            page = page[:max(limit - counts["events"], 0)]
+            if not page:
+                break
+
+        with instrumentation.span("page", events=len(page)):
+            work_units = []
+            # The main proposal_matches document is written once its shards are stored
+            deferred_writes = []
+            results = pool.imap(match_event, [doc.to_dict() for doc in page], chunksize=WORKER_CHUNK_SIZE)
+            for proposal_id, projection, matched_users, matched_terms, immediate_users, digest_users in results:
+                recipient_count = len(immediate_users) + sum(len(users) for users in digest_users.values())
+                counts["events"] += 1
+                counts["events_matched"] += 1 if recipient_count else 0
+                counts["matched_users"] += recipient_count
+                counts["immediate"] += len(immediate_users)
+                counts["digest"] += recipient_count - len(immediate_users)
+                if dry_run:
+                    continue
+
+                memo_writes = proposal_matches.get_matched_users_writes(db, proposal_id, matched_users, matched_terms)
+                for doc_ref, fields in memo_writes[:-1]:
+                    bulk_writer.set(doc_ref, fields)
+                deferred_writes.append(memo_writes[-1])
+
+                if not recipient_count:
+                    continue
+
+                event_ref = db.collection(delivery_state.MATCHED_EVENTS_COLLECTION).document()
+                shard_count, event_writes = delivery_state.get_matched_event_writes(
+                    event_ref, {"proposal": projection}, immediate_users
+                )
+                for doc_ref, fields in event_writes:
+                    bulk_writer.set(doc_ref, fields)
+
+                # Without publish the matched events are only stored, queueing digest
+                # items would send them with the next digest
+                if publish:
+                    for queue_ref, fields in digest_queue.get_digest_item_writes(db, event_ref.id, digest_users):
+                        bulk_writer.set(queue_ref, fields, merge=True)
+                    if immediate_users:
+                        work_units += [
+                            {**work_unit, "trace_id": instrumentation.get_trace_id()}
+                            for work_unit in delivery_state.get_work_units(event_ref, shard_count)
+                        ]
+
+            if not dry_run:
+                bulk_writer.flush()
+                for doc_ref, fields in deferred_writes:
+                    bulk_writer.set(doc_ref, fields)
+                bulk_writer.flush()
+
+            # Work units are published once the events they refer to are stored
+            if work_units:
+                publish_matched_event(work_units)
+
+        if checkpoint:
+            save_checkpoint(checkpoint, page[-1].id, counts)
+        print(json.dumps({"message": "replay progress", "last_id": page[-1].id, **counts}))
+
+    if bulk_writer is not None:
+        bulk_writer.close()
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay stored snapshot_events through the matcher.")
+    parser.add_argument("--since", type=parse_time, help="only events created at or after this ISO date or unix time")
+    parser.add_argument("--until", type=parse_time, help="only events created before this ISO date or unix time")
+    parser.add_argument("--space", help="only events of this Snapshot space")
+    parser.add_argument("--page-size", type=int, default=500, help="events read per query")
+    parser.add_argument("--processes", type=int, default=os.cpu_count(), help="matcher worker processes")
+    parser.add_argument("--limit", type=int, help="stop after this many events")
+    parser.add_argument("--dry-run", action="store_true", help="only report match counts, don't write anything")
+    parser.add_argument("--publish", action="store_true", help="send the matched events to the matched users")
+    parser.add_argument("--checkpoint", help="file to save progress to, and resume from")
+    args = parser.parse_args()
+    if args.dry_run and args.publish:
+        parser.error("--dry-run and --publish can't be combined")
+
+    with instrumentation.trace("replay", dry_run=args.dry_run, publish=args.publish):
+        db = get_firestore_client()
+
+        # Every event is matched against the same copy of the subscription index
+        with instrumentation.span("scan"):
+            subscription_cache.refresh(db)
+
+        query = get_events_query(db, args.since, args.until, args.space)
+        with create_pool(args.processes) as pool:
+            counts = replay(
+                db, query, pool, args.page_size, args.dry_run, args.publish, args.checkpoint, args.limit
+            )
+
+    print(json.dumps({"message": "replay finished", "dry_run": args.dry_run, **counts}))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+import datetime
+import json
+import os
+import time
+
+from common import subscription_index
+
+# Reload the whole index when the cached copy is older than this, as a safety net
+# for anything the incremental refresh could have missed
+MAX_STALENESS_SECONDS = int(os.environ.get("SUBSCRIPTION_CACHE_MAX_STALENESS", "3600"))
+
+# Index writes are stamped with a server timestamp at commit time, so look back a
+# little when refreshing to pick up writes that committed around the last refresh
+REFRESH_OVERLAP = datetime.timedelta(seconds=5)
+
+
+# Process-level copy of the subscription index, kept across warm invocations.
+# Every refresh re-reads only the index entries changed since the previous one.
+class SubscriptionCache:
+    def __init__(self, max_staleness=MAX_STALENESS_SECONDS):
+        self.max_staleness = max_staleness
+        self._terms = {}  # kind -> {term: set of user ids}, the union of the term's shards
+        self._shards = {}  # (kind, term, shard) -> set of user ids
+        self._loaded_at = None  # time.monotonic() of the last full reload
+        self._refreshed_at = None  # time.monotonic() of the last refresh
+        self._cursor = None  # entries updated after this time are re-read on the next refresh
+        self._applied = {}  # doc id -> `updated` timestamp of the version in the cache
+
+    # Function to apply an index entry to the cache. Returns False when this version of
+    # the entry was already applied.
+    def _apply(self, doc):
+        entry = doc.to_dict()
+        updated = entry.get("updated")
+        if updated is not None and self._applied.get(doc.id) == updated:
+            return False
+        self._applied[doc.id] = updated
+
+        kind, term = entry.get("kind"), entry.get("term")
+        key = (kind, term, entry.get("shard", 0))
+        users = set(entry.get("users") or [])
+        previous = self._shards.pop(key, set())
+        if users:
+            self._shards[key] = users
+
+        # A user is only ever in one shard of a term, so the term's users change by the
+        # difference between the shard's old and new users
+        kind_terms = self._terms.setdefault(kind, {})
+        term_users = kind_terms.setdefault(term, set())
+        term_users -= previous - users
+        term_users |= users - previous
+        if not term_users:
+            del kind_terms[term]
+        return True
+
+    # Function to bring the cache up to date before matching an event
+    def refresh(self, db):
+        now = time.monotonic()
+        staleness = None if self._refreshed_at is None else now - self._refreshed_at
+        # Anchored to when this refresh started rather than to the newest entry read, so an
+        # index that stops changing (e.g. right after a rebuild) isn't re-read every time
+        started = datetime.datetime.now(datetime.timezone.utc)
+        collection = db.collection(subscription_index.INDEX_COLLECTION)
+        docs_read = applied = 0
+
+        full_reload = self._loaded_at is None or now - self._loaded_at > self.max_staleness or self._cursor is None
+        if full_reload:
+            # Cold instance or too stale: full reload, into a separate copy so a reload
+            # that fails partway leaves the previous copy and cursor in place
+            target = SubscriptionCache(self.max_staleness)
+            query = collection
+            result = "miss"
+        else:
+            # Warm instance: only read the entries changed since the last refresh. Each
+            # entry is applied whole, and the cursor only moves once all of them are.
+            target = self
+            query = collection.where("updated", ">", self._cursor)
+            result = "hit"
+
+        for doc in query.stream():
+            docs_read += 1
+            applied += 1 if target._apply(doc) else 0
+
+        if full_reload:
+            self._terms, self._shards, self._applied = target._terms, target._shards, target._applied
+            self._loaded_at = now
+        self._cursor = started - REFRESH_OVERLAP
+        self._refreshed_at = now
+
+        cached_terms = sum(len(terms) for terms in self._terms.values())
+        print(json.dumps({
+            "message": "subscription cache refresh",
+            "result": result,
+            "staleness_seconds": None if staleness is None else round(staleness, 3),
+            "docs_read": docs_read,
+            "docs_applied": applied,
+            "cached_terms": cached_terms,
+            "reads_saved": max(cached_terms - docs_read, 0),
+        }))
+
+    # Function to get the cached index ({kind: {term: set of user ids}}), e.g. to match
+    # events in other processes
+    def get_snapshot(self):
+        return self._terms
+
+    # Function to use a snapshot taken by get_snapshot, without reading Firestore
+    def load_snapshot(self, terms):
+        self._terms = terms
+        self._shards = {}
+        self._applied = {}
+        self._cursor = None
+        self._loaded_at = self._refreshed_at = time.monotonic()
+
+    # Function to get the users subscribed to a single term
+    def get_term_subscribers(self, kind, term):
+        return self._terms.get(kind, {}).get(subscription_index.normalize_term(kind, term), set())
+
+    # Function to get every term of a kind along with its subscribers
+    def get_kind_subscribers(self, kind):
+        return self._terms.get(kind, {})
+
+
+subscription_cache = SubscriptionCache()
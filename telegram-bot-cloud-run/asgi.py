@@ -0,0 +1,121 @@
+import asyncio
+import http
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs
+
+from telegram import Update
+
+import main
+
+# Command updates and notification fan-out run in separate lanes, each with its own
+# concurrency limit, so /subscribe stays responsive while deliveries are in flight
+COMMAND_CONCURRENCY = int(os.environ.get("COMMAND_CONCURRENCY", "16"))
+DELIVERY_CONCURRENCY = int(os.environ.get("DELIVERY_CONCURRENCY", "4"))
+
+command_executor = ThreadPoolExecutor(max_workers=COMMAND_CONCURRENCY, thread_name_prefix="command")
+delivery_executor = ThreadPoolExecutor(max_workers=DELIVERY_CONCURRENCY, thread_name_prefix="fanout")
+
+_delivery_slots = None
+
+
+def process_update(payload):
+    main.get_dispatcher().process_update(Update.de_json(payload, main.bot))
+    return "", http.HTTPStatus.NO_CONTENT
+
+
+async def run_command(payload):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(command_executor, process_update, payload)
+
+
+async def run_delivery(handler, *args):
+    global _delivery_slots
+    if _delivery_slots is None:
+        _delivery_slots = asyncio.Semaphore(DELIVERY_CONCURRENCY)
+
+    # Don't queue fan-outs behind each other on a busy instance. Pub/Sub backs off and
+    # redelivers, possibly to another instance.
+    if _delivery_slots.locked():
+        return "Too many deliveries in flight, retry later", http.HTTPStatus.TOO_MANY_REQUESTS
+
+    async with _delivery_slots:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(delivery_executor, handler, *args)
+
+
+async def read_body(receive):
+    body = b""
+    while True:
+        message = await receive()
+        body += message.get("body", b"")
+        if not message.get("more_body"):
+            return body
+
+
+async def respond(send, body, status):
+    await send({
+        "type": "http.response.start",
+        "status": int(status),
+        "headers": [(b"content-type", b"text/plain; charset=utf-8")],
+    })
+    await send({"type": "http.response.body", "body": body.encode("utf-8")})
+
+
+async def handle_lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            command_executor.shutdown(wait=False)
+            delivery_executor.shutdown(wait=True)
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+# ASGI entry point serving the same routes as the Flask app in main.py
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        await handle_lifespan(receive, send)
+        return
+    if scope["type"] != "http":
+        return
+
+    if scope["method"] != "POST":
+        await respond(send, "Method Not Allowed", http.HTTPStatus.METHOD_NOT_ALLOWED)
+        return
+
+    body = await read_body(receive)
+    path = scope["path"]
+
+    try:
+        denied = None
+        if path in ("/digest", "/compact"):
+            # Verifying the token may fetch Google's certificates, so it runs off the loop
+            authorization = dict(scope["headers"]).get(b"authorization", b"").decode("latin-1") or None
+            loop = asyncio.get_running_loop()
+            denied = await loop.run_in_executor(command_executor, main.authorize_scheduler_request, authorization)
+
+        if denied:
+            result = denied
+        elif path == "/":
+            result = await run_command(json.loads(body))
+        elif path == "/pubsub":
+            envelope = json.loads(body) if body else None
+            result = await run_delivery(main.handle_pubsub_envelope, envelope)
+        elif path == "/digest":
+            mode = parse_qs(scope["query_string"].decode("latin-1")).get("mode", [None])[0]
+            result = await run_delivery(main.handle_digest, mode)
+        elif path == "/compact":
+            result = await run_delivery(main.handle_compact)
+        else:
+            result = "Not Found", http.HTTPStatus.NOT_FOUND
+    except json.JSONDecodeError:
+        result = "Bad Request: invalid JSON", http.HTTPStatus.BAD_REQUEST
+    except Exception as e:
+        print(f"error: failed to handle {path}: {e}")
+        result = "Internal Server Error", http.HTTPStatus.INTERNAL_SERVER_ERROR
+
+    await respond(send, *result)
@@ -0,0 +1,311 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from telegram.error import BadRequest, InvalidToken, NetworkError, RetryAfter, Unauthorized
+
+from common import instrumentation
+from common.delivery_state import PUBSUB_ACK_DEADLINE_SECONDS
+
+# Number of messages sent in parallel by this instance
+MAX_DELIVERY_WORKERS = int(os.environ.get("MAX_DELIVERY_WORKERS", "16"))
+
+# Telegram allows bots roughly 30 messages per second overall and one message per
+# second to the same chat. The overall budget is shared by every instance of the
+# bot, so each instance gets an equal part of it. BOT_MAX_INSTANCES must match the
+# service's --max-instances.
+GLOBAL_MESSAGES_PER_SECOND = float(os.environ.get("GLOBAL_MESSAGES_PER_SECOND", "25"))
+BOT_MAX_INSTANCES = int(os.environ.get("BOT_MAX_INSTANCES", "1"))
+INSTANCE_MESSAGES_PER_SECOND = GLOBAL_MESSAGES_PER_SECOND / max(BOT_MAX_INSTANCES, 1)
+PER_CHAT_INTERVAL_SECONDS = float(os.environ.get("PER_CHAT_INTERVAL_SECONDS", "1"))
+
+# Each user gets at most this many messages in a burst, refilled at the given rate.
+# Messages over the limit wait for a token or are handed back for a later retry. Set
+# the rate to 0 to turn the limit off.
+USER_BURST_MESSAGES = float(os.environ.get("USER_BURST_MESSAGES", "10"))
+USER_MESSAGES_PER_MINUTE = float(os.environ.get("USER_MESSAGES_PER_MINUTE", "6"))
+# Longest a send waits for the user's next token before it's handed back
+MAX_USER_WAIT_SECONDS = float(os.environ.get("MAX_USER_WAIT_SECONDS", "10"))
+
+# A message with the same key (e.g. a proposal reposted in the same space) isn't sent
+# twice to a user within this window. Keys are kept in memory, oldest dropped first.
+DUPLICATE_WINDOW_SECONDS = float(os.environ.get("DUPLICATE_WINDOW_SECONDS", "3600"))
+MAX_RECENT_DELIVERIES = int(os.environ.get("MAX_RECENT_DELIVERIES", "100000"))
+
+# Stop starting new sends this long after the push request arrived, so the request
+# returns before the Pub/Sub subscription's ack deadline. Anything left is handed
+# back for a later retry.
+DELIVERY_DEADLINE_SECONDS = float(
+    os.environ.get("DELIVERY_DEADLINE_SECONDS", str(PUBSUB_ACK_DEADLINE_SECONDS * 0.9))
+)
+
+# How many times a single send is retried after Telegram answers 429
+MAX_RETRY_AFTER_ATTEMPTS = 3
+
+
+# Token bucket shared by every delivery on this instance
+class RateLimiter:
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        # Rates under 1 message per second (e.g. many instances) still need room for
+        # a whole token
+        self.capacity = max(burst or rate, 1)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    # Function to wait for a token. Returns False if none is available before the deadline.
+    def acquire(self, deadline):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if now >= self._paused_until and self._tokens >= 1:
+                    self._tokens -= 1
+                    return True
+                wait = max(self._paused_until - now, (1 - self._tokens) / self.rate)
+
+            if time.monotonic() + wait > deadline:
+                return False
+            time.sleep(wait)
+
+    # Function to stop handing out tokens, used when Telegram answers 429
+    def pause(self, seconds):
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+
+# Enforces the minimum interval between two messages to the same chat
+class ChatThrottle:
+    def __init__(self, interval):
+        self.interval = interval
+        self._last_sent = {}
+        self._lock = threading.Lock()
+
+    # Function to reserve the chat's next send slot. Returns the seconds to wait for it.
+    def reserve(self, chat_id):
+        with self._lock:
+            now = time.monotonic()
+            if len(self._last_sent) > 10000:
+                # Forget chats that can't be throttled anymore
+                self._last_sent = {
+                    chat: sent for chat, sent in self._last_sent.items() if now - sent < self.interval
+                }
+            slot = max(now, self._last_sent.get(chat_id, 0.0) + self.interval)
+            self._last_sent[chat_id] = slot
+            return slot - now
+
+
+# Per-user token buckets, limiting how many messages a single chat gets in a burst
+class UserRateLimiter:
+    def __init__(self, rate_per_minute, burst):
+        self.rate = rate_per_minute / 60
+        self.capacity = burst
+        self._buckets = {}  # user id -> (tokens, time.monotonic() of the last update)
+        self._lock = threading.Lock()
+
+    # Function to take one of the user's tokens. Returns the seconds until one is
+    # available, the token is only taken when that is 0.
+    def acquire(self, user_id):
+        if self.rate <= 0:
+            return 0.0
+        with self._lock:
+            now = time.monotonic()
+            if len(self._buckets) > 10000:
+                # Forget users whose bucket has refilled, they start out full anyway
+                self._buckets = {
+                    user: (tokens, updated) for user, (tokens, updated) in self._buckets.items()
+                    if tokens + (now - updated) * self.rate < self.capacity
+                }
+            tokens, updated = self._buckets.get(user_id, (self.capacity, now))
+            tokens = min(self.capacity, tokens + (now - updated) * self.rate)
+            if tokens >= 1:
+                self._buckets[user_id] = (tokens - 1, now)
+                return 0.0
+            self._buckets[user_id] = (tokens, now)
+            return (1 - tokens) / self.rate
+
+
+# Bounded set of recently delivered (user, key) pairs, each kept for a time window
+class RecentDeliveries:
+    def __init__(self, window, max_size):
+        self.window = window
+        self.max_size = max_size
+        self._expires = OrderedDict()  # (user id, key) -> time.monotonic() it expires at
+        self._lock = threading.Lock()
+
+    # Function to reserve a (user, key) pair. Returns False if it was delivered or
+    # reserved within the window.
+    def claim(self, user_id, key):
+        with self._lock:
+            now = time.monotonic()
+            # Entries are added in expiry order, so expired ones are at the front
+            while self._expires and (next(iter(self._expires.values())) <= now or len(self._expires) >= self.max_size):
+                self._expires.popitem(last=False)
+            if (user_id, key) in self._expires:
+                return False
+            self._expires[(user_id, key)] = now + self.window
+            return True
+
+    # Function to drop a reservation, e.g. when the send failed
+    def release(self, user_id, key):
+        with self._lock:
+            self._expires.pop((user_id, key), None)
+
+
+# Telegram answers 403 with one of these when a chat can never be sent to again. A
+# 401 (also raised as Unauthorized) means the bot's token is wrong, not the chat.
+DEAD_CHAT_MESSAGES = (
+    "forbidden: bot was blocked by the user",
+    "forbidden: user is deactivated",
+)
+# Description of Telegram's 401, every other Unauthorized is a 403 about one chat
+BOT_UNAUTHORIZED_MESSAGE = "unauthorized"
+
+
+# Raised when Telegram rejects the bot itself (bad or revoked token), so no send can
+# succeed until the configuration is fixed
+class BotConfigurationError(Exception):
+    pass
+
+
+# Function to check whether a send error means the chat is gone for good: the user
+# blocked the bot or deleted their account, or the chat doesn't exist
+def is_dead_chat_error(error):
+    message = str(error).lower()
+    if isinstance(error, Unauthorized):
+        return message.startswith(DEAD_CHAT_MESSAGES)
+    return isinstance(error, BadRequest) and "chat not found" in message
+
+
+# Function to check whether a send error means the bot's token is invalid. Other 403s
+# (e.g. the bot can't initiate a conversation with the user) only fail that chat.
+def is_bot_configuration_error(error):
+    if isinstance(error, InvalidToken):
+        return True
+    return isinstance(error, Unauthorized) and str(error).strip().lower() == BOT_UNAUTHORIZED_MESSAGE
+
+
+class DeliveryResult:
+    def __init__(self):
+        self.delivered = []
+        self.failed = []
+        self.leftover = []
+        # Duplicates of a message the user recently received, not sent again
+        self.skipped = []
+        # Users whose chat is gone, sending to them again would fail the same way
+        self.dead = []
+
+
+class DeliveryEngine:
+    def __init__(
+        self,
+        max_workers=MAX_DELIVERY_WORKERS,
+        messages_per_second=INSTANCE_MESSAGES_PER_SECOND,
+        per_chat_interval=PER_CHAT_INTERVAL_SECONDS,
+        user_messages_per_minute=USER_MESSAGES_PER_MINUTE,
+        user_burst=USER_BURST_MESSAGES,
+    ):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="delivery")
+        self._limiter = RateLimiter(messages_per_second)
+        self._chat_throttle = ChatThrottle(per_chat_interval)
+        self._user_limiter = UserRateLimiter(user_messages_per_minute, user_burst)
+        self._recent = RecentDeliveries(DUPLICATE_WINDOW_SECONDS, MAX_RECENT_DELIVERIES)
+
+    def _deliver_one(self, user_id, send, deadline, dedup_key, stopped):
+        # Once the bot's token was rejected, the remaining recipients are left untouched
+        if stopped.is_set():
+            return "leftover"
+        if dedup_key is not None and not self._recent.claim(user_id, dedup_key):
+            return "skipped"
+
+        status = self._send_one(user_id, send, deadline, stopped)
+        if status != "delivered" and dedup_key is not None:
+            self._recent.release(user_id, dedup_key)
+        return status
+
+    def _send_one(self, user_id, send, deadline, stopped):
+        # Smooth bursts to a single user before spending the bot's global budget on them
+        wait = self._user_limiter.acquire(user_id)
+        while wait:
+            if wait > MAX_USER_WAIT_SECONDS or time.monotonic() + wait > deadline:
+                instrumentation.increment(instrumentation.TELEGRAM_USER_THROTTLED)
+                return "leftover"
+            time.sleep(wait)
+            wait = self._user_limiter.acquire(user_id)
+
+        for attempt in range(MAX_RETRY_AFTER_ATTEMPTS):
+            wait = self._chat_throttle.reserve(user_id)
+            if time.monotonic() + wait > deadline:
+                return "leftover"
+            time.sleep(wait)
+
+            if not self._limiter.acquire(deadline):
+                return "leftover"
+
+            try:
+                send(user_id)
+                return "delivered"
+            except RetryAfter as e:
+                # Flood control applies to the whole bot, so every worker backs off
+                print(f"Telegram asked to retry after {e.retry_after}s (user {user_id})")
+                instrumentation.increment(instrumentation.TELEGRAM_RETRY_AFTER)
+                self._limiter.pause(e.retry_after)
+            except Exception as e:
+                if is_bot_configuration_error(e):
+                    print(f"error: Telegram rejected the bot's token: {e}")
+                    stopped.set()
+                    return "leftover"
+                if is_dead_chat_error(e):
+                    print(f"Chat of user {user_id} is gone: {e}")
+                    return "dead"
+                if isinstance(e, NetworkError) and not isinstance(e, BadRequest):
+                    # Timeouts and connection errors, the send is retried later
+                    print(f"Transient error sending message to user {user_id}: {e}")
+                    return "leftover"
+                print(f"Failed to send message to user {user_id}: {e}")
+                return "failed"
+
+        return "leftover"
+
+    # Function to send to every recipient with bounded concurrency. Recipients that
+    # couldn't be sent to before the deadline are returned in `leftover`. Recipients
+    # who recently received a message with the same dedup_key are returned in `skipped`.
+    # Raises BotConfigurationError if Telegram rejected the bot's token.
+    def deliver(self, recipients, send, deadline=None, dedup_key=None):
+        if deadline is None:
+            deadline = time.monotonic() + DELIVERY_DEADLINE_SECONDS
+        stopped = threading.Event()
+
+        futures = [
+            (
+                user_id,
+                instrumentation.submit_in_trace(
+                    self._executor, self._deliver_one, user_id, send, deadline, dedup_key, stopped
+                ),
+            )
+            for user_id in recipients
+        ]
+
+        result = DeliveryResult()
+        for user_id, future in futures:
+            getattr(result, future.result()).append(user_id)
+
+        instrumentation.increment(instrumentation.TELEGRAM_MESSAGES, len(result.delivered))
+        instrumentation.increment(instrumentation.TELEGRAM_FAILURES, len(result.failed))
+        instrumentation.increment(instrumentation.TELEGRAM_DUPLICATES, len(result.skipped))
+        instrumentation.increment(instrumentation.TELEGRAM_DEAD_CHATS, len(result.dead))
+
+        print(
+            f"Delivered {len(result.delivered)} messages, {len(result.failed)} failed, "
+            f"{len(result.dead)} dead chats, {len(result.skipped)} duplicates skipped, "
+            f"{len(result.leftover)} left for retry"
+        )
+
+        if stopped.is_set():
+            raise BotConfigurationError("Telegram rejected the bot's token, check the TOKEN secret")
+        return result
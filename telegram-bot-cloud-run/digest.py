@@ -0,0 +1,79 @@
+from datetime import datetime
+
+from google.cloud import firestore
+
+from common import delivery_state, digest_queue
+from common.proposal import Proposal
+import subscriptions
+
+# Telegram messages are limited to 4096 characters
+MAX_DIGEST_LENGTH = 3800
+
+
+@firestore.transactional
+def _clear_sent_items(transaction, queue_ref, sent_items):
+    snapshot = queue_ref.get(transaction=transaction)
+    remaining = [item for item in (snapshot.to_dict() or {}).get("items", []) if item not in sent_items]
+    transaction.update(queue_ref, {"items": remaining, "pending": bool(remaining)})
+
+
+def build_digest_message(mode, proposals):
+    header = f"Your {mode} digest ({len(proposals)} proposal{'s' if len(proposals) != 1 else ''}):\n"
+    lines = []
+    length = len(header)
+
+    for i, proposal in enumerate(proposals):
+        title_url = f"https://snapshot.org/#/{proposal.space_id}/proposal/{proposal.id}"
+        end_time = datetime.utcfromtimestamp(int(proposal.end)).strftime("%Y-%m-%d %H:%M") if proposal.end else "-"
+        line = (
+            f"\n{i + 1}. [{proposal.title}]({title_url})\n"
+            f"    {proposal.label} | Space: {proposal.space_name} | Ends: {end_time} UTC"
+        )
+
+        if length + len(line) > MAX_DIGEST_LENGTH:
+            lines.append(f"\n...and {len(proposals) - i} more")
+            break
+        lines.append(line)
+        length += len(line)
+
+    return header + "".join(lines)
+
+
+# Function to send every pending digest of a delivery mode, one message per user.
+# Called by Cloud Scheduler once per window.
+def send_digests(db, bot, delivery_engine, mode):
+    queues = {
+        doc.id: doc.to_dict().get("items", [])
+        for doc in db.collection(digest_queue.DIGEST_QUEUE_COLLECTION)
+        .where("mode", "==", mode)
+        .where("pending", "==", True)
+        .stream()
+    }
+    queues = {user_id: items for user_id, items in queues.items() if items}
+    if not queues:
+        print(f"No pending {mode} digests")
+        return None
+
+    # Many users share the same matched events, so load each one once
+    event_ids = sorted(set(item for items in queues.values() for item in items))
+    event_refs = [db.collection(delivery_state.MATCHED_EVENTS_COLLECTION).document(event_id) for event_id in event_ids]
+    proposals = {
+        doc.id: Proposal.from_projection(doc.get("proposal"))
+        for doc in db.get_all(event_refs)
+        if doc.exists and "proposal" in doc.to_dict()
+    }
+
+    def send(user_id):
+        items = queues[user_id]
+        user_proposals = [proposals[item] for item in items if item in proposals]
+        if user_proposals:
+            message = build_digest_message(mode, user_proposals)
+            bot.send_message(chat_id=user_id, text=message, parse_mode='Markdown', disable_web_page_preview=True)
+        _clear_sent_items(db.transaction(), digest_queue.get_queue_ref(db, user_id), set(items))
+
+    result = delivery_engine.deliver(list(queues), send)
+    # Users whose chat is gone are marked inactive, which also drops their digest
+    if result.dead:
+        subscriptions.deactivate_users(db, result.dead)
+    print(f"Sent {len(result.delivered)} {mode} digests covering {len(event_ids)} matched events")
+    return result
@@ -1,26 +1,38 @@
+from __future__ import annotations
+
 import os
 import http
+import threading
 import json
 import base64
 import time
-import openai
 from datetime import datetime
-from google.cloud import firestore, secretmanager
 from flask import Flask, request
 from werkzeug.wrappers import Response
+from common import delivery_state, digest_queue, instrumentation, subscription_index
+from common.clients import get_firestore_client
+from common.proposal import EVENT_TYPES, Proposal
+from common.tickers import ALL_TICKERS, get_ticker_subscriptions, is_known_ticker, normalize_ticker
+from delivery import DeliveryEngine, DELIVERY_DEADLINE_SECONDS, MAX_DELIVERY_WORKERS
+from digest import send_digests
+import subscriptions
+from summaries import summarizer
+from typing import TYPE_CHECKING
 from telegram import Bot, Update
-from telegram.ext import (
-    Dispatcher,
-    Filters,
-    MessageHandler,
-    CallbackContext,
-    CommandHandler,
-)
+from telegram.utils.request import Request
+
+if TYPE_CHECKING:
+    from telegram.ext import CallbackContext
 
 app = Flask(__name__)
 
 
 def start(update: Update, context: CallbackContext):
+    # Users who blocked the bot were marked inactive, restarting it brings their
+    # subscriptions back
+    if subscriptions.reactivate_user(get_firestore_client(), str(update.effective_user.id)):
+        update.message.reply_text("Welcome back! Your subscriptions are active again.")
+
     update.message.reply_text(
         "Welcome to the Crypto Governance Event Notifications bot!\n\n"
         "Subscribe to be notified of governance proposal actions in real-time. "
@@ -29,195 +41,108 @@ def start(update: Update, context: CallbackContext):
         "/subscribe - Subscribe to projects, keywords, and token tickers\n"
         "    To subscribe to projects: /subscribe project project1 project2\n"
         "    To subscribe to keywords: /subscribe keyword keyword1 keyword2\n"
-        "    To subscribe to token tickers: /subscribe ticker\n"
+        "    To subscribe to token tickers: /subscribe ticker UNI AAVE\n"
+        "    To subscribe to all token tickers: /subscribe ticker\n"
         "/unsubscribe - Unsubscribe from projects, keywords, and token tickers\n"
         "    To unsubscribe from projects: /unsubscribe project project1 project2\n"
         "    To unsubscribe from keywords: /unsubscribe keyword keyword1 keyword2\n"
-        "    To unsubscribe from token tickers: /unsubscribe ticker\n"
+        "    To unsubscribe from token tickers: /unsubscribe ticker UNI AAVE\n"
+        "    To unsubscribe from all token tickers: /unsubscribe ticker\n"
         "/list_subscriptions - List your current subscriptions\n"
+        "/delivery - Choose immediate notifications or an hourly or daily digest\n"
+        "    To receive a daily digest: /delivery daily\n"
+        "/events - Choose which proposal events you are notified of (created, start, end, deleted)\n"
+        "    To only be notified of new proposals and results: /events created end\n"
         "/help - Show this help message"
     )
 
 
-def subscribe(update: Update, context: CallbackContext):
-    user_id = str(update.effective_user.id)
-    args = context.args
-    projects = []
-    keywords = []
-    ticker_subscription = None
-
-    if len(args) < 1:
-        update.message.reply_text("Please provide a project, keyword, or ticker.")
-        return
+# Subscription kinds accepted as the first argument of /subscribe and /unsubscribe
+SUBSCRIPTION_KINDS = {
+    "project": subscription_index.PROJECT,
+    "keyword": subscription_index.KEYWORD,
+    "ticker": subscription_index.TICKER,
+}
 
-    if args[0] == "keyword":
-        keywords.extend(args[1:])
-    elif args[0] == "project":
-        projects.extend(args[1:])
-    elif args[0] == "ticker":
-        ticker_subscription = True
-    else:
-        update.message.reply_text("Please provide a project, keyword, or ticker.")
-        return
 
-    if not projects and not keywords and ticker_subscription is None:
-        update.message.reply_text("Please provide a project, keyword, or ticker.")
-        return
+def format_tickers(tickers):
+    return ", ".join("all tickers" if ticker == ALL_TICKERS else ticker for ticker in sorted(tickers))
 
-    # Initialize Firestore
-    db = firestore.Client()
 
-    # Firestore document reference for the user
-    user_doc_ref = db.collection("user_subscriptions").document(user_id)
+def format_terms(kind, terms):
+    names = format_tickers(terms) if kind == subscription_index.TICKER else ", ".join(terms)
+    return f"{kind}{'s' if len(terms) > 1 else ''}: {names}"
 
-    # Check document existence
-    doc = user_doc_ref.get()
-    if not doc.exists:
-        # Document doesn't exist
-        user_doc_ref.set({"keywords": keywords, "projects": projects, "tickers": ticker_subscription})
 
-        response = ""
-        if projects:
-            if len(projects) == 1:
-                response += f"Successfully subscribed to project: {projects[0]}\n"
-            else:
-                response += (
-                    f"Successfully subscribed to projects: {', '.join(projects)}\n"
-                )
-        if keywords:
-            if len(keywords) == 1:
-                response += f"Successfully subscribed to keyword: {keywords[0]}\n"
-            else:
-                response += (
-                    f"Successfully subscribed to keywords: {', '.join(keywords)}\n"
-                )
-        if ticker_subscription is not None:
-            response += f"Successfully subscribed to ticker notifications."
+def parse_subscription_args(args):
+    if len(args) < 1 or args[0] not in SUBSCRIPTION_KINDS:
+        return None, []
 
-        update.message.reply_text(response)
-    else:
-        # Document exists
-        existing_projects = doc.get("projects")
-        existing_keywords = doc.get("keywords")
-        already_subscribed_tickers = doc.get("tickers")
-
-        if existing_projects is None:
-            existing_projects = []
-        if existing_keywords is None:
-            existing_keywords = []
-
-        new_projects = list(set(projects) - set(existing_projects))
-        new_keywords = list(set(keywords) - set(existing_keywords))
-        already_subscribed_projects = list(set(projects) & set(existing_projects))
-        already_subscribed_keywords = list(set(keywords) & set(existing_keywords))
-
-        response = ""
-
-        if new_projects:
-            user_doc_ref.update({"projects": firestore.ArrayUnion(new_projects)})
-            if len(new_projects) == 1:
-                response += f"Successfully subscribed to project: {new_projects[0]}\n"
-            else:
-                response += (
-                    f"Successfully subscribed to projects: {', '.join(new_projects)}\n"
-                )
-
-        if new_keywords:
-            user_doc_ref.update({"keywords": firestore.ArrayUnion(new_keywords)})
-            if len(new_keywords) == 1:
-                response += f"Successfully subscribed to keyword: {new_keywords[0]}\n"
-            else:
-                response += (
-                    f"Successfully subscribed to keywords: {', '.join(new_keywords)}\n"
-                )
-
-        if ticker_subscription is not None and not already_subscribed_tickers:
-            user_doc_ref.update({"tickers": ticker_subscription})
-            response += f"Successfully subscribed to ticker notifications.\n"
-        elif ticker_subscription is not None and already_subscribed_tickers:
-            response += "You are already subscribed to ticker notifications.\n"
-
-        if already_subscribed_projects:
-            if len(already_subscribed_projects) == 1:
-                response += f"You are already subscribed to project: {already_subscribed_projects[0]}\n"
-            else:
-                response += f"You are already subscribed to projects: {', '.join(already_subscribed_projects)}\n"
+    kind = SUBSCRIPTION_KINDS[args[0]]
+    terms = args[1:]
+    if kind == subscription_index.TICKER:
+        terms = [normalize_ticker(ticker) for ticker in terms]
+    return kind, terms
 
-        if already_subscribed_keywords:
-            if len(already_subscribed_keywords) == 1:
-                response += f"You are already subscribed to keyword: {already_subscribed_keywords[0]}\n"
-            else:
-                response += f"You are already subscribed to keywords: {', '.join(already_subscribed_keywords)}\n"
 
-        update.message.reply_text(response)
+def subscribe(update: Update, context: CallbackContext):
+    user_id = str(update.effective_user.id)
+    kind, terms = parse_subscription_args(context.args)
+    response = ""
 
+    if kind == subscription_index.TICKER:
+        # Without any symbols, subscribe to every known ticker
+        if not terms:
+            terms = [ALL_TICKERS]
 
-def unsubscribe(update: Update, context: CallbackContext):
-    user_id = str(update.effective_user.id)
-    args = context.args
-    projects = []
-    keywords = []
-    ticker_subscription = None
+        unknown_tickers = [ticker for ticker in terms if not is_known_ticker(ticker)]
+        if unknown_tickers:
+            terms = [ticker for ticker in terms if is_known_ticker(ticker)]
+            response += f"Unknown tickers: {', '.join(unknown_tickers)}\n"
 
-    if len(args) < 1:
-        update.message.reply_text("Please provide a project, keyword, or ticker.")
+    if not terms:
+        update.message.reply_text(response or "Please provide a project, keyword, or ticker.")
         return
 
-    if args[0] == "keyword":
-        keywords.extend(args[1:])
-    elif args[0] == "project":
-        projects.extend(args[1:])
-    elif args[0] == "ticker":
-        ticker_subscription = False
-    else:
-        update.message.reply_text("Please provide a project, keyword, or ticker.")
-        return
+    # Shared Firestore client
+    db = get_firestore_client()
+
+    # Update the user's subscriptions and the matcher's index in one transaction
+    change = subscriptions.subscribe(db, user_id, kind, terms)
+
+    if change.changed:
+        response += f"Successfully subscribed to {format_terms(kind, change.changed)}\n"
+    if change.unchanged:
+        response += f"You are already subscribed to {format_terms(kind, change.unchanged)}\n"
+
+    update.message.reply_text(response)
+
+
+def unsubscribe(update: Update, context: CallbackContext):
+    user_id = str(update.effective_user.id)
+    kind, terms = parse_subscription_args(context.args)
 
-    if not projects and not keywords and ticker_subscription is None:
+    if kind is None or (not terms and kind != subscription_index.TICKER):
         update.message.reply_text("Please provide a project, keyword, or ticker.")
         return
 
-    # Initialize Firestore
-    db = firestore.Client()
+    # Shared Firestore client
+    db = get_firestore_client()
 
-    # Firestore document reference for the user
-    user_doc_ref = db.collection("user_subscriptions").document(user_id)
+    # Update the user's subscriptions and the matcher's index in one transaction.
+    # "/unsubscribe ticker" removes every ticker subscription.
+    change = subscriptions.unsubscribe(db, user_id, kind, terms or None)
 
-    # Check document existence
-    doc = user_doc_ref.get()
-    if not doc.exists:
+    if not change.user_exists:
         update.message.reply_text("You are not subscribed to any projects, keywords or tickers.")
         return
 
-    existing_projects = doc.get("projects")
-    existing_keywords = doc.get("keywords")
-    already_subscribed_tickers = doc.get("tickers")
-
-    if existing_projects is None:
-        existing_projects = []
-    if existing_keywords is None:
-        existing_keywords = []
-
     response = ""
-
-    for project in projects:
-        if project in existing_projects:
-            user_doc_ref.update({"projects": firestore.ArrayRemove([project])})
-            response += f"Successfully unsubscribed from project: {project}\n"
-        else:
-            response += f"You are not subscribed to project: {project}\n"
-
-    for keyword in keywords:
-        if keyword in existing_keywords:
-            user_doc_ref.update({"keywords": firestore.ArrayRemove([keyword])})
-            response += f"Successfully unsubscribed from keyword: {keyword}\n"
-        else:
-            response += f"You are not subscribed to keyword: {keyword}\n"
-
-    if ticker_subscription is not None and already_subscribed_tickers:
-        user_doc_ref.update({"tickers": ticker_subscription})
-        response += "Successfully unsubscribed from ticker notifications.\n"
-    elif ticker_subscription is not None and not already_subscribed_tickers:
+    if change.changed:
+        response += f"Successfully unsubscribed from {format_terms(kind, change.changed)}\n"
+    if change.unchanged:
+        response += f"You are not subscribed to {format_terms(kind, change.unchanged)}\n"
+    if not change.changed and not change.unchanged:
         response += "You are not subscribed to ticker notifications.\n"
 
     update.message.reply_text(response)
@@ -226,8 +151,8 @@ def unsubscribe(update: Update, context: CallbackContext):
 def list_subscriptions(update: Update, context: CallbackContext):
     user_id = str(update.effective_user.id)
 
-    # Initialize Firestore
-    db = firestore.Client()
+    # Shared Firestore client
+    db = get_firestore_client()
 
     # Firestore document reference for the user
     user_doc_ref = db.collection("user_subscriptions").document(user_id)
@@ -241,7 +166,7 @@ def list_subscriptions(update: Update, context: CallbackContext):
     data = doc.to_dict()
     projects = data.get("projects", [])
     keywords = data.get("keywords", [])
-    tickers = data.get("tickers", None)
+    tickers = get_ticker_subscriptions(data.get("tickers"))
 
     response = ""
     if projects:
@@ -249,13 +174,75 @@ def list_subscriptions(update: Update, context: CallbackContext):
     if keywords:
         response += f"Your current keyword subscriptions: {', '.join(keywords)}\n"
     if tickers:
-        response += "You are currently subscribed to ticker notifications.\n"
+        response += f"Your current ticker subscriptions: {format_tickers(tickers)}\n"
     if not projects and not keywords and not tickers:
         response = "You have no subscriptions."
 
     update.message.reply_text(response)
 
 
+def delivery(update: Update, context: CallbackContext):
+    user_id = str(update.effective_user.id)
+    args = context.args
+
+    # Shared Firestore client
+    db = get_firestore_client()
+
+    if len(args) < 1:
+        update.message.reply_text(
+            f"Your current delivery mode: {subscriptions.get_delivery_mode(db, user_id)}\n"
+            f"To change it: /delivery {' | '.join(digest_queue.DELIVERY_MODES)}"
+        )
+        return
+
+    mode = args[0].lower()
+    if mode not in digest_queue.DELIVERY_MODES:
+        update.message.reply_text(f"Please provide a delivery mode: {', '.join(digest_queue.DELIVERY_MODES)}.")
+        return
+
+    # Update the user's delivery mode and the matcher's index in one transaction
+    previous_mode = subscriptions.set_delivery_mode(db, user_id, mode)
+
+    if previous_mode == mode:
+        update.message.reply_text(f"Your delivery mode is already {mode}.")
+    elif mode == digest_queue.IMMEDIATE:
+        update.message.reply_text("You will now be notified of each matching proposal immediately.")
+    else:
+        update.message.reply_text(f"You will now receive one {mode} digest of your matching proposals.")
+
+
+def events(update: Update, context: CallbackContext):
+    user_id = str(update.effective_user.id)
+    args = [arg.lower() for arg in context.args]
+
+    # Shared Firestore client
+    db = get_firestore_client()
+
+    if len(args) < 1:
+        snapshot = subscriptions.get_user_ref(db, user_id).get()
+        current_types = subscriptions.get_event_types(snapshot.to_dict() if snapshot.exists else {})
+        update.message.reply_text(
+            f"You are notified of these proposal events: {', '.join(current_types) or 'none'}\n"
+            f"To change them: /events {' '.join(EVENT_TYPES)} (or /events all)"
+        )
+        return
+
+    event_types = list(EVENT_TYPES) if args == ["all"] else args
+    unknown = [event_type for event_type in event_types if event_type not in EVENT_TYPES]
+    if unknown:
+        update.message.reply_text(f"Unknown event type: {', '.join(unknown)}. Please choose from: {', '.join(EVENT_TYPES)}.")
+        return
+
+    # Update the user's event types and the matcher's index in one transaction
+    previous_types = subscriptions.set_event_types(db, user_id, event_types)
+
+    chosen = [event_type for event_type in EVENT_TYPES if event_type in event_types]
+    if set(previous_types) == set(chosen):
+        update.message.reply_text(f"You are already notified of these proposal events: {', '.join(chosen)}")
+    else:
+        update.message.reply_text(f"You will now be notified of these proposal events: {', '.join(chosen)}")
+
+
 def help_command(update: Update, context: CallbackContext):
     help_text = (
         "Available commands:\n\n"
@@ -263,27 +250,24 @@ def help_command(update: Update, context: CallbackContext):
         "/subscribe - Subscribe to projects, keywords, and token tickers\n"
         "    To subscribe to projects: /subscribe project project1 project2\n"
         "    To subscribe to keywords: /subscribe keyword keyword1 keyword2\n"
-        "    To subscribe to token tickers: /subscribe ticker\n"
+        "    To subscribe to token tickers: /subscribe ticker UNI AAVE\n"
+        "    To subscribe to all token tickers: /subscribe ticker\n"
         "/unsubscribe - Unsubscribe from projects, keywords, and token tickers\n"
         "    To unsubscribe from projects: /unsubscribe project project1 project2\n"
         "    To unsubscribe from keywords: /unsubscribe keyword keyword1 keyword2\n"
-        "    To unsubscribe from token tickers: /unsubscribe ticker\n"
+        "    To unsubscribe from token tickers: /unsubscribe ticker UNI AAVE\n"
+        "    To unsubscribe from all token tickers: /unsubscribe ticker\n"
         "/list_subscriptions - List your current subscriptions\n"
+        "/delivery - Choose immediate notifications or an hourly or daily digest\n"
+        "    To receive a daily digest: /delivery daily\n"
+        "/events - Choose which proposal events you are notified of (created, start, end, deleted)\n"
+        "    To only be notified of new proposals and results: /events created end\n"
         "/help - Show this help message"
     )
 
     update.message.reply_text(help_text)
 
 
-def get_secret_value(secret_name, version_id="latest"):
-    # GCP project id
-    project_id = 'telegram-governance-bot'
-    client = secretmanager.SecretManagerServiceClient()
-    name = f"projects/{project_id}/secrets/{secret_name}/versions/{version_id}"
-    response = client.access_secret_version(request={"name": name})
-    return response.payload.data.decode("UTF-8")
-
-
 def process_pubsub_message(pubsub_message: dict):
     if isinstance(pubsub_message, dict) and "data" in pubsub_message:
         message = base64.b64decode(pubsub_message["data"]).decode("utf-8").strip()
@@ -294,122 +278,195 @@ def process_pubsub_message(pubsub_message: dict):
         return None
     
 
-def get_openai_summary(body):
-    # Get summary of the proposal body field using OpenAI
-    openai.api_key = get_secret_value("OPENAI_API_KEY")
-
-    for i in range(3):
-        try:
-            response = openai.Completion.create(
-                model="text-davinci-003",
-                prompt="Provide a concise summary of the given content, using no more than 100 words, while accurately conveying its main points and ideas.\n\n" + body,
-                temperature=0,
-                max_tokens=1000,
-                top_p=1,
-                frequency_penalty=0,
-                presence_penalty=0
-            )
-            summary = response.choices[0].text.strip()
-
-            return summary
-
-        except Exception as e:
-            if i < 2:
-                # If the OpenAI request fails, retry after a short delay
-                time.sleep(2)
-            else:
-                # If the OpenAI request fails 3 times, return an error response
-                return f"Error generating summary: {str(e)}"
+def get_proposal_summary(proposal: Proposal):
+    # Summaries are cached by body hash, so redeliveries, other shards and later events
+    # for the same proposal never summarize it again
+    db = get_firestore_client()
 
+    # Matched events only carry a reference to the body, which is stored with the Snapshot event
+    def load_body():
+        if proposal.body is not None:
+            return proposal.body
+        event_doc = db.collection("snapshot_events").document(proposal.id).get()
+        return event_doc.get("body") if event_doc.exists else ""
 
-def format_event(event_data):
-    title = event_data.get('title', {}).get('stringValue')
-    body = event_data.get('body', {}).get('stringValue')
-    start = event_data.get('start', {}).get('integerValue')
-    end = event_data.get('end', {}).get('integerValue')
-    space_map = event_data.get('space', {}).get('mapValue', {}).get('fields', {})
-    space_name = space_map.get('name', {}).get('stringValue')
-    space_id = space_map.get('id', {}).get('stringValue')
-    event_id = event_data.get('id', {}).get('stringValue')
+    return summarizer.get(db, proposal.body_hash, proposal.id, load_body)
 
-    # Get choices and join them into a single string
-    choices_list = event_data.get('choices', {}).get('arrayValue', {}).get('values', [])
-    choices = ", ".join([choice.get('stringValue', '') for choice in choices_list])
-
-    body_summary = get_openai_summary(body)
 
+def format_event(proposal: Proposal):
     formatted_event = {
-        'title': title,
-        'body': body_summary,
-        'start': start,
-        'end': end,
-        'space_name': space_name,
-        'choices': choices,
-        'space_id': space_id,
-        'event_id': event_id,
+        'title': proposal.title,
+        'body': get_proposal_summary(proposal),
+        'start': proposal.start,
+        'end': proposal.end,
+        'space_name': proposal.space_name,
+        'choices': ", ".join(proposal.choices),
+        'space_id': proposal.space_id,
+        'event_id': proposal.id,
+        'label': proposal.label,
     }
     print("formatted_event = ", formatted_event)
     
     return formatted_event
 
 
+def build_message(event):
+    start_time = datetime.utcfromtimestamp(int(event['start'])).strftime("%Y-%m-%d %H:%M")
+    end_time = datetime.utcfromtimestamp(int(event['end'])).strftime("%Y-%m-%d %H:%M")
+
+    # Create a hyperlink for the title
+    title_url = f"https://snapshot.org/#/{event['space_id']}/proposal/{event['event_id']}"
+    title_with_link = f"[{event['title']}]({title_url})"
+
+    return (
+        f"{event['label']}:\n"
+        f"Title: {title_with_link}\n"
+        f"Space: {event['space_name']}\n"
+        f"Summary: {event['body']}\n"
+        f"Choices: {event['choices']}\n"
+        f"Start: {start_time} UTC\n"
+        f"End: {end_time} UTC"
+    )
+
+
+# Bodies shorter than this (e.g. empty test proposals) say too little to tell a repost
+# from a different proposal
+MIN_DEDUP_BODY_LENGTH = 200
+
+
+# Function to get the key of a notification for the delivery engine's duplicate check.
+# Reposts of a proposal in the same space have the same title and body, so a user only
+# gets one of them for each event type. Proposals with a short or unknown body aren't
+# deduplicated.
+def get_dedup_key(proposal: Proposal):
+    if proposal.body_length is None or proposal.body_length < MIN_DEDUP_BODY_LENGTH:
+        return None
+    title = " ".join(proposal.title.lower().split())
+    return f"{proposal.space_id}:{title}:{proposal.body_hash}:{proposal.event}"
+
+
+# Function to deliver a matched event to every recipient that hasn't received it yet.
+# Recipients are claimed with a lease per delivery status document, so a Pub/Sub
+# redelivery or a parallel instance only ever sends to pending recipients. Returns
+# False if some recipients are still pending and the message should be retried.
 def send_telegram_message(message_json: dict):
-    # Initialize Firestore
-    db = firestore.Client()
-
-    # Send a message to the user with the new event for each matched user
-    for user_id, sent_status in message_json["matched_users"].items():
-        # Only send the message if it hasn't been sent to this user yet
-        if not sent_status:
-            try:
-                event = format_event(message_json["event_data"])
-                
-                start_time = datetime.utcfromtimestamp(int(event['start'])).strftime("%Y-%m-%d %H:%M")
-                end_time = datetime.utcfromtimestamp(int(event['end'])).strftime("%Y-%m-%d %H:%M")
-
-                # Create a hyperlink for the title
-                title_url = f"https://snapshot.org/#/{event['space_id']}/proposal/{event['event_id']}"
-                title_with_link = f"[{event['title']}]({title_url})"
-            
-                message = (
-                    f"Proposal Created:\n"
-                    f"Title: {title_with_link}\n"
-                    f"Space: {event['space_name']}\n"
-                    f"Summary: {event['body']}\n"
-                    f"Choices: {event['choices']}\n"
-                    f"Start: {start_time} UTC\n"
-                    f"End: {end_time} UTC"
-                )
-
-                bot.send_message(chat_id=user_id, text=message, parse_mode='Markdown')
-
-                # Assuming you want to update the sent_status in Firestore to True
-                db.collection("matched_events").document(message_json['id']).update({f"matched_users.{user_id}": True})
-
-            except Exception as e:
-                print(f"Failed to send message to user {user_id}: {e}")
-                                    
-
-bot = Bot(token=os.environ["TOKEN"])
-dispatcher = Dispatcher(bot=bot, update_queue=None)
-
-dispatcher.add_handler(CommandHandler("start", start))
-dispatcher.add_handler(CommandHandler("subscribe", subscribe))
-dispatcher.add_handler(CommandHandler("unsubscribe", unsubscribe))
-dispatcher.add_handler(CommandHandler("list_subscriptions", list_subscriptions))
-dispatcher.add_handler(CommandHandler("help", help_command))
+    if "id" not in message_json:
+        print("error: matched event message has no id, dropping it")
+        return True
+
+    # Shared Firestore client
+    db = get_firestore_client()
+
+    event_ref = db.collection(delivery_state.MATCHED_EVENTS_COLLECTION).document(message_json["id"])
+    shard_count = message_json.get("delivery_shards", 0)
+
+    # A work unit covers a single shard of the event's recipients
+    if "shard" in message_json:
+        recipient_doc_refs = [delivery_state.get_shard_doc_ref(event_ref, message_json["shard"])]
+    else:
+        recipient_doc_refs = delivery_state.get_recipient_doc_refs(event_ref, shard_count)
+
+    lease_owner = delivery_state.new_lease_owner()
+    deadline = time.monotonic() + DELIVERY_DEADLINE_SECONDS
+    message = None
+    dedup_key = None
+    complete = True
+
+    for doc_ref in recipient_doc_refs:
+        with instrumentation.span("claim"):
+            recipients = delivery_state.claim_recipients(db, doc_ref, lease_owner)
+        if recipients is None:
+            # Another delivery attempt is working on these recipients
+            complete = False
+            continue
+        if not recipients:
+            continue
+
+        # Format and summarize the event once, then reuse the message for every recipient
+        if message is None:
+            event_doc = event_ref.get()
+            if not event_doc.exists:
+                print(f"error: matched event {event_ref.id} not found")
+                delivery_state.release_recipients(doc_ref, lease_owner)
+                return True
+            event_fields = event_doc.to_dict()
+            if "proposal" in event_fields:
+                proposal = Proposal.from_projection(event_fields["proposal"])
+            else:
+                # Matched events stored before the compact projection was introduced
+                proposal = Proposal.from_firestore_fields(event_fields["event_data"])
+            with instrumentation.span("summarize", proposal_id=proposal.id):
+                event = format_event(proposal)
+                message = build_message(event)
+            dedup_key = get_dedup_key(proposal)
+
+        # Delivery acknowledgements are buffered and written in batches
+        acks = delivery_state.DeliveryAckBuffer(db, event_ref, shard_count)
+
+        def send(user_id):
+            bot.send_message(chat_id=user_id, text=message, parse_mode='Markdown')
+            acks.ack(user_id)
+
+        # Send a message to the user with the new event for each matched user
+        try:
+            with instrumentation.span("send", recipients=len(recipients)):
+                result = delivery_engine.deliver(recipients, send, deadline, dedup_key)
+            # Users who already received the same proposal count as delivered, and so do
+            # users whose chat is gone, they are marked inactive instead
+            for user_id in result.skipped + result.dead:
+                acks.ack(user_id)
+        finally:
+            with instrumentation.span("ack"):
+                acks.flush()
+                delivery_state.release_recipients(doc_ref, lease_owner)
+
+        if result.dead:
+            with instrumentation.span("deactivate", users=len(result.dead)):
+                subscriptions.deactivate_users(db, result.dead)
+
+        if result.leftover:
+            complete = False
+
+    return complete
+
+
+bot = Bot(token=os.environ["TOKEN"], request=Request(con_pool_size=MAX_DELIVERY_WORKERS + 4))
+delivery_engine = DeliveryEngine()
+
+# Command handling needs telegram.ext, which is slow to import. The dispatcher is
+# created on the first command update, so cold starts that only deliver
+# notifications never load it.
+_dispatcher = None
+_dispatcher_lock = threading.Lock()
+
+
+def get_dispatcher():
+    global _dispatcher
+    with _dispatcher_lock:
+        if _dispatcher is None:
+            from telegram.ext import CommandHandler, Dispatcher
+
+            dispatcher = Dispatcher(bot=bot, update_queue=None)
+            dispatcher.add_handler(CommandHandler("start", start))
+            dispatcher.add_handler(CommandHandler("subscribe", subscribe))
+            dispatcher.add_handler(CommandHandler("unsubscribe", unsubscribe))
+            dispatcher.add_handler(CommandHandler("list_subscriptions", list_subscriptions))
+            dispatcher.add_handler(CommandHandler("delivery", delivery))
+            dispatcher.add_handler(CommandHandler("events", events))
+            dispatcher.add_handler(CommandHandler("help", help_command))
+            _dispatcher = dispatcher
+    return _dispatcher
 
 
 @app.post("/")
 def index() -> Response:
-    dispatcher.process_update(Update.de_json(request.get_json(force=True), bot))
+    get_dispatcher().process_update(Update.de_json(request.get_json(force=True), bot))
 
     return "", http.HTTPStatus.NO_CONTENT
 
 
-@app.post("/pubsub")
-def pubsub_endpoint():
-    envelope = request.get_json()
+# Function to handle a Pub/Sub push envelope. Returns the response body and status.
+def handle_pubsub_envelope(envelope):
     if not envelope:
         msg = "no Pub/Sub message received"
         print(f"error: {msg}")
@@ -424,6 +481,91 @@ def pubsub_endpoint():
     message_json = process_pubsub_message(pubsub_message)
 
     if message_json:
-        send_telegram_message(message_json)
+        # Continue the trace started by the webhook for the matched event
+        with instrumentation.trace("delivery", trace_id=message_json.get("trace_id"), matched_event_id=message_json.get("id")):
+            complete = send_telegram_message(message_json)
+        if not complete:
+            # Pending recipients stay pending in Firestore; Pub/Sub redelivers the message later
+            return "Delivery incomplete, retry later", 503
+
+    return '', 204
+
+
+# /digest and /compact only accept requests from Cloud Scheduler, with an OIDC token
+# of this service account for this audience (the service URL). Both must be set.
+SCHEDULER_SERVICE_ACCOUNT = os.environ.get("SCHEDULER_SERVICE_ACCOUNT")
+SCHEDULER_AUDIENCE = os.environ.get("SCHEDULER_AUDIENCE")
+
+_auth_request = None
+
+
+# Function to check the Authorization header of a Cloud Scheduler request. Returns
+# None when the request is allowed, otherwise the response body and status.
+def authorize_scheduler_request(authorization):
+    global _auth_request
+    if not SCHEDULER_SERVICE_ACCOUNT or not SCHEDULER_AUDIENCE:
+        print("error: SCHEDULER_SERVICE_ACCOUNT and SCHEDULER_AUDIENCE must be set to accept scheduled requests")
+        return "Forbidden", 403
+    if not authorization or not authorization.startswith("Bearer "):
+        return "Unauthorized", 401
+
+    # google-auth is only needed for scheduled requests
+    from google.auth.transport import requests as google_requests
+    from google.oauth2 import id_token
+
+    if _auth_request is None:
+        _auth_request = google_requests.Request()
+    try:
+        claims = id_token.verify_oauth2_token(authorization[len("Bearer "):], _auth_request, audience=SCHEDULER_AUDIENCE)
+    except ValueError as e:
+        print(f"error: invalid scheduler token: {e}")
+        return "Unauthorized", 401
+
+    if claims.get("email") != SCHEDULER_SERVICE_ACCOUNT or not claims.get("email_verified"):
+        print(f"error: scheduler token of unexpected account {claims.get('email')}")
+        return "Forbidden", 403
+    return None
+
+
+# Function to handle a digest run for a delivery mode. Returns the response body and status.
+def handle_digest(mode):
+    if mode not in digest_queue.DIGEST_MODES:
+        return f"Bad Request: mode must be one of {', '.join(digest_queue.DIGEST_MODES)}", 400
+
+    with instrumentation.trace("digest", mode=mode):
+        send_digests(get_firestore_client(), bot, delivery_engine, mode)
+
+    return '', 204
+
+
+# Function to handle a compaction run. Returns the response body and status.
+def handle_compact():
+    with instrumentation.trace("compact"):
+        counts = subscriptions.compact_inactive_users(get_firestore_client())
+        for name, value in counts.items():
+            instrumentation.set_attribute(name, value)
+
+    return '', 204
+
+
+@app.post("/pubsub")
+def pubsub_endpoint():
+    return handle_pubsub_envelope(request.get_json())
+
+
+@app.post("/digest")
+def digest_endpoint():
+    # Called by Cloud Scheduler, e.g. /digest?mode=hourly every hour
+    denied = authorize_scheduler_request(request.headers.get("Authorization"))
+    if denied:
+        return denied
+    return handle_digest(request.args.get("mode"))
+
 
-    return '', 204
\ No newline at end of file
+@app.post("/compact")
+def compact_endpoint():
+    # Called by Cloud Scheduler, e.g. once a day
+    denied = authorize_scheduler_request(request.headers.get("Authorization"))
+    if denied:
+        return denied
+    return handle_compact()
@@ -0,0 +1,287 @@
+import datetime
+import json
+import os
+
+from google.cloud import firestore
+
+from common import subscription_index
+from common.digest_queue import DIGEST_MODES, IMMEDIATE, get_queue_ref
+from common.proposal import EVENT_TYPES
+from common.tickers import get_ticker_subscriptions
+
+USER_SUBSCRIPTIONS_COLLECTION = "user_subscriptions"
+
+# Users whose chat is gone are kept, inactive, for this many days in case they come
+# back, then deleted by the compaction
+INACTIVE_RETENTION_DAYS = float(os.environ.get("INACTIVE_RETENTION_DAYS", "30"))
+# Index entries emptied this long ago are deleted by the compaction. Must be longer
+# than the matcher's SUBSCRIPTION_CACHE_MAX_STALENESS, so every cached copy has seen
+# the entry empty.
+EMPTY_INDEX_ENTRY_RETENTION = datetime.timedelta(days=1)
+
+# user_subscriptions field holding each kind of subscription
+SUBSCRIPTION_FIELDS = {
+    subscription_index.PROJECT: "projects",
+    subscription_index.KEYWORD: "keywords",
+    subscription_index.TICKER: "tickers",
+}
+
+
+# Outcome of a subscribe or unsubscribe command
+class SubscriptionChange:
+    def __init__(self, user_exists):
+        self.user_exists = user_exists
+        self.changed = []  # terms subscribed to or unsubscribed from
+        self.unchanged = []  # terms already subscribed to, or not subscribed to
+
+
+def get_user_ref(db, user_id):
+    return db.collection(USER_SUBSCRIPTIONS_COLLECTION).document(user_id)
+
+
+def get_subscribed_terms(user_subscription, kind):
+    if kind == subscription_index.TICKER:
+        return get_ticker_subscriptions(user_subscription.get("tickers"))
+    return list(user_subscription.get(SUBSCRIPTION_FIELDS[kind]) or [])
+
+
+def _index_terms(kind, terms):
+    return set(subscription_index.normalize_term(kind, term) for term in terms)
+
+
+def _update_index(transaction, db, user_id, kind, terms, transform):
+    for term in terms:
+        transaction.set(
+            subscription_index.user_index_doc_ref(db, kind, term, user_id),
+            {
+                "kind": kind,
+                "term": term,
+                "shard": subscription_index.get_index_shard(user_id),
+                "users": transform([user_id]),
+                "updated": firestore.SERVER_TIMESTAMP,
+            },
+            merge=True,
+        )
+
+
+# The user document and every index entry it affects are read and written in one
+# transaction, so a command costs one read and one commit and concurrent commands
+# from the same user can't interleave
+@firestore.transactional
+def _subscribe(transaction, db, user_id, kind, terms):
+    user_ref = get_user_ref(db, user_id)
+    snapshot = user_ref.get(transaction=transaction)
+    user_subscription = snapshot.to_dict() if snapshot.exists else {}
+
+    # Users who were marked inactive are evidently back
+    if user_subscription.get("active") is False:
+        _reactivate_in_transaction(transaction, db, user_id, user_ref, user_subscription)
+
+    existing = get_subscribed_terms(user_subscription, kind)
+    change = SubscriptionChange(snapshot.exists)
+    for term in dict.fromkeys(terms):
+        (change.unchanged if term in existing else change.changed).append(term)
+
+    if change.changed:
+        fields = {SUBSCRIPTION_FIELDS[kind]: existing + change.changed}
+        if not snapshot.exists:
+            fields = {"projects": [], "keywords": [], "tickers": [], **fields}
+        transaction.set(user_ref, fields, merge=True)
+
+        new_index_terms = _index_terms(kind, change.changed) - _index_terms(kind, existing)
+        _update_index(transaction, db, user_id, kind, new_index_terms, firestore.ArrayUnion)
+
+    return change
+
+
+@firestore.transactional
+def _unsubscribe(transaction, db, user_id, kind, terms):
+    user_ref = get_user_ref(db, user_id)
+    snapshot = user_ref.get(transaction=transaction)
+    if not snapshot.exists:
+        return SubscriptionChange(False)
+
+    existing = get_subscribed_terms(snapshot.to_dict(), kind)
+    change = SubscriptionChange(True)
+    # Without any terms, unsubscribe from everything of this kind
+    for term in dict.fromkeys(existing if terms is None else terms):
+        (change.changed if term in existing else change.unchanged).append(term)
+
+    if change.changed:
+        remaining = [term for term in existing if term not in change.changed]
+        transaction.update(user_ref, {SUBSCRIPTION_FIELDS[kind]: remaining})
+
+        # Keywords are indexed in lower case, so keep the ones a remaining keyword still maps to
+        removed_index_terms = _index_terms(kind, change.changed) - _index_terms(kind, remaining)
+        _update_index(transaction, db, user_id, kind, removed_index_terms, firestore.ArrayRemove)
+
+    return change
+
+
+@firestore.transactional
+def _set_delivery_mode(transaction, db, user_id, mode):
+    user_ref = get_user_ref(db, user_id)
+    snapshot = user_ref.get(transaction=transaction)
+    current_mode = (snapshot.to_dict() if snapshot.exists else {}).get("delivery_mode", IMMEDIATE)
+    if current_mode == mode:
+        return current_mode
+
+    transaction.set(user_ref, {"delivery_mode": mode}, merge=True)
+
+    # The matcher finds digest users through the subscription index
+    if current_mode in DIGEST_MODES:
+        _update_index(transaction, db, user_id, subscription_index.DELIVERY, [current_mode], firestore.ArrayRemove)
+    if mode in DIGEST_MODES:
+        _update_index(transaction, db, user_id, subscription_index.DELIVERY, [mode], firestore.ArrayUnion)
+
+    return current_mode
+
+
+# Users without an `events` field are notified of every event type
+def get_event_types(user_subscription):
+    events = user_subscription.get("events")
+    return list(EVENT_TYPES) if events is None else [event_type for event_type in EVENT_TYPES if event_type in events]
+
+
+@firestore.transactional
+def _set_event_types(transaction, db, user_id, event_types):
+    user_ref = get_user_ref(db, user_id)
+    snapshot = user_ref.get(transaction=transaction)
+    current_types = get_event_types(snapshot.to_dict() if snapshot.exists else {})
+    if set(current_types) == set(event_types):
+        return current_types
+
+    transaction.set(user_ref, {"events": [event_type for event_type in EVENT_TYPES if event_type in event_types]}, merge=True)
+
+    # The matcher finds the users who turned an event type off through the subscription index
+    muted = [event_type for event_type in EVENT_TYPES if event_type not in event_types and event_type in current_types]
+    unmuted = [event_type for event_type in EVENT_TYPES if event_type in event_types and event_type not in current_types]
+    _update_index(transaction, db, user_id, subscription_index.MUTED_EVENT, muted, firestore.ArrayUnion)
+    _update_index(transaction, db, user_id, subscription_index.MUTED_EVENT, unmuted, firestore.ArrayRemove)
+
+    return current_types
+
+
+# Function to add an inactive user back to the index entries of all their subscriptions
+def _reactivate_in_transaction(transaction, db, user_id, user_ref, user_subscription):
+    transaction.update(user_ref, {"active": firestore.DELETE_FIELD, "inactive_since": firestore.DELETE_FIELD})
+    for kind, term in subscription_index.get_user_terms(user_subscription):
+        _update_index(transaction, db, user_id, kind, [term], firestore.ArrayUnion)
+
+
+@firestore.transactional
+def _reactivate(transaction, db, user_id):
+    user_ref = get_user_ref(db, user_id)
+    snapshot = user_ref.get(transaction=transaction)
+    if not snapshot.exists or snapshot.to_dict().get("active") is not False:
+        return False
+    _reactivate_in_transaction(transaction, db, user_id, user_ref, snapshot.to_dict())
+    return True
+
+
+# Marking a user inactive removes them from every index entry, so the matcher stops
+# matching them, and drops their pending digest
+@firestore.transactional
+def _deactivate(transaction, db, user_id):
+    user_ref = get_user_ref(db, user_id)
+    snapshot = user_ref.get(transaction=transaction)
+    if not snapshot.exists or snapshot.to_dict().get("active") is False:
+        return False
+
+    transaction.update(user_ref, {"active": False, "inactive_since": firestore.SERVER_TIMESTAMP})
+    for kind, term in subscription_index.get_user_terms(snapshot.to_dict()):
+        _update_index(transaction, db, user_id, kind, [term], firestore.ArrayRemove)
+    transaction.delete(get_queue_ref(db, user_id))
+    return True
+
+
+def subscribe(db, user_id, kind, terms):
+    return _subscribe(db.transaction(), db, user_id, kind, terms)
+
+
+# Function to unsubscribe from terms of a kind, or from all of them if terms is None
+def unsubscribe(db, user_id, kind, terms=None):
+    return _unsubscribe(db.transaction(), db, user_id, kind, terms)
+
+
+# Function to change the user's delivery mode. Returns the previous mode.
+def set_delivery_mode(db, user_id, mode):
+    return _set_delivery_mode(db.transaction(), db, user_id, mode)
+
+
+def get_delivery_mode(db, user_id):
+    snapshot = get_user_ref(db, user_id).get()
+    return (snapshot.to_dict() if snapshot.exists else {}).get("delivery_mode", IMMEDIATE)
+
+
+# Function to choose the event types the user is notified of. Returns the previous ones.
+def set_event_types(db, user_id, event_types):
+    return _set_event_types(db.transaction(), db, user_id, event_types)
+
+
+# Function to mark users whose chat is gone (they blocked the bot or deleted their
+# account) inactive. Returns how many weren't inactive already.
+def deactivate_users(db, user_ids):
+    deactivated = sum(1 for user_id in user_ids if _deactivate(db.transaction(), db, user_id))
+    if deactivated:
+        print(f"Marked {deactivated} users inactive")
+    return deactivated
+
+
+# Function to add a user marked inactive back, e.g. when they start the bot again.
+# Returns True if they were inactive.
+def reactivate_user(db, user_id):
+    return _reactivate(db.transaction(), db, user_id)
+
+
+# Function to delete users that have been inactive for longer than the retention,
+# and index entries nobody is subscribed to anymore. Returns the counts.
+def compact_inactive_users(db, retention_days=INACTIVE_RETENTION_DAYS):
+    now = datetime.datetime.now(datetime.timezone.utc)
+    user_cutoff = now - datetime.timedelta(days=retention_days)
+    # inactive_users counts the users still kept inactive after the compaction
+    counts = {"inactive_users": 0, "deleted_users": 0, "deleted_index_entries": 0}
+
+    expired = []
+    for doc in db.collection(USER_SUBSCRIPTIONS_COLLECTION).where("active", "==", False).stream():
+        counts["inactive_users"] += 1
+        inactive_since = doc.to_dict().get("inactive_since")
+        if inactive_since is not None and inactive_since < user_cutoff:
+            expired.append(doc)
+
+    # They were removed from the index and their digest when marked inactive, so only
+    # their own document is left. A concurrent reactivation is kept.
+    for doc in expired:
+        if _delete_inactive_user(db.transaction(), doc.reference):
+            counts["deleted_users"] += 1
+
+    counts["inactive_users"] -= counts["deleted_users"]
+
+    # A user may subscribe to an empty entry's term in the meantime, so every entry is
+    # checked again in the transaction deleting it
+    index_cutoff = now - EMPTY_INDEX_ENTRY_RETENTION
+    for doc in db.collection(subscription_index.INDEX_COLLECTION).where("users", "==", []).stream():
+        updated = doc.to_dict().get("updated")
+        if updated is not None and updated < index_cutoff and _delete_empty_index_entry(db.transaction(), doc.reference):
+            counts["deleted_index_entries"] += 1
+
+    print(json.dumps({"message": "compacted inactive users", **counts}))
+    return counts
+
+
+@firestore.transactional
+def _delete_inactive_user(transaction, user_ref):
+    snapshot = user_ref.get(transaction=transaction)
+    if not snapshot.exists or snapshot.to_dict().get("active") is not False:
+        return False
+    transaction.delete(user_ref)
+    return True
+
+
+@firestore.transactional
+def _delete_empty_index_entry(transaction, entry_ref):
+    snapshot = entry_ref.get(transaction=transaction)
+    if not snapshot.exists or snapshot.to_dict().get("users"):
+        return False
+    transaction.delete(entry_ref)
+    return True
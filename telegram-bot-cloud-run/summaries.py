@@ -0,0 +1,220 @@
+import os
+import re
+import threading
+import time
+from collections import Counter, OrderedDict
+from concurrent.futures import Future
+
+from common import instrumentation
+from common.clients import get_openai_client
+
+SUMMARIES_COLLECTION = "proposal_summaries"
+
+SUMMARY_PROMPT = "Provide a concise summary of the given content, using no more than 100 words, while accurately conveying its main points and ideas.\n\n"
+COMBINE_PROMPT = "The following are summaries of consecutive parts of one proposal. Combine them into a single concise summary of no more than 100 words.\n\n"
+
+# Seconds to wait for a completion before falling back to the extractive summary
+OPENAI_TIMEOUT_SECONDS = float(os.environ.get("OPENAI_TIMEOUT_SECONDS", "20"))
+# Seconds to wait for all the completions of one summary, chunked bodies need several
+OPENAI_TOTAL_TIMEOUT_SECONDS = float(os.environ.get("OPENAI_TOTAL_TIMEOUT_SECONDS", "30"))
+
+# text-davinci-003 has a 4097 token context, shared with the 1000 token completion.
+# At roughly 4 characters per token a chunk of this size leaves enough room.
+MAX_CHUNK_CHARS = int(os.environ.get("SUMMARY_MAX_CHUNK_CHARS", "10000"))
+# Longer bodies are summarized in chunks and the rest is cut off
+MAX_CHUNKS = int(os.environ.get("SUMMARY_MAX_CHUNKS", "4"))
+
+# Summaries kept in memory, by body hash
+SUMMARY_CACHE_SIZE = int(os.environ.get("SUMMARY_CACHE_SIZE", "1000"))
+# Fallback summaries are only kept in memory, and only this long, so OpenAI is tried
+# again once it has recovered
+FALLBACK_TTL_SECONDS = float(os.environ.get("SUMMARY_FALLBACK_TTL_SECONDS", "300"))
+
+EXTRACTIVE_SUMMARY_WORDS = 100
+
+STOP_WORDS = frozenset(
+    "a an and are as at be been but by can for from has have if in into is it its of on or our "
+    "that the their there these this to was we were which will with would you your".split()
+)
+
+
+# Function to split a body into chunks of at most max_chars, on paragraph boundaries where possible
+def split_into_chunks(text, max_chars=MAX_CHUNK_CHARS, max_chunks=MAX_CHUNKS):
+    chunks = []
+    current = ""
+    for paragraph in re.split(r"\n\s*\n", text):
+        while len(paragraph) > max_chars:
+            # A single paragraph longer than a chunk is cut into pieces
+            if current:
+                chunks.append(current)
+                current = ""
+            chunks.append(paragraph[:max_chars])
+            paragraph = paragraph[max_chars:]
+        if current and len(current) + len(paragraph) + 2 > max_chars:
+            chunks.append(current)
+            current = ""
+        current = f"{current}\n\n{paragraph}" if current else paragraph
+        if len(chunks) >= max_chunks:
+            break
+    if current:
+        chunks.append(current)
+    return [chunk for chunk in chunks if chunk.strip()][:max_chunks]
+
+
+# Function to build a summary locally, from the sentences with the most frequent words
+def extractive_summary(text, max_words=EXTRACTIVE_SUMMARY_WORDS):
+    # Drop markdown images and links' targets, they are noise in a Telegram message
+    text = re.sub(r"!\[[^\]]*\]\([^)]*\)", " ", text)
+    text = re.sub(r"\[([^\]]*)\]\([^)]*\)", r"\1", text)
+    sentences = [sentence.strip() for sentence in re.split(r"(?<=[.!?])\s+|\n+", text) if sentence.strip()]
+    if not sentences:
+        return ""
+
+    frequencies = Counter(
+        word for word in re.findall(r"[a-z0-9']+", text.lower()) if word not in STOP_WORDS
+    )
+
+    def score(sentence):
+        words = [word for word in re.findall(r"[a-z0-9']+", sentence.lower()) if word not in STOP_WORDS]
+        return sum(frequencies[word] for word in words) / (len(words) + 1)
+
+    ranked = sorted(range(len(sentences)), key=lambda i: score(sentences[i]), reverse=True)
+    chosen = []
+    seen = set()
+    word_count = 0
+    for i in ranked:
+        length = len(sentences[i].split())
+        if sentences[i] in seen or (chosen and word_count + length > max_words):
+            continue
+        chosen.append(i)
+        seen.add(sentences[i])
+        word_count += length
+        if word_count >= max_words:
+            break
+
+    summary = " ".join(sentences[i].lstrip("#*- ").strip() for i in sorted(chosen))
+    words = summary.split()
+    if len(words) > max_words:
+        summary = " ".join(words[:max_words]) + "..."
+    return summary
+
+
+# Function to get a completion from OpenAI
+def get_openai_completion(prompt, timeout=OPENAI_TIMEOUT_SECONDS):
+    openai = get_openai_client()
+    response = openai.Completion.create(
+        model="text-davinci-003",
+        prompt=prompt,
+        temperature=0,
+        max_tokens=1000,
+        top_p=1,
+        frequency_penalty=0,
+        presence_penalty=0,
+        request_timeout=timeout,
+    )
+    usage = getattr(response, "usage", None)
+    if usage is not None:
+        instrumentation.increment(instrumentation.OPENAI_TOKENS, usage["total_tokens"])
+    return response.choices[0].text.strip()
+
+
+# Function to summarize a body with OpenAI. Long bodies are summarized in chunks,
+# and the chunk summaries combined. Raises TimeoutError once the completions took
+# longer than total_timeout altogether.
+def get_openai_summary(body, total_timeout=OPENAI_TOTAL_TIMEOUT_SECONDS):
+    deadline = time.monotonic() + total_timeout
+
+    def complete(prompt):
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise TimeoutError(f"Summary not done within {total_timeout} seconds")
+        return get_openai_completion(prompt, timeout=min(OPENAI_TIMEOUT_SECONDS, remaining))
+
+    chunks = split_into_chunks(body)
+    if len(chunks) <= 1:
+        return complete(SUMMARY_PROMPT + body)
+
+    chunk_summaries = [complete(SUMMARY_PROMPT + chunk) for chunk in chunks]
+    return complete(COMBINE_PROMPT + "\n\n".join(chunk_summaries))
+
+
+# Summaries of proposal bodies, keyed by the body's content hash. Summaries are kept
+# in memory and in Firestore, and concurrent requests for the same body share one
+# summarization. When OpenAI fails the summary is extracted locally instead.
+class Summarizer:
+    def __init__(self, cache_size=SUMMARY_CACHE_SIZE, fallback_ttl=FALLBACK_TTL_SECONDS, summarize=get_openai_summary):
+        self.cache_size = cache_size
+        self.fallback_ttl = fallback_ttl
+        self.summarize = summarize
+        self._cache = OrderedDict()  # body hash -> (summary, expires_at or None)
+        self._pending = {}  # body hash -> Future, for summaries in progress
+        self._lock = threading.Lock()
+
+    def _get_cached(self, body_hash):
+        with self._lock:
+            entry = self._cache.get(body_hash)
+            if entry is None:
+                return None
+            summary, expires_at = entry
+            if expires_at is not None and time.monotonic() >= expires_at:
+                del self._cache[body_hash]
+                return None
+            self._cache.move_to_end(body_hash)
+            return summary
+
+    def _set_cached(self, body_hash, summary, ttl=None):
+        with self._lock:
+            self._cache[body_hash] = (summary, time.monotonic() + ttl if ttl is not None else None)
+            self._cache.move_to_end(body_hash)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def _load_or_summarize(self, db, body_hash, proposal_id, load_body):
+        summary_ref = db.collection(SUMMARIES_COLLECTION).document(body_hash)
+        doc = summary_ref.get()
+        if doc.exists:
+            summary = doc.get("summary")
+            self._set_cached(body_hash, summary)
+            return summary
+
+        body = load_body()
+        try:
+            summary = self.summarize(body)
+        except Exception as e:
+            print(f"Failed to summarize proposal {proposal_id} with OpenAI, using an extractive summary: {e}")
+            instrumentation.increment(instrumentation.SUMMARY_FALLBACKS)
+            summary = extractive_summary(body)
+            self._set_cached(body_hash, summary, ttl=self.fallback_ttl)
+            return summary
+
+        summary_ref.set({"proposal_id": proposal_id, "body_hash": body_hash, "summary": summary})
+        self._set_cached(body_hash, summary)
+        return summary
+
+    # Function to get the summary of a proposal body. load_body is only called when the
+    # summary isn't cached yet, matched events don't carry the body.
+    def get(self, db, body_hash, proposal_id, load_body):
+        summary = self._get_cached(body_hash)
+        if summary is not None:
+            return summary
+
+        with self._lock:
+            future = self._pending.get(body_hash)
+            leader = future is None
+            if leader:
+                future = Future()
+                self._pending[body_hash] = future
+
+        if leader:
+            try:
+                future.set_result(self._load_or_summarize(db, body_hash, proposal_id, load_body))
+            except Exception as e:
+                future.set_exception(e)
+            finally:
+                with self._lock:
+                    del self._pending[body_hash]
+
+        return future.result()
+
+
+summarizer = Summarizer()
@@ -0,0 +1,14 @@
+import os
+import sys
+
+# The services are deployed from their own directories, so their modules import each
+# other (and the shared common package) as top-level modules
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for path in (ROOT, os.path.join(ROOT, "process-events-cloud-function"), os.path.join(ROOT, "telegram-bot-cloud-run")):
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+# Service modules talk to the in-process fakes instead of Google Cloud
+from benchmarks import fakes  # noqa: E402
+
+fakes.install()
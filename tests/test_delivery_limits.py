@@ -0,0 +1,199 @@
+import types
+
+import pytest
+
+from telegram.error import BadRequest, InvalidToken, TimedOut, Unauthorized
+
+import delivery
+from delivery import (
+    BotConfigurationError,
+    DeliveryEngine,
+    RateLimiter,
+    RecentDeliveries,
+    UserRateLimiter,
+    is_bot_configuration_error,
+    is_dead_chat_error,
+)
+
+
+# Stand-in for the time module: monotonic() only moves when sleep() or advance() is called
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+        self.slept = []
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.slept.append(seconds)
+        self.now += seconds
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(delivery, "time", types.SimpleNamespace(monotonic=clock.monotonic, sleep=clock.sleep))
+    return clock
+
+
+def test_rate_limiter_burst_then_refill(clock):
+    limiter = RateLimiter(rate=10, burst=5)
+    for _ in range(5):
+        assert limiter.acquire(deadline=clock.now)
+    assert clock.slept == []
+
+    # The bucket is empty, the next token takes a tenth of a second to refill
+    assert limiter.acquire(deadline=clock.now + 1)
+    assert clock.slept == [pytest.approx(0.1)]
+
+    # Refills up to the burst size only
+    clock.advance(60)
+    for _ in range(5):
+        assert limiter.acquire(deadline=clock.now)
+    assert not limiter.acquire(deadline=clock.now)
+
+
+def test_rate_limiter_gives_up_at_the_deadline_without_waiting(clock):
+    limiter = RateLimiter(rate=1)
+    assert limiter.acquire(deadline=clock.now)
+    assert not limiter.acquire(deadline=clock.now + 0.5)
+    assert clock.slept == []
+    assert limiter.acquire(deadline=clock.now + 1)
+
+
+def test_rate_limiter_below_one_message_per_second(clock):
+    # e.g. the global budget split across more instances than messages per second
+    limiter = RateLimiter(rate=25 / 50)
+    assert limiter.acquire(deadline=clock.now)
+    assert limiter.acquire(deadline=clock.now + 5)
+    assert clock.slept == [pytest.approx(2)]
+    assert not limiter.acquire(deadline=clock.now + 1)
+
+
+def test_rate_limiter_pause(clock):
+    limiter = RateLimiter(rate=100, burst=100)
+    limiter.pause(5)
+    assert not limiter.acquire(deadline=clock.now + 4)
+    assert limiter.acquire(deadline=clock.now + 6)
+    assert sum(clock.slept) == pytest.approx(5)
+
+    # A shorter pause doesn't cut a longer one short
+    limiter.pause(5)
+    limiter.pause(1)
+    assert not limiter.acquire(deadline=clock.now + 4)
+
+
+def test_user_rate_limiter_burst_and_refill(clock):
+    limiter = UserRateLimiter(rate_per_minute=6, burst=3)
+    assert [limiter.acquire("1") for _ in range(3)] == [0.0, 0.0, 0.0]
+
+    # One token every 10 seconds
+    assert limiter.acquire("1") == pytest.approx(10)
+    clock.advance(4)
+    assert limiter.acquire("1") == pytest.approx(6)
+    clock.advance(6)
+    assert limiter.acquire("1") == 0.0
+    assert limiter.acquire("1") == pytest.approx(10)
+
+
+def test_user_rate_limiter_buckets_are_per_user(clock):
+    limiter = UserRateLimiter(rate_per_minute=6, burst=1)
+    assert limiter.acquire("1") == 0.0
+    assert limiter.acquire("1") > 0
+    assert limiter.acquire("2") == 0.0
+
+
+def test_user_rate_limiter_waiting_doesnt_take_a_token(clock):
+    limiter = UserRateLimiter(rate_per_minute=60, burst=1)
+    assert limiter.acquire("1") == 0.0
+    for _ in range(5):
+        assert limiter.acquire("1") == pytest.approx(1)
+    clock.advance(1)
+    assert limiter.acquire("1") == 0.0
+
+
+def test_user_rate_limiter_turned_off(clock):
+    limiter = UserRateLimiter(rate_per_minute=0, burst=1)
+    assert all(limiter.acquire("1") == 0.0 for _ in range(100))
+
+
+def test_recent_deliveries_expire_after_the_window(clock):
+    recent = RecentDeliveries(window=60, max_size=100)
+    assert recent.claim("1", "proposal")
+    assert not recent.claim("1", "proposal")
+    assert recent.claim("2", "proposal")
+    assert recent.claim("1", "other proposal")
+
+    clock.advance(59)
+    assert not recent.claim("1", "proposal")
+    clock.advance(1)
+    assert recent.claim("1", "proposal")
+
+
+def test_recent_deliveries_release(clock):
+    recent = RecentDeliveries(window=60, max_size=100)
+    assert recent.claim("1", "proposal")
+    recent.release("1", "proposal")
+    assert recent.claim("1", "proposal")
+    recent.release("1", "unknown")
+
+
+def test_recent_deliveries_drop_the_oldest_when_full(clock):
+    recent = RecentDeliveries(window=60, max_size=3)
+    for user_id in "1234":
+        assert recent.claim(user_id, "proposal")
+        clock.advance(1)
+
+    assert len(recent._expires) == 3
+    assert recent.claim("1", "proposal")
+    assert not recent.claim("4", "proposal")
+
+
+def test_send_error_classification():
+    # python-telegram-bot raises Unauthorized for both 401 and 403
+    assert is_bot_configuration_error(Unauthorized("Unauthorized"))
+    assert is_bot_configuration_error(InvalidToken())
+
+    blocked = Unauthorized("Forbidden: bot was blocked by the user")
+    assert is_dead_chat_error(blocked) and not is_bot_configuration_error(blocked)
+    deactivated = Unauthorized("Forbidden: user is deactivated")
+    assert is_dead_chat_error(deactivated) and not is_bot_configuration_error(deactivated)
+    assert is_dead_chat_error(BadRequest("Chat not found"))
+
+    cant_initiate = Unauthorized("Forbidden: bot can't initiate conversation with a user")
+    assert not is_dead_chat_error(cant_initiate) and not is_bot_configuration_error(cant_initiate)
+    kicked = Unauthorized("Forbidden: bot was kicked from the group chat")
+    assert not is_dead_chat_error(kicked) and not is_bot_configuration_error(kicked)
+    assert not is_bot_configuration_error(TimedOut())
+
+
+def test_per_chat_403_only_fails_that_recipient():
+    errors = {
+        "2": Unauthorized("Forbidden: bot can't initiate conversation with a user"),
+        "3": Unauthorized("Forbidden: bot was blocked by the user"),
+        "4": TimedOut(),
+    }
+
+    def send(user_id):
+        if user_id in errors:
+            raise errors[user_id]
+
+    engine = DeliveryEngine(max_workers=2, messages_per_second=1000, per_chat_interval=0, user_messages_per_minute=0)
+    result = engine.deliver(["1", "2", "3", "4", "5"], send)
+    assert sorted(result.delivered) == ["1", "5"]
+    assert result.failed == ["2"]
+    assert result.dead == ["3"]
+    assert result.leftover == ["4"]
+
+
+def test_bad_token_stops_the_delivery():
+    def send(user_id):
+        raise Unauthorized("Unauthorized")
+
+    engine = DeliveryEngine(max_workers=2, messages_per_second=1000, per_chat_interval=0, user_messages_per_minute=0)
+    with pytest.raises(BotConfigurationError):
+        engine.deliver(["1", "2", "3"], send)
@@ -0,0 +1,83 @@
+import random
+import re
+
+import keyword_matcher
+from keyword_matcher import KeywordMatcher, get_keyword_matcher
+
+
+# Reference implementation: look for every keyword separately
+def naive_find(keywords, text, word_boundaries=False):
+    found = set()
+    for keyword in keywords:
+        if not keyword:
+            continue
+        if word_boundaries:
+            # A keyword edge next to a word character must itself be a non-word character
+            pattern = (r"(?<!\w)" if re.match(r"\w", keyword[0]) else "") + re.escape(keyword)
+            pattern += r"(?!\w)" if re.match(r"\w", keyword[-1]) else ""
+            if re.search(pattern, text):
+                found.add(keyword)
+        elif keyword in text:
+            found.add(keyword)
+    return found
+
+
+def test_finds_overlapping_keywords():
+    matcher = KeywordMatcher(["he", "she", "his", "hers"])
+    assert matcher.find("ushers") == {"he", "she", "hers"}
+    assert matcher.find("this") == {"his"}
+    assert matcher.find("nothing here") == {"he"}
+
+
+def test_keyword_inside_another_keyword():
+    matcher = KeywordMatcher(["treasury", "treasury grant", "grant", "ant"])
+    assert matcher.find("a treasury grant") == {"treasury", "treasury grant", "grant", "ant"}
+
+
+def test_empty_keywords_and_text():
+    assert KeywordMatcher([]).find("anything") == set()
+    assert KeywordMatcher(["", "dao"]).find("dao") == {"dao"}
+    assert KeywordMatcher(["dao"]).find("") == set()
+
+
+def test_word_boundaries():
+    matcher = KeywordMatcher(["uni", "aave v3", "l2"], word_boundaries=True)
+    assert matcher.find("unicorn and community") == set()
+    assert matcher.find("uni") == {"uni"}
+    assert matcher.find("vote on uni, then aave v3.") == {"uni", "aave v3"}
+    assert matcher.find("(uni)") == {"uni"}
+    assert matcher.find("aave v30") == set()
+    assert matcher.find("l2_fees") == set()
+    assert matcher.find("l2-fees on l2") == {"l2"}
+
+
+def test_word_boundaries_keep_searching_after_a_rejected_occurrence():
+    matcher = KeywordMatcher(["uni"], word_boundaries=True)
+    assert matcher.find("unicorn uni") == {"uni"}
+
+
+def test_keywords_with_punctuation_edges_and_word_boundaries():
+    matcher = KeywordMatcher(["$uni", "c++"], word_boundaries=True)
+    assert matcher.find("buy $uni now") == {"$uni"}
+    assert matcher.find("a$uni") == {"$uni"}
+    assert matcher.find("$unicorn") == set()
+    assert matcher.find("written in c++") == {"c++"}
+
+
+def test_matches_naive_scan():
+    rng = random.Random(1)
+    alphabet = "ab c"
+    for _ in range(300):
+        keywords = {"".join(rng.choice(alphabet) for _ in range(rng.randint(1, 4))) for _ in range(rng.randint(1, 8))}
+        text = "".join(rng.choice(alphabet) for _ in range(rng.randint(0, 40)))
+        for word_boundaries in (False, True):
+            matcher = KeywordMatcher(keywords, word_boundaries)
+            assert matcher.find(text) == naive_find(keywords, text, word_boundaries), (keywords, text, word_boundaries)
+
+
+def test_cached_matcher_is_rebuilt_when_keywords_change(monkeypatch):
+    monkeypatch.setattr(keyword_matcher, "_cached_matcher", None)
+    first = get_keyword_matcher({"dao", "grant"})
+    assert get_keyword_matcher(["grant", "dao"]) is first
+    assert get_keyword_matcher({"dao"}) is not first
+    assert get_keyword_matcher({"dao"}, word_boundaries=True).word_boundaries
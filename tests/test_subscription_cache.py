@@ -0,0 +1,76 @@
+import pytest
+
+from benchmarks import fakes
+from common import subscription_index
+from subscription_cache import SubscriptionCache
+
+
+@pytest.fixture
+def db():
+    return fakes.FakeFirestore()
+
+
+def add_entry(db, kind, term, users, shard=0):
+    subscription_index.index_doc_ref(db, kind, term, shard).set({
+        "kind": kind, "term": term, "shard": shard, "users": users, "updated": fakes.SERVER_TIMESTAMP,
+    })
+
+
+# Function to make the next query over the index fail after `after` documents
+def fail_next_stream(monkeypatch, after):
+    original = fakes.Query.stream
+
+    def stream(self, transaction=None):
+        monkeypatch.setattr(fakes.Query, "stream", original)
+        for i, doc in enumerate(original(self)):
+            if i == after:
+                raise RuntimeError("stream broken")
+            yield doc
+
+    monkeypatch.setattr(fakes.Query, "stream", stream)
+
+
+def test_full_reload_and_incremental_refresh(db):
+    add_entry(db, subscription_index.PROJECT, "dao.eth", ["1", "2"])
+    add_entry(db, subscription_index.KEYWORD, "grant", ["3"])
+    cache = SubscriptionCache()
+    cache.refresh(db)
+    assert cache.get_term_subscribers(subscription_index.PROJECT, "dao.eth") == {"1", "2"}
+
+    add_entry(db, subscription_index.PROJECT, "dao.eth", ["2", "4"], shard=1)
+    add_entry(db, subscription_index.KEYWORD, "grant", [])
+    cache.refresh(db)
+    assert cache.get_term_subscribers(subscription_index.PROJECT, "dao.eth") == {"1", "2", "4"}
+    assert cache.get_kind_subscribers(subscription_index.KEYWORD) == {}
+
+
+def test_failed_first_load_is_retried_in_full(db, monkeypatch):
+    add_entry(db, subscription_index.PROJECT, "a.eth", ["1"])
+    add_entry(db, subscription_index.PROJECT, "b.eth", ["2"])
+    cache = SubscriptionCache()
+
+    fail_next_stream(monkeypatch, after=1)
+    with pytest.raises(RuntimeError):
+        cache.refresh(db)
+    assert cache.get_kind_subscribers(subscription_index.PROJECT) == {}
+
+    cache.refresh(db)
+    assert set(cache.get_kind_subscribers(subscription_index.PROJECT)) == {"a.eth", "b.eth"}
+
+
+def test_failed_stale_reload_keeps_the_previous_copy(db, monkeypatch):
+    add_entry(db, subscription_index.PROJECT, "a.eth", ["1"])
+    add_entry(db, subscription_index.PROJECT, "b.eth", ["2"])
+    cache = SubscriptionCache(max_staleness=-1)
+    cache.refresh(db)
+
+    fail_next_stream(monkeypatch, after=1)
+    with pytest.raises(RuntimeError):
+        cache.refresh(db)
+    assert set(cache.get_kind_subscribers(subscription_index.PROJECT)) == {"a.eth", "b.eth"}
+
+    # The next refresh is a full reload again, not an incremental one over a partial copy
+    cache.max_staleness = 3600
+    add_entry(db, subscription_index.PROJECT, "c.eth", ["3"])
+    cache.refresh(db)
+    assert set(cache.get_kind_subscribers(subscription_index.PROJECT)) == {"a.eth", "b.eth", "c.eth"}
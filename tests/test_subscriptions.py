@@ -0,0 +1,188 @@
+import datetime
+
+import pytest
+
+import subscriptions
+from benchmarks import fakes
+from common import subscription_index
+from common.digest_queue import DAILY, HOURLY, IMMEDIATE, get_queue_ref
+from common.tickers import ALL_TICKERS
+
+PROJECT = subscription_index.PROJECT
+KEYWORD = subscription_index.KEYWORD
+TICKER = subscription_index.TICKER
+DELIVERY = subscription_index.DELIVERY
+MUTED_EVENT = subscription_index.MUTED_EVENT
+
+
+@pytest.fixture
+def db():
+    return fakes.FakeFirestore()
+
+
+# Function to get the users of an index term, across its shards
+def index_users(db, kind, term):
+    users = set()
+    query = db.collection(subscription_index.INDEX_COLLECTION).where("kind", "==", kind).where("term", "==", term)
+    for doc in query.stream():
+        users.update(doc.to_dict()["users"])
+    return users
+
+
+def user_doc(db, user_id):
+    return subscriptions.get_user_ref(db, user_id).get().to_dict()
+
+
+def test_subscribe_creates_the_user_and_index_entries(db):
+    change = subscriptions.subscribe(db, "1", PROJECT, ["dao.eth", "other.eth", "dao.eth"])
+    assert not change.user_exists
+    assert change.changed == ["dao.eth", "other.eth"]
+    assert user_doc(db, "1") == {"projects": ["dao.eth", "other.eth"], "keywords": [], "tickers": []}
+    assert index_users(db, PROJECT, "dao.eth") == {"1"}
+    assert index_users(db, PROJECT, "other.eth") == {"1"}
+
+    change = subscriptions.subscribe(db, "1", PROJECT, ["dao.eth", "new.eth"])
+    assert change.user_exists
+    assert (change.changed, change.unchanged) == (["new.eth"], ["dao.eth"])
+    assert user_doc(db, "1")["projects"] == ["dao.eth", "other.eth", "new.eth"]
+
+
+def test_index_entries_are_sharded_by_user(db):
+    user_ids = [str(i) for i in range(40)]
+    for user_id in user_ids:
+        subscriptions.subscribe(db, user_id, PROJECT, ["dao.eth"])
+
+    entries = list(db.collection(subscription_index.INDEX_COLLECTION).stream())
+    assert len(entries) > 1
+    for entry in entries:
+        entry = entry.to_dict()
+        assert all(subscription_index.get_index_shard(user_id) == entry["shard"] for user_id in entry["users"])
+    assert index_users(db, PROJECT, "dao.eth") == set(user_ids)
+
+
+def test_unsubscribe(db):
+    subscriptions.subscribe(db, "1", PROJECT, ["dao.eth", "other.eth"])
+    change = subscriptions.unsubscribe(db, "1", PROJECT, ["dao.eth", "unknown.eth"])
+    assert (change.changed, change.unchanged) == (["dao.eth"], ["unknown.eth"])
+    assert user_doc(db, "1")["projects"] == ["other.eth"]
+    assert index_users(db, PROJECT, "dao.eth") == set()
+    assert index_users(db, PROJECT, "other.eth") == {"1"}
+
+    # Without terms, from everything of the kind
+    change = subscriptions.unsubscribe(db, "1", PROJECT)
+    assert change.changed == ["other.eth"]
+    assert index_users(db, PROJECT, "other.eth") == set()
+
+    assert not subscriptions.unsubscribe(db, "2", PROJECT, ["dao.eth"]).user_exists
+
+
+def test_keywords_are_indexed_case_insensitively(db):
+    subscriptions.subscribe(db, "1", KEYWORD, ["Grant", "grant"])
+    assert user_doc(db, "1")["keywords"] == ["Grant", "grant"]
+    assert index_users(db, KEYWORD, "grant") == {"1"}
+
+    # "grant" still maps to the same index term
+    subscriptions.unsubscribe(db, "1", KEYWORD, ["Grant"])
+    assert index_users(db, KEYWORD, "grant") == {"1"}
+
+    subscriptions.unsubscribe(db, "1", KEYWORD, ["grant"])
+    assert index_users(db, KEYWORD, "grant") == set()
+
+
+def test_ticker_subscriptions(db):
+    subscriptions.subscribe(db, "1", TICKER, ["UNI"])
+    subscriptions.subscribe(db, "2", TICKER, [ALL_TICKERS])
+    assert index_users(db, TICKER, "UNI") == {"1"}
+    assert index_users(db, TICKER, ALL_TICKERS) == {"2"}
+
+    # Subscriptions stored as a boolean for "all tickers"
+    subscriptions.get_user_ref(db, "3").set({"projects": [], "keywords": [], "tickers": True})
+    assert subscriptions.unsubscribe(db, "3", TICKER).changed == [ALL_TICKERS]
+    assert user_doc(db, "3")["tickers"] == []
+
+
+def test_delivery_mode(db):
+    assert subscriptions.get_delivery_mode(db, "1") == IMMEDIATE
+    assert subscriptions.set_delivery_mode(db, "1", HOURLY) == IMMEDIATE
+    assert index_users(db, DELIVERY, HOURLY) == {"1"}
+
+    assert subscriptions.set_delivery_mode(db, "1", DAILY) == HOURLY
+    assert index_users(db, DELIVERY, HOURLY) == set()
+    assert index_users(db, DELIVERY, DAILY) == {"1"}
+    assert subscriptions.get_delivery_mode(db, "1") == DAILY
+
+    assert subscriptions.set_delivery_mode(db, "1", IMMEDIATE) == DAILY
+    assert index_users(db, DELIVERY, DAILY) == set()
+
+
+def test_event_types(db):
+    assert subscriptions.set_event_types(db, "1", ["created", "end"]) == ["created", "start", "end", "deleted"]
+    assert user_doc(db, "1")["events"] == ["created", "end"]
+    assert index_users(db, MUTED_EVENT, "start") == {"1"}
+    assert index_users(db, MUTED_EVENT, "deleted") == {"1"}
+    assert index_users(db, MUTED_EVENT, "created") == set()
+
+    assert subscriptions.set_event_types(db, "1", ["created", "start", "end"]) == ["created", "end"]
+    assert index_users(db, MUTED_EVENT, "start") == set()
+    assert index_users(db, MUTED_EVENT, "deleted") == {"1"}
+
+
+def test_deactivate_removes_the_user_from_the_index(db):
+    subscriptions.subscribe(db, "1", PROJECT, ["dao.eth"])
+    subscriptions.subscribe(db, "1", KEYWORD, ["Grant"])
+    subscriptions.set_delivery_mode(db, "1", HOURLY)
+    subscriptions.set_event_types(db, "1", ["created"])
+    subscriptions.subscribe(db, "2", PROJECT, ["dao.eth"])
+    get_queue_ref(db, "1").set({"mode": HOURLY, "items": ["event"], "pending": True})
+
+    assert subscriptions.deactivate_users(db, ["1", "unknown"]) == 1
+    assert user_doc(db, "1")["active"] is False
+    assert index_users(db, PROJECT, "dao.eth") == {"2"}
+    assert index_users(db, KEYWORD, "grant") == set()
+    assert index_users(db, DELIVERY, HOURLY) == set()
+    assert index_users(db, MUTED_EVENT, "start") == set()
+    assert not get_queue_ref(db, "1").get().exists
+
+    assert subscriptions.deactivate_users(db, ["1"]) == 0
+
+
+def test_subscribing_again_reactivates(db):
+    subscriptions.subscribe(db, "1", PROJECT, ["dao.eth"])
+    subscriptions.set_delivery_mode(db, "1", DAILY)
+    subscriptions.deactivate_users(db, ["1"])
+
+    subscriptions.subscribe(db, "1", KEYWORD, ["grant"])
+    assert "active" not in user_doc(db, "1")
+    assert "inactive_since" not in user_doc(db, "1")
+    assert index_users(db, PROJECT, "dao.eth") == {"1"}
+    assert index_users(db, DELIVERY, DAILY) == {"1"}
+    assert index_users(db, KEYWORD, "grant") == {"1"}
+
+
+def test_reactivate_user(db):
+    subscriptions.subscribe(db, "1", PROJECT, ["dao.eth"])
+    assert not subscriptions.reactivate_user(db, "1")
+    assert not subscriptions.reactivate_user(db, "unknown")
+
+    subscriptions.deactivate_users(db, ["1"])
+    assert subscriptions.reactivate_user(db, "1")
+    assert index_users(db, PROJECT, "dao.eth") == {"1"}
+
+
+def test_compact_inactive_users(db, monkeypatch):
+    for user_id in "123":
+        subscriptions.subscribe(db, user_id, PROJECT, [f"{user_id}.eth"])
+    subscriptions.deactivate_users(db, ["1", "2"])
+
+    # Nothing is old enough yet
+    counts = subscriptions.compact_inactive_users(db)
+    assert counts == {"inactive_users": 2, "deleted_users": 0, "deleted_index_entries": 0}
+
+    subscriptions.reactivate_user(db, "2")
+    monkeypatch.setattr(subscriptions, "EMPTY_INDEX_ENTRY_RETENTION", datetime.timedelta(seconds=-1))
+    counts = subscriptions.compact_inactive_users(db, retention_days=-1)
+    assert counts == {"inactive_users": 0, "deleted_users": 1, "deleted_index_entries": 1}
+    assert not subscriptions.get_user_ref(db, "1").get().exists
+    assert user_doc(db, "2")["projects"] == ["2.eth"]
+    entries = db.collection(subscription_index.INDEX_COLLECTION).stream()
+    assert sorted(doc.to_dict()["term"] for doc in entries) == ["2.eth", "3.eth"]
@@ -0,0 +1,53 @@
+from common.tickers import (
+    ALL_TICKERS,
+    KNOWN_TICKERS,
+    PREFIXED_ONLY_TICKERS,
+    extract_tickers,
+    get_ticker_subscriptions,
+    is_known_ticker,
+    normalize_ticker,
+)
+
+
+def test_upper_case_or_prefixed():
+    assert extract_tickers("Swap UNI for AAVE") == {"UNI", "AAVE"}
+    assert extract_tickers("Swap $uni for $Aave") == {"UNI", "AAVE"}
+    assert extract_tickers("Uni and uni and aave") == set()
+
+
+def test_common_words_only_match_with_the_prefix():
+    assert extract_tickers("Add a LINK to the POOL, NOTE the SAFE BANK") == set()
+    assert extract_tickers("Bridge $LINK and $safe") == {"LINK", "SAFE"}
+    for ticker in PREFIXED_ONLY_TICKERS:
+        assert extract_tickers(f"about {ticker} here") == set(), ticker
+        assert extract_tickers(f"about ${ticker.lower()} here") == {ticker}, ticker
+
+
+def test_known_ticker_list():
+    assert not KNOWN_TICKERS & PREFIXED_ONLY_TICKERS
+    assert {"LINK", "POOL", "NOTE", "SAFE", "BANK", "ALPHA", "BAND", "SAND"} <= PREFIXED_ONLY_TICKERS
+    assert {"UNI", "AAVE", "ETH"} <= KNOWN_TICKERS
+
+
+def test_token_boundaries():
+    assert extract_tickers("(UNI), UNI. UNI!\nUNI") == {"UNI"}
+    assert extract_tickers("UNIX and XUNI and UNI2 and UNI_V3") == set()
+    assert extract_tickers("a$UNI and $$UNI") == set()
+    assert extract_tickers("AAVEAAVEAAVE") == set()
+    assert extract_tickers("") == set()
+
+
+def test_normalize_and_known():
+    assert normalize_ticker(" $uni ") == "UNI"
+    assert is_known_ticker("UNI")
+    assert is_known_ticker("LINK")
+    assert is_known_ticker(ALL_TICKERS)
+    assert not is_known_ticker("uni")
+    assert not is_known_ticker("NOTATICKER")
+
+
+def test_ticker_subscriptions():
+    assert get_ticker_subscriptions(True) == [ALL_TICKERS]
+    assert get_ticker_subscriptions(None) == []
+    assert get_ticker_subscriptions(False) == []
+    assert get_ticker_subscriptions(["UNI"]) == ["UNI"]
@@ -1,88 +1,104 @@
+import os
 import json
-import time
-import requests
-import openai
-from google.cloud import firestore, secretmanager
+import base64
+import functions_framework
 from flask import jsonify
+from common import instrumentation
+from common.clients import get_firestore_client, get_publisher_client, get_secret_value
+from common.proposal import PROPOSAL_DELETED
+from snapshot_client import ProposalClient
 
-db = firestore.Client()
+# In fast-ack mode the webhook only validates and enqueues events. The
+# enrich_snapshot_event worker fetches the proposal data and stores them.
+FAST_ACK = os.environ.get("WEBHOOK_FAST_ACK", "false").lower() == "true"
+PENDING_EVENTS_TOPIC = "snapshot-webhook-events"
 
-def get_secret_value(secret_name):
-    # Create the Secret Manager client
-    client = secretmanager.SecretManagerServiceClient()
+# Snapshot API client shared by every request on this instance
+proposal_client = ProposalClient()
 
-    project_id = 'telegram-governance-bot'
 
-    # Build the resource name of the secret version
-    name = f"projects/{project_id}/secrets/{secret_name}/versions/latest"
-
-    # Access the secret version
-    response = client.access_secret_version(request={"name": name})
-
-    # Return the secret payload as a string
-    return response.payload.data.decode("UTF-8")
+def is_valid_secret(secret):
+    if secret == get_secret_value("SNAPSHOT_WEBHOOK_SECRET"):
+        return True
+    # The cached secret may be outdated after a rotation, so check the latest version once more
+    return secret == get_secret_value("SNAPSHOT_WEBHOOK_SECRET", force_refresh=True)
 
 def store_event(data):
     event_id = data["id"]
+    db = get_firestore_client()
     doc_ref = db.collection("snapshot_events").document(event_id)
     doc_ref.set(data)
     return event_id
 
-def fetch_proposal_data(proposal_id, max_retries=3, delay=2):
-    url = 'https://hub.snapshot.org/graphql'
-    query = '''
-    query ($id: String!) {
-      proposal(id: $id) {
-        id
-        title
-        body
-        choices
-        start
-        end
-        snapshot
-        state
-        author
-        created
-        scores
-        scores_by_strategy
-        scores_total
-        scores_updated
-        plugins
-        network
-        strategies {
-          name
-          network
-          params
-        }
-        space {
-          id
-          name
-        }
-      }
-    }
-    '''
-
-    variables = {
-        'id': proposal_id
-    }
-
-    for i in range(max_retries):
-        try:
-            response = requests.post(url, json={'query': query, 'variables': variables})
-            data = response.json()
-            return data['data']['proposal']
-        except Exception as e:
-            if i < max_retries - 1:
-                time.sleep(delay)
-            else:
-                raise e
+# Function to record the deletion of a stored proposal. Every proposal has one
+# snapshot_events document, updated with each of its lifecycle events.
+def mark_event_deleted(proposal_id, event_data):
+    from google.api_core.exceptions import NotFound
+
+    db = get_firestore_client()
+    doc_ref = db.collection("snapshot_events").document(proposal_id)
+    try:
+        doc_ref.update({"event": event_data['event'], "trace_id": instrumentation.get_trace_id()})
+    except NotFound:
+        print(f"Proposal {proposal_id} was never stored, skipping {event_data['event']} event")
+        return None
+    return proposal_id
+
+# Function to fetch the proposal data for a webhook event and store both
+def enrich_and_store(event_data):
+    # Fetch the additional proposal data
+    proposal_id = event_data['id'].split('/')[-1]
+    with instrumentation.span("fetch", proposal_id=proposal_id):
+        proposal_data = proposal_client.get(proposal_id)
+    if proposal_data is None:
+        if event_data['event'] == PROPOSAL_DELETED:
+            # Deleted proposals can't be fetched anymore, so only the event of the
+            # stored proposal is updated
+            with instrumentation.span("store"):
+                return mark_event_deleted(proposal_id, event_data)
+        print(f"Proposal {proposal_id} not found, skipping {event_data['event']} event")
+        return None
+
+    # Merge the event data and the proposal data. The trace id is stored with the
+    # event, so the matcher triggered by the write continues the same trace.
+    merged_data = {**event_data, **proposal_data, "trace_id": instrumentation.get_trace_id()}
+
+    # Store the merged data in Firestore
+    with instrumentation.span("store"):
+        return store_event(merged_data)
+
+# Function to queue a webhook event for the enrichment worker
+def enqueue_event(event_data):
+    publisher = get_publisher_client()
+    topic_path = publisher.topic_path("telegram-governance-bot", PENDING_EVENTS_TOPIC)
+    # Wait for the publish, the event is lost if the function is frozen before it's sent
+    publisher.publish(
+        topic_path, json.dumps(event_data).encode("utf-8"), trace_id=instrumentation.get_trace_id()
+    ).result(timeout=10)
+
+# Pub/Sub triggered worker for events queued in fast-ack mode. Raising makes Pub/Sub retry.
+# Runs with concurrency, so proposal lookups of concurrent events are batched together.
+@functions_framework.cloud_event
+def enrich_snapshot_event(cloud_event):
+    message = cloud_event.data["message"]
+    event_data = json.loads(base64.b64decode(message["data"]).decode("utf-8"))
+    trace_id = message.get("attributes", {}).get("trace_id")
+    with instrumentation.trace("enrich", trace_id=trace_id, event=event_data["event"]):
+        enrich_and_store(event_data)
 
 def webhook(request):
+    # Every webhook call starts a new trace, followed through the matcher and the bot
+    with instrumentation.trace("webhook"):
+        return handle_webhook(request)
+
+def handle_webhook(request):
     if request.method == 'POST':
-        data = json.loads(request.data)
+        with instrumentation.span("validate"):
+            data = json.loads(request.data)
+            valid = 'secret' in data and is_valid_secret(data['secret'])
 
         # Check if the webhook payload contains a 'secret' field and compare it to the provided secret token
-        if 'secret' in data and data['secret'] == get_secret_value("SNAPSHOT_WEBHOOK_SECRET"):
+        if valid:
 
             event_data = {
                 'id': data['id'],
@@ -91,20 +107,21 @@ def webhook(request):
                 'expire': data['expire']
             }
 
-            # Fetch the additional proposal data
-            proposal_id = event_data['id'].split('/')[-1]
-            
+            instrumentation.set_attribute("event", data['event'])
+
+            if FAST_ACK:
+                try:
+                    with instrumentation.span("enqueue"):
+                        enqueue_event(event_data)
+                except Exception as e:
+                    return jsonify({"status": "error", "message": f"Error queueing event: {str(e)}"})
+                return jsonify({"status": "OK"})
+
             try:
-                proposal_data = fetch_proposal_data(proposal_id)
+                enrich_and_store(event_data)
             except Exception as e:
                 return jsonify({"status": "error", "message": f"Error fetching proposal data: {str(e)}"})
 
-            # Merge the event data and the proposal data
-            merged_data = {**event_data, **proposal_data}
-
-            # Store the merged data in Firestore
-            event_id = store_event(merged_data)
-
         return jsonify({"status": "OK"})
     else:
         return jsonify({"status": "error", "message": "Invalid secret token"})
\ No newline at end of file
@@ -0,0 +1,176 @@
+import random
+import threading
+import time
+from concurrent.futures import Future
+
+import requests
+from requests.adapters import HTTPAdapter
+
+SNAPSHOT_GRAPHQL_URL = 'https://hub.snapshot.org/graphql'
+
+PROPOSAL_FIELDS = '''
+    id
+    title
+    body
+    choices
+    start
+    end
+    snapshot
+    state
+    author
+    created
+    updated
+    scores
+    scores_by_strategy
+    scores_total
+    scores_updated
+    plugins
+    network
+    strategies {
+      name
+      network
+      params
+    }
+    space {
+      id
+      name
+    }
+'''
+
+# Only used to check whether a cached proposal is still current
+PROPOSAL_VERSION_FIELDS = '''
+    id
+    updated
+'''
+
+
+class SnapshotGraphQLError(Exception):
+    pass
+
+
+# Client for the Snapshot GraphQL API. Concurrent lookups are coalesced into one
+# aliased multi-proposal query, and proposals are cached by id and `updated`, so
+# repeated events for an unchanged proposal only cost a small version query.
+class ProposalClient:
+    def __init__(
+        self,
+        url=SNAPSHOT_GRAPHQL_URL,
+        timeout=(3, 10),
+        max_retries=3,
+        backoff=0.5,
+        batch_window=0.02,
+        max_batch_size=20,
+        cache_ttl=300,
+    ):
+        self.url = url
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.batch_window = batch_window
+        self.max_batch_size = max_batch_size
+        self.cache_ttl = cache_ttl
+
+        # Keep-alive connections reused across invocations
+        self.session = requests.Session()
+        self.session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=10))
+
+        self._cache = {}  # proposal id -> (proposal, cached_at)
+        self._pending = {}  # proposal id -> Future, for the next batch
+        self._batch_scheduled = False
+        self._lock = threading.Lock()
+
+    def _post(self, query, variables):
+        for i in range(self.max_retries):
+            try:
+                response = self.session.post(
+                    self.url, json={'query': query, 'variables': variables}, timeout=self.timeout
+                )
+                response.raise_for_status()
+                reply = response.json()
+                if reply.get('errors'):
+                    messages = "; ".join(error.get('message', str(error)) for error in reply['errors'])
+                    raise SnapshotGraphQLError(messages)
+                return reply['data']
+            except Exception:
+                if i < self.max_retries - 1:
+                    # Exponential backoff with jitter
+                    time.sleep(self.backoff * 2 ** i + random.uniform(0, self.backoff))
+                else:
+                    raise
+
+    # Function to look up several proposals with aliased queries (p0: proposal(...), p1: ...)
+    def _query_proposals(self, proposal_ids, fields):
+        proposals = {}
+        for start in range(0, len(proposal_ids), self.max_batch_size):
+            chunk = proposal_ids[start:start + self.max_batch_size]
+            params = ", ".join(f"$id{i}: String!" for i in range(len(chunk)))
+            selections = "\n".join(f"p{i}: proposal(id: $id{i}) {{{fields}}}" for i in range(len(chunk)))
+            data = self._post(
+                f"query ({params}) {{\n{selections}\n}}",
+                {f"id{i}": proposal_id for i, proposal_id in enumerate(chunk)},
+            )
+            for i, proposal_id in enumerate(chunk):
+                proposals[proposal_id] = data.get(f"p{i}")
+        return proposals
+
+    # Function to fetch several proposals, only downloading the ones that changed since cached
+    def fetch_many(self, proposal_ids):
+        now = time.monotonic()
+        with self._lock:
+            cached = {
+                proposal_id: entry[0]
+                for proposal_id, entry in ((proposal_id, self._cache.get(proposal_id)) for proposal_id in proposal_ids)
+                if entry is not None and now - entry[1] < self.cache_ttl
+            }
+
+        proposals = {}
+        if cached:
+            versions = self._query_proposals(list(cached), PROPOSAL_VERSION_FIELDS)
+            for proposal_id, version in versions.items():
+                if version is not None and version.get('updated') == cached[proposal_id].get('updated'):
+                    proposals[proposal_id] = cached[proposal_id]
+
+        missing = [proposal_id for proposal_id in proposal_ids if proposal_id not in proposals]
+        if missing:
+            fetched = self._query_proposals(missing, PROPOSAL_FIELDS)
+            with self._lock:
+                for proposal_id, proposal in fetched.items():
+                    if proposal is not None:
+                        self._cache[proposal_id] = (proposal, now)
+                    else:
+                        self._cache.pop(proposal_id, None)
+                # Drop expired entries
+                self._cache = {
+                    proposal_id: entry for proposal_id, entry in self._cache.items() if now - entry[1] < self.cache_ttl
+                }
+            proposals.update(fetched)
+
+        return proposals
+
+    # Function to get a single proposal. Lookups arriving within the batch window,
+    # from any thread, are sent together; lookups for the same id share one result.
+    def get(self, proposal_id):
+        with self._lock:
+            future = self._pending.get(proposal_id)
+            if future is None:
+                future = Future()
+                self._pending[proposal_id] = future
+            leader = not self._batch_scheduled
+            self._batch_scheduled = True
+
+        if leader:
+            time.sleep(self.batch_window)
+            with self._lock:
+                batch, self._pending = self._pending, {}
+                self._batch_scheduled = False
+
+            try:
+                proposals = self.fetch_many(list(batch))
+            except Exception as e:
+                for pending in batch.values():
+                    pending.set_exception(e)
+            else:
+                for pending_id, pending in batch.items():
+                    pending.set_result(proposals.get(pending_id))
+
+        return future.result()